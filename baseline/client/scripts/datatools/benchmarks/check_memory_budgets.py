@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# Checks that the peak memory each datatools component uses, in bytes per trial, stays within the budgets
+# in memory_budgets.json. The components are run on synthetic data by run_benchmarks.py, under tracemalloc,
+# and the script exits with status 1 if any of them goes over its budget, so it can be used as a
+# regression check before merging changes to the transformers, combine_task_files, extract_all or label_setnums.
+# test_memory_budgets.py runs the same check under pytest when DATATOOLS_MEMORY_BUDGETS=1 is set.
+#
+# Budgets are keyed by component name (as printed by run_benchmarks.py); a key may be a shell-style
+# pattern such as transform:*, and the first matching key is used. Components without a budget are
+# reported but don't fail the check.
+#
+# Usage:
+# check_memory_budgets.py [--budgets memory_budgets.json] [--scale small|medium|large] [--components c1 c2 ...]
+# check_memory_budgets.py --update [--headroom 1.5]
+#   Sets every measured component's budget to its current bytes per trial times the headroom. Do this
+#   when a change is expected to use more memory, and commit the new budgets along with it.
+#
+# Bytes per trial settle once there are a few thousand trials per component, so the budgets hold at any
+# scale from medium up, but the small scale is too small to check against.
+
+import argparse
+from fnmatch import fnmatchcase
+import json
+import math
+from pathlib import Path
+import sys
+
+import run_benchmarks
+import synthetic_trials
+
+DEFAULT_BUDGETS = Path(__file__).resolve().parent / 'memory_budgets.json'
+
+def budget_for(name, budgets):
+    if name in budgets:
+        return budgets[name]
+    for (pattern, budget) in budgets.items():
+        if fnmatchcase(name, pattern):
+            return budget
+    return None
+
+def check(results, budgets):
+    """Returns (over, unbudgeted): a list of (component, bytes per trial, budget) for every component over its budget, and the components with no budget."""
+    over = []
+    unbudgeted = []
+    for (name, res) in results.items():
+        budget = budget_for(name, budgets)
+        if budget is None:
+            unbudgeted.append(name)
+        elif res['bytes_per_trial'] > budget:
+            over.append((name, res['bytes_per_trial'], budget))
+    return (over, unbudgeted)
+
+def updated_budgets(results, budgets, headroom):
+    """Returns budgets with an exact-name entry for every measured component set to headroom times its bytes per trial."""
+    new_budgets = dict(budgets)
+    for (name, res) in results.items():
+        new_budgets[name] = math.ceil(res['bytes_per_trial'] * headroom)
+    return new_budgets
+
+if __name__ == '__main__':
+    def _parse_args():
+        parser = argparse.ArgumentParser(description='Fails if any component uses more memory per trial than its budget.')
+        parser.add_argument('--budgets', type=Path, default=DEFAULT_BUDGETS, help='Budgets file (default memory_budgets.json next to this script)')
+        parser.add_argument('--scale', choices=run_benchmarks.SCALES.keys(), default='medium', help='Preset for the amount of synthetic data (default medium)')
+        parser.add_argument('--components', nargs='+', choices=run_benchmarks.COMPONENTS, default=run_benchmarks.COMPONENTS)
+        parser.add_argument('--update', help='Write new budgets from this run instead of checking', action='store_true')
+        parser.add_argument('--headroom', type=float, default=1.5, help='With --update, the multiple of the measured bytes per trial to allow (default 1.5)')
+        return parser.parse_args()
+
+    def _main(args):
+        with open(args.budgets) as f:
+            budget_file = json.load(f)
+        budgets = budget_file['budgets']
+        (users, sets, trials) = run_benchmarks.SCALES[args.scale]
+        print(f'Measuring peak memory with {users} users, {sets} sets and {trials} trials per run...')
+        results = run_benchmarks.run_benchmarks(args.components, synthetic_trials.make_users(users), sets, trials)
+
+        if args.update:
+            budget_file['budgets'] = updated_budgets(results, budgets, args.headroom)
+            with open(args.budgets, 'w') as f:
+                json.dump(budget_file, f, indent=2)
+                f.write('\n')
+            print(f'Updated {len(results)} budgets in {args.budgets}.')
+            return 0
+
+        (over, unbudgeted) = check(results, budgets)
+        print(f'{"component":<45} {"bytes/trial":>11} {"budget":>8}')
+        for (name, res) in results.items():
+            budget = budget_for(name, budgets)
+            print(f'{name:<45} {res["bytes_per_trial"]:>11.0f} {budget if budget is not None else "-":>8}')
+        for name in unbudgeted:
+            print(f'WARNING: no memory budget for {name}')
+        for (name, bytes_per_trial, budget) in over:
+            print(f'OVER BUDGET {name}: {bytes_per_trial:.0f} bytes/trial vs budget {budget}')
+        return 1 if over else 0
+
+    sys.exit(_main(_parse_args()))
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# Benchmarks the datatools against synthetic data from synthetic_trials.py, reporting throughput
+# (trials per second) and peak memory (from tracemalloc) for each component, and optionally comparing
+# the results against a baseline saved by an earlier run.
+#
+# Components:
+#  transform      TsvTransformer.process for each of the 20 tasks (reported per task)
+#  combine        combine_task_files on the per-run .tsv files for --combine-task, both with the
+#                 byte-level fast path and with a row filter (which uses the csv parser)
+#  extract        multi-exp-json-to-csv.py's extract_all on a mixed export
+#  label-setnums  label_setnums.py on a mixed export, streamed from the export file to an output file the way
+#                 the script runs it, both in one process and partitioned across 2 processes (-j 2).
+#                 tracemalloc only sees the parent process, so the parallel figure covers partitioning
+#                 and writing the output, not the labeling done in the workers.
+#  decode         dynamo_decode.py on wire-format items for every task, and boto3's TypeDeserializer
+#                 (what the resource layer uses) on the same items if boto3 is installed
+#
+# Usage:
+# run_benchmarks.py [--scale small|medium|large] [--users n] [--sets n] [--trials n] [--components c1 c2 ...]
+#                   [--save-baseline file] [--baseline file] [--tolerance 0.15] [--no-memory]
+# Run it from any directory; it imports the tools from their locations in this repo. The combine
+# component needs no Flywheel access, but it does need the combine-cog-files dependencies installed.
+#
+# Timing and memory are measured in separate runs of each component, because tracemalloc slows
+# Python down considerably. Baselines are only meaningful on the machine they were recorded on.
+
+import argparse
+import gc
+import importlib.util
+import json
+import os
+from pathlib import Path
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+DATATOOLS_DIR = Path(__file__).resolve().parent.parent
+sys.path[0:0] = [str(DATATOOLS_DIR), str(DATATOOLS_DIR / 'cog-to-flywheel'), str(DATATOOLS_DIR / 'combine-cog-files')]
+
+import synthetic_trials
+
+SCALES = {
+    # users, sets, trials per run
+    'small': (5, 12, 40),
+    'medium': (50, 12, 60),
+    'large': (500, 12, 60),
+}
+COMPONENTS = ['transform', 'combine', 'extract', 'label-setnums', 'decode']
+
+def load_script(name, file_name):
+    """Imports one of the datatools scripts whose file names aren't valid module names."""
+    spec = importlib.util.spec_from_file_location(name, DATATOOLS_DIR / file_name)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def measure(fn, trials, trace_memory=True):
+    """
+    Runs fn twice: once to time it and (if trace_memory) once under tracemalloc to find its peak memory use.
+    Returns a dict of results; trials is the number of trials fn processes and is used for the per-trial figures.
+    """
+    gc.collect()
+    start = time.perf_counter()
+    fn()
+    secs = time.perf_counter() - start
+    result = {'trials': trials, 'seconds': secs, 'trials_per_second': trials / secs if secs > 0 else 0}
+    if trace_memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            fn()
+            (_, peak) = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        result['peak_bytes'] = peak
+        result['bytes_per_trial'] = peak / trials if trials else 0
+    return result
+
+class in_directory(object):
+    def __init__(self, path):
+        self.path = path
+    def __enter__(self):
+        self.prev = os.getcwd()
+        os.chdir(self.path)
+    def __exit__(self, *exc):
+        os.chdir(self.prev)
+
+def bench_transform(users, sets, trials_per_run, workdir, trace_memory, tasks=synthetic_trials.TASKS):
+    from tsv_transformer import transformer_for_task
+    results = {}
+    for task in tasks:
+        items = list(synthetic_trials.generate_task_items(task, users, sets, trials_per_run))
+        def run():
+            transformer = transformer_for_task(task, items, users[0].human_id)
+            transformer.process()
+        with in_directory(workdir):
+            results[f'transform:{task}'] = measure(run, len(items), trace_memory)
+        del items
+    return results
+
+def make_task_files(task, users, sets, trials_per_run, outdir):
+    """Writes the per-run .tsv files for task for every user to outdir and returns their paths and the number of rows in them."""
+    from tsv_transformer import transformer_for_task
+    files = []
+    with in_directory(outdir):
+        for user in users:
+            items = synthetic_trials.generate_task_items(task, [user], sets, trials_per_run)
+            files.extend(transformer_for_task(task, list(items), user.human_id).process())
+    paths = [Path(outdir) / f for f in files]
+    rows = 0
+    for p in paths:
+        with open(p, 'rb') as f:
+            rows += f.read().count(b'\n') - 1
+    return (paths, rows)
+
+def bench_combine(users, sets, trials_per_run, workdir, trace_memory, task='task-flanker'):
+    combine = load_script('combine_cog_files_script', 'combine-cog-files/combine-cog-files.py')
+    from combine_cog_files.filters import CombineFilter
+    tsv_dir = Path(workdir) / 'tsv'
+    tsv_dir.mkdir(exist_ok=True)
+    (paths, rows) = make_task_files(task, users, sets, trials_per_run, tsv_dir)
+    user_map = {combine.hash_subject(u.human_id): 'F' if idx % 2 == 0 else 'P' for (idx, u) in enumerate(users)}
+    condition_map = combine.make_condition_map()
+    outfile = Path(workdir) / 'combined.tsv'
+    results = {}
+    results[f'combine:{task}:fast'] = measure(lambda: combine.combine_task_files(paths, outfile, False, user_map, condition_map), rows, trace_memory)
+    row_filter = CombineFilter(columns=['date_time', 'response', 'correct', 'response_time_ms'], predicates=['is_relevant=True'])
+    results[f'combine:{task}:filtered'] = measure(lambda: combine.combine_task_files(paths, outfile, False, user_map, condition_map, None, row_filter), rows, trace_memory)
+    return results
+
+def write_export_file(users, sets, trials_per_run, workdir):
+    path = Path(workdir) / 'export.json'
+    with open(path, 'w') as f:
+        count = synthetic_trials.write_export(synthetic_trials.generate_export(synthetic_trials.TASKS, users, sets, trials_per_run), f)
+    return (path, count)
+
+def bench_extract(export_path, trials, trace_memory):
+    multi_exp = load_script('multi_exp_json_to_csv', 'multi-exp-json-to-csv.py')
+    return {'extract:all': measure(lambda: multi_exp.extract_all(export_path), trials, trace_memory)}
+
+def bench_label_setnums(export_path, trials, workdir, trace_memory):
+    import label_setnums
+    from trial_archive import open_trials
+    output_path = Path(workdir) / 'labeled.json'
+    def run_stream():
+        with open(output_path, 'w') as f:
+            label_setnums.write_trials(label_setnums.iter_labeled_setnums(open_trials(export_path)), f)
+    def run_parallel():
+        with open(output_path, 'w') as f:
+            label_setnums.label_setnums_parallel(open_trials(export_path), f, 2)
+    return {
+        'label-setnums:stream': measure(run_stream, trials, trace_memory),
+        'label-setnums:parallel': measure(run_parallel, trials, trace_memory),
+    }
+
+def bench_decode(users, sets, trials_per_run, trace_memory):
+    from dynamo_decode import decode_items
+    wire_items = [synthetic_trials.to_wire_format(item) for task in synthetic_trials.TASKS
+                  for item in synthetic_trials.generate_task_items(task, users, sets, trials_per_run)]
+    results = {'decode:raw': measure(lambda: decode_items(wire_items, ['identityId', 'userId']), len(wire_items), trace_memory)}
+    try:
+        from boto3.dynamodb.types import TypeDeserializer
+    except ImportError:
+        return results
+    deserializer = TypeDeserializer()
+    def run():
+        return [{k: deserializer.deserialize(v) for (k, v) in item.items()} for item in wire_items]
+    results['decode:type-deserializer'] = measure(run, len(wire_items), trace_memory)
+    return results
+
+def run_benchmarks(components, users, sets, trials_per_run, trace_memory=True):
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        if 'transform' in components:
+            results.update(bench_transform(users, sets, trials_per_run, workdir, trace_memory))
+        if 'combine' in components:
+            results.update(bench_combine(users, sets, trials_per_run, workdir, trace_memory))
+        if 'decode' in components:
+            results.update(bench_decode(users, sets, trials_per_run, trace_memory))
+        if 'extract' in components or 'label-setnums' in components:
+            (export_path, trials) = write_export_file(users, sets, trials_per_run, workdir)
+            if 'extract' in components:
+                results.update(bench_extract(export_path, trials, trace_memory))
+            if 'label-setnums' in components:
+                results.update(bench_label_setnums(export_path, trials, workdir, trace_memory))
+    return results
+
+def compare(results, baseline, tolerance):
+    """Returns a list of (component, message) for every component that's slower or uses more memory than the baseline allows."""
+    regressions = []
+    for (name, res) in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if base['trials_per_second'] and res['trials_per_second'] < base['trials_per_second'] * (1 - tolerance):
+            regressions.append((name, f'throughput {res["trials_per_second"]:.0f}/s vs baseline {base["trials_per_second"]:.0f}/s'))
+        if 'bytes_per_trial' in res and base.get('bytes_per_trial') and res['bytes_per_trial'] > base['bytes_per_trial'] * (1 + tolerance):
+            regressions.append((name, f'peak memory {res["bytes_per_trial"]:.0f} bytes/trial vs baseline {base["bytes_per_trial"]:.0f} bytes/trial'))
+    return regressions
+
+def print_results(results, baseline=None):
+    print(f'{"component":<45} {"trials":>9} {"seconds":>8} {"trials/s":>10} {"peak MB":>8} {"bytes/trial":>11} {"vs baseline":>12}')
+    for (name, res) in results.items():
+        peak = f'{res["peak_bytes"] / 1e6:.1f}' if 'peak_bytes' in res else '-'
+        per_trial = f'{res["bytes_per_trial"]:.0f}' if 'bytes_per_trial' in res else '-'
+        vs = ''
+        if baseline and baseline.get(name, {}).get('trials_per_second'):
+            vs = f'{res["trials_per_second"] / baseline[name]["trials_per_second"]:.2f}x'
+        print(f'{name:<45} {res["trials"]:>9} {res["seconds"]:>8.2f} {res["trials_per_second"]:>10.0f} {peak:>8} {per_trial:>11} {vs:>12}')
+
+if __name__ == '__main__':
+    def _parse_args():
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--scale', choices=SCALES.keys(), default='small', help='Preset for --users, --sets and --trials')
+        parser.add_argument('--users', type=int)
+        parser.add_argument('--sets', type=int)
+        parser.add_argument('--trials', type=int, help='Trials per run for non-survey tasks')
+        parser.add_argument('--components', nargs='+', choices=COMPONENTS, default=COMPONENTS)
+        parser.add_argument('--no-memory', help='Skip the (slow) tracemalloc runs', action='store_true', dest='no_memory')
+        parser.add_argument('--save-baseline', help='Save the results to this file for later comparison', dest='save_baseline')
+        parser.add_argument('--baseline', help='Compare the results to a baseline saved with --save-baseline')
+        parser.add_argument('--tolerance', type=float, default=0.15, help='Fractional slowdown or memory increase vs. the baseline to allow before reporting a regression')
+        return parser.parse_args()
+
+    def _main(args):
+        (users, sets, trials) = SCALES[args.scale]
+        users = args.users or users
+        sets = args.sets or sets
+        trials = args.trials or trials
+        print(f'Benchmarking with {users} users, {sets} sets and {trials} trials per run...')
+        results = run_benchmarks(args.components, synthetic_trials.make_users(users), sets, trials, not args.no_memory)
+
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)['results']
+        print_results(results, baseline)
+
+        if args.save_baseline:
+            with open(args.save_baseline, 'w') as f:
+                json.dump({'users': users, 'sets': sets, 'trials': trials, 'python': platform.python_version(), 'results': results}, f, indent=2)
+            print(f'Saved results to {args.save_baseline}.')
+
+        if baseline:
+            regressions = compare(results, baseline, args.tolerance)
+            for (name, msg) in regressions:
+                print(f'REGRESSION {name}: {msg}')
+            if regressions:
+                sys.exit(1)
+
+    _main(_parse_args())
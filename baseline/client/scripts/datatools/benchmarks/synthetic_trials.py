@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+# Generates realistic synthetic jsPsych trial streams for all of the cognitive assessment tasks,
+# for use in benchmarks. Each run of a task looks like the real thing: a taskStarted header with
+# the setNum, a mix of relevant and irrelevant (instruction, fullscreen, etc.) trials, and a
+# final trial with the ua/v/screen values that marks the end of the run.
+#
+# Trials can be generated in either of two shapes:
+#  - DynamoDB items (identityId, userId, experimentDateTime, isRelevant, results), as consumed by tsv_transformer
+#  - export trials (the results fields plus dateTime, experiment, isRelevant and userId), as produced by
+#    the admin download and consumed by multi-exp-json-to-csv.py, label_setnums.py, etc.
+#
+# Usage:
+# synthetic_trials.py [--tasks task-panas task-nBack ...] [--users n] [--sets n] [--trials n] [--relevant-fraction f] [--seed n] [--format json|ndjson] outfile
+# Writes an export (trials from all of the given tasks, in dateTime order for each user) to outfile.
+
+from datetime import datetime, timedelta, timezone
+import json
+import math
+import random
+import re
+import string
+import uuid
+
+TASKS = ['task-ffmq', 'task-faceName', 'task-moodPrediction', 'task-dass', 'task-mindInEyes', 'task-dailyStressors', 'task-patternSeparationRecall', 'task-flanker', 'task-emotionalMemory', 'task-panas', 'task-nBack', 'task-moodMemory', 'task-patternSeparationLearning', 'task-verbalFluency', 'task-sleepSurvey', 'task-spatialOrientation', 'task-taskSwitching', 'task-verbalLearningLearning', 'task-physicalActivity', 'task-verbalLearningRecall']
+
+# tasks whose runs are a handful of survey pages rather than many trials
+SURVEY_TASKS = ['task-ffmq', 'task-moodPrediction', 'task-dass', 'task-dailyStressors', 'task-panas', 'task-moodMemory', 'task-sleepSurvey', 'task-physicalActivity']
+
+PANAS_ITEMS = ['ashamed', 'upset', 'strong', 'proud', 'excited', 'hostile', 'attentive', 'active', 'inspired', 'distressed', 'enthusiastic', 'guilty', 'irritable', 'alert', 'nervous', 'determined', 'jittery', 'afraid', 'interested', 'scared']
+FFMQ_QUESTIONS = [
+    "When I take a shower or a bath, I stay alert to the sensations of water on my body.",
+    "I’m good at finding words to describe my feelings.",
+    "I don’t pay attention to what I’m doing because I’m daydreaming, worrying, or otherwise distracted.",
+    "I believe some of my thoughts are abnormal or bad and I shouldn’t think that way.",
+    "When I have distressing thoughts or images, I “step back” and am aware of the thought or image without getting taken over by it.",
+    "I notice how foods and drinks affect my thoughts, bodily sensations, and emotions.",
+    "I have trouble thinking of the right words to express how I feel about things.",
+    "I do jobs or tasks automatically without being aware of what I’m doing.",
+    "I think some of my emotions are bad or inappropriate and I shouldn’t feel them.",
+    "When I have distressing thoughts or images I am able just to notice them without reacting.",
+    "I pay attention to sensations, such as the wind in my hair or the sun on my face.",
+    "Even when I’m feeling terribly upset I can find a way to put it into words.",
+    "I find myself doing things without paying attention.",
+    "I tell myself I shouldn’t be feeling the way I’m feeling.",
+    "When I have distressing thoughts or images I just notice them and let them go."
+]
+SLEEP_QUESTIONS = [
+    "as a passenger in a car for an hour without a break",
+    "in a car, while stopped for a few minutes in traffic",
+    "lying down to rest in the afternoon when circumstances permit",
+    "sitting and reading",
+    "sitting and talking to someone",
+    "sitting inactive in a public place (e.g., a theater or a meeting)",
+    "sitting quietly after a lunch without alcohol",
+    "watching tv",
+    "sleepiness five minutes before"
+]
+WORDS = ['apple', 'river', 'candle', 'garden', 'pencil', 'window', 'forest', 'button', 'ladder', 'mirror', 'saddle', 'tunnel']
+NAMES = ['Alice', 'Bruce', 'Carmen', 'Dmitri', 'Elena', 'Farid', 'Grace', 'Hiro', 'Imani', 'Jonas']
+UAS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.3 Safari/605.1.15',
+]
+SCREENS = ['1920x1080', '1440x900', '2560x1440']
+# set n of every user starts on day 2n, each user an hour after the previous one
+BASE_TIME = datetime(2023, 3, 1, 9, 0, 0, tzinfo=timezone.utc)
+
+def task_to_experiment(task_name):
+    # same mapping as cog-to-flywheel.py
+    name_match = re.search(r'task-([^_]+)', task_name)
+    return re.sub(r'([A-Z]+)', lambda x: f'-{x.group().lower()}', name_match.group(1))
+
+def _stimulus(rng, words=3):
+    return '<div class="stim"><p>' + ' '.join(rng.choice(WORDS) for _ in range(words)) + '</p></div>'
+
+def _rt(rng):
+    return rng.randint(250, 4000)
+
+def _survey(task, rng):
+    if task == 'task-panas':
+        return {'trial_type': 'survey-likert', 'response': {item: rng.randint(0, 4) for item in PANAS_ITEMS}, 'question_order': list(range(len(PANAS_ITEMS)))}
+    if task == 'task-ffmq':
+        return {'trial_type': 'survey-likert', 'response': {q: rng.randint(0, 4) for q in FFMQ_QUESTIONS}}
+    if task == 'task-dass':
+        return {'trial_type': 'survey-multi-choice', 'response': {f'Q{i}': rng.choice(['Never', 'Sometimes', 'Often', 'Almost always']) for i in range(21)}}
+    if task == 'task-dailyStressors':
+        return {'trial_type': 'survey-multi-choice', 'response': {f'Q{i}': rng.choice(['Yes', 'No']) for i in range(8)}}
+    if task == 'task-sleepSurvey':
+        return {'trial_type': 'survey-multi-choice', 'response': {q: rng.randint(0, 3) for q in SLEEP_QUESTIONS}}
+    if task == 'task-physicalActivity':
+        return {'trial_type': 'survey-html-form', 'response': {'activity_level': str(rng.randint(1, 5)), 'weight': str(rng.randint(100, 250)), 'height_feet': str(rng.randint(4, 6)), 'height_inches': str(rng.randint(0, 11)), 'age': str(rng.randint(60, 85)), 'gender': rng.choice(['male', 'female'])}}
+    # mood prediction and mood memory
+    return {'trial_type': 'survey-percent-sum', 'preamble': '<p>How likely are you to be in each of these moods?</p>', 'response': {'Bad Mood': 20, 'Neutral Mood': 50, 'Good Mood': 30}}
+
+def _trial(task, rng, trial_index):
+    stim = _stimulus(rng)
+    if task == 'task-faceName':
+        return {'trial_type': 'html-keyboard-response', 'stimulus': stim, 'cat': rng.choice(['YA', 'OA']), 'isLearning': rng.random() < 0.5, 'isPractice': False, 'isRecall': rng.random() < 0.5, 'name': rng.choice(NAMES), 'names': rng.sample(NAMES, 2), 'picId': rng.randint(1, 200), 'lure': rng.choice(NAMES), 'response': rng.choice(['1', '2']), 'correct': rng.random() < 0.7, 'rt': _rt(rng)}
+    if task == 'task-patternSeparationLearning':
+        return {'trial_type': 'image-keyboard-response', 'stimulus': f'./img/{rng.randint(1, 400)}.jpg', 'isLearning': True, 'isPractice': False, 'pic': f'{rng.randint(1, 400)}.jpg', 'type': 'Target', 'response': rng.choice(['1', '2']), 'rt': _rt(rng)}
+    if task == 'task-patternSeparationRecall':
+        return {'trial_type': 'image-keyboard-response', 'stimulus': f'./img/{rng.randint(1, 400)}.jpg', 'isRecall': True, 'pic': f'{rng.randint(1, 400)}.jpg', 'type': rng.choice(['Target', 'Lure', 'New']), 'response': rng.choice(['1', '2', '3', '4']), 'rt': _rt(rng)}
+    if task == 'task-spatialOrientation':
+        target = rng.uniform(-math.pi, math.pi)
+        completion = rng.choices(['responded', 'timedout', 'skipped'], [0.9, 0.08, 0.02])[0]
+        response = target + rng.gauss(0, 0.6) if completion == 'responded' else None
+        signed = math.atan2(math.sin(target - response), math.cos(target - response)) if response is not None else None
+        return {'trial_type': 'spatial-orientation', 'stimulus': stim, 'mode': 'test', 'center': rng.choice(WORDS), 'facing': rng.choice(WORDS), 'target': rng.choice(WORDS), 'targetRadians': target, 'responseRadians': response, 'signedRadianDistance': signed, 'timeLimit': 300000, 'completionReason': completion, 'rt': _rt(rng)}
+    if task == 'task-mindInEyes':
+        return {'trial_type': 'html-button-response', 'isPractice': False, 'stimulus': stim, 'pic': f'{rng.randint(1, 36)}.jpg', 'words': rng.sample(WORDS, 4), 'response': rng.randint(0, 3), 'rt': _rt(rng)}
+    if task == 'task-verbalFluency':
+        return {'trial_type': 'timed-writing', 'stimulus': stim, 'letter': rng.choice('FAS'), 'response': '\n'.join(rng.sample(WORDS, 5))}
+    if task == 'task-nBack':
+        n = rng.randint(0, 2)
+        responses = [{'index': i, 'correct': rng.random() < 0.8, 'time_from_focus': _rt(rng), 'time_from_start': _rt(rng)} for i in range(rng.randint(0, 4))]
+        return {'trial_type': 'n-back', 'stimulus': stim, 'n': n, 'sequence': [rng.randint(1, 9) for _ in range(15)], 'missedIndices': [rng.randint(0, 14) for _ in range(rng.randint(0, 2))], 'responses': responses}
+    if task == 'task-taskSwitching':
+        return {'trial_type': 'html-keyboard-response', 'stimulus': stim, 'isTraining': False, 'blockType': 'mixed', 'color': rng.choice(['blue', 'orange']), 'number': rng.randint(1, 9), 'size': rng.choice(['big', 'small']), 'taskType': rng.choice(['color', 'number', 'size']), 'response': rng.choice(['ArrowLeft', 'ArrowRight']), 'correct': rng.random() < 0.85, 'rt': _rt(rng)}
+    if task == 'task-flanker':
+        return {'trial_type': 'image-keyboard-response', 'stimulus': stim, 'isTraining': False, 'arrows': [rng.randint(0, 1) for _ in range(5)], 'congruent': rng.random() < 0.5, 'response': rng.choice(['ArrowLeft', 'ArrowRight']), 'correct': rng.random() < 0.9, 'correct_response': 'arrowleft', 'rt': _rt(rng), 'trial_duration': 2000}
+    if task == 'task-emotionalMemory':
+        return {'trial_type': 'image-keyboard-response', 'stimulus': stim, 'imagePath': f'./img/{rng.randint(1, 100)}.jpg', 'response': rng.choice(['1', '2', '3']), 'rt': _rt(rng)}
+    if task == 'task-verbalLearningLearning':
+        return {'trial_type': 'audio-keyboard-response', 'stimulus': 'pre-a.mp3', 'response': ' '.join(rng.sample(WORDS, 6)), 'failed_audio': []}
+    # verbal learning recall
+    return {'trial_type': 'html-keyboard-response', 'stimulus': stim, 'response': ' '.join(rng.sample(WORDS, 6))}
+
+def _irrelevant_trial(task, rng, set_num):
+    if task in SURVEY_TASKS:
+        # survey tasks only have screens the transformers skip outside of the survey pages
+        return rng.choice([
+            {'trial_type': 'fullscreen', 'success': True},
+            {'trial_type': 'call-function', 'value': None},
+            {'trial_type': 'html-keyboard-response', 'stimulus': f'<p>You are about to start set {set_num}.</p>', 'response': ' ', 'rt': _rt(rng)},
+        ])
+    return {'trial_type': 'html-keyboard-response', 'stimulus': '<p>In this task you will see a series of images. ' + _stimulus(rng, 20) + '</p><p>Press the space bar to continue.</p>', 'response': ' ', 'rt': _rt(rng)}
+
+class SyntheticUser(object):
+    def __init__(self, rng):
+        self.human_id = ''.join(rng.choice(string.ascii_uppercase) for _ in range(7))
+        self.user_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        self.identity_id = f'us-west-2:{uuid.UUID(int=rng.getrandbits(128))}'
+
+def make_users(count, seed=0):
+    rng = random.Random(seed)
+    return [SyntheticUser(rng) for _ in range(count)]
+
+def generate_run(task, set_num, start_time, rng, trials_per_run=60, relevant_fraction=0.7):
+    """
+    Yields (date_time, isRelevant, results) tuples for one run of task, starting at start_time.
+    Survey tasks get a few pages per run regardless of trials_per_run.
+    """
+    t = start_time
+    def tick():
+        nonlocal t
+        t += timedelta(milliseconds=rng.randint(500, 5000))
+        return t
+
+    yield (t, False, {'taskStarted': True, 'setNum': set_num})
+    count = rng.randint(1, 3) if task in SURVEY_TASKS else trials_per_run
+    time_elapsed = 0
+    for trial_index in range(count):
+        relevant = rng.random() < relevant_fraction
+        if relevant:
+            results = _survey(task, rng) if task in SURVEY_TASKS else _trial(task, rng, trial_index)
+        else:
+            results = _irrelevant_trial(task, rng, set_num)
+        time_elapsed += rng.randint(500, 5000)
+        results['trial_index'] = trial_index
+        results['time_elapsed'] = time_elapsed
+        results['rt'] = results.get('rt', _rt(rng))
+        yield (tick(), relevant, results)
+    yield (tick(), False, {'ua': rng.choice(UAS), 'v': '1.4.2', 'screen': rng.choice(SCREENS)})
+
+def _iso(t):
+    return t.strftime('%Y-%m-%dT%H:%M:%S.') + f'{t.microsecond // 1000:03d}Z'
+
+def generate_task_items(task, users, sets=12, trials_per_run=60, relevant_fraction=0.7, seed=0):
+    """
+    Yields DynamoDB items (as the resource layer returns them, minus Decimals) for task, for every
+    user and set, in the order a query on identityId and begins_with(experimentDateTime, task) returns them.
+    """
+    rng = random.Random(f'{seed}-{task}')
+    for (user_idx, user) in enumerate(users):
+        for set_num in range(1, sets + 1):
+            start = _set_start(user_idx, set_num) + timedelta(minutes=rng.randint(0, 59))
+            for (_, item) in _run_items(task, user, set_num, start, rng, trials_per_run, relevant_fraction):
+                yield item
+
+def _set_start(user_idx, set_num):
+    return BASE_TIME + timedelta(days=set_num * 2, hours=user_idx % 12)
+
+def _run_items(task, user, set_num, start, rng, trials_per_run, relevant_fraction):
+    """Yields (date_time, item) tuples for one run of task by user."""
+    experiment = task_to_experiment(task)
+    for (idx, (t, relevant, results)) in enumerate(generate_run(task, set_num, start, rng, trials_per_run, relevant_fraction)):
+        yield (t, {
+            'identityId': user.identity_id,
+            'userId': user.user_id,
+            'experimentDateTime': f'{experiment}|{_iso(t)}|{idx}',
+            'isRelevant': relevant,
+            'results': results,
+        })
+
+def _wire_value(value):
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    if value is None:
+        return {'NULL': True}
+    if isinstance(value, (int, float)):
+        return {'N': str(value)}
+    if isinstance(value, str):
+        return {'S': value}
+    if isinstance(value, dict):
+        return {'M': {k: _wire_value(v) for (k, v) in value.items()}}
+    if isinstance(value, (list, tuple)):
+        return {'L': [_wire_value(v) for v in value]}
+    raise TypeError(f'Unsupported type {type(value)}')
+
+def to_wire_format(item):
+    """Encodes an item the way the low-level DynamoDB client returns it ({'S': ...}, {'N': ...}, ...)."""
+    return {k: _wire_value(v) for (k, v) in item.items()}
+
+def item_to_export_trial(item, human_id):
+    """Converts a DynamoDB item to the shape the admin download produces."""
+    (experiment, date_time, _) = item['experimentDateTime'].split('|')
+    return {**item['results'], 'dateTime': date_time, 'experiment': experiment, 'isRelevant': item['isRelevant'], 'userId': human_id}
+
+def generate_export(tasks, users, sets=12, trials_per_run=60, relevant_fraction=0.7, seed=0):
+    """
+    Yields export trials for all of the given tasks, grouped by user and in dateTime order
+    within each user (the order label_setnums requires). Only the taskStarted headers have setNums.
+    Like a real session, each set's tasks are run one after another, in the order given, with a
+    short break between them, so no two runs overlap.
+    """
+    for (user_idx, user) in enumerate(users):
+        rngs = {task: random.Random(f'{seed}-{user.human_id}-{task}') for task in tasks}
+        for set_num in range(1, sets + 1):
+            start = _set_start(user_idx, set_num)
+            for task in tasks:
+                rng = rngs[task]
+                for (t, item) in _run_items(task, user, set_num, start, rng, trials_per_run, relevant_fraction):
+                    yield item_to_export_trial(item, user.human_id)
+                start = t + timedelta(seconds=rng.randint(10, 120))
+
+def write_export(trials, f, fmt='json'):
+    """Writes export trials to the open text file f as a JSON array ('json') or one trial per line ('ndjson')."""
+    count = 0
+    if fmt == 'json':
+        f.write('[')
+    for trial in trials:
+        if fmt == 'json':
+            if count > 0: f.write(',')
+            f.write(json.dumps(trial))
+        else:
+            f.write(json.dumps(trial))
+            f.write('\n')
+        count += 1
+    if fmt == 'json':
+        f.write(']')
+    return count
+
+if __name__ == '__main__':
+    import argparse
+
+    def _parse_args():
+        parser = argparse.ArgumentParser()
+        parser.add_argument('outfile')
+        parser.add_argument('--tasks', nargs='+', choices=TASKS, default=TASKS)
+        parser.add_argument('--users', type=int, default=10)
+        parser.add_argument('--sets', type=int, default=12)
+        parser.add_argument('--trials', type=int, default=60, help='Trials per run for non-survey tasks')
+        parser.add_argument('--relevant-fraction', type=float, default=0.7, dest='relevant_fraction')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--format', choices=['json', 'ndjson'], default='json')
+        return parser.parse_args()
+
+    def _main(args):
+        users = make_users(args.users, args.seed)
+        trials = generate_export(args.tasks, users, args.sets, args.trials, args.relevant_fraction, args.seed)
+        with open(args.outfile, 'w') as f:
+            count = write_export(trials, f, args.format)
+        print(f'Wrote {count} trials to {args.outfile}.')
+
+    _main(_parse_args())
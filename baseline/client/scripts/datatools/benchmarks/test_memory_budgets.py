@@ -0,0 +1,30 @@
+# The memory budget check from check_memory_budgets.py as a pytest test, so that a component that starts
+# using more memory per trial than its budget in memory_budgets.json fails the test run. Each component
+# is measured at the scale the budgets are set at (medium), which takes a few minutes per component (about
+# 8 minutes for all of them), so the tests are skipped unless DATATOOLS_MEMORY_BUDGETS=1 is set:
+# DATATOOLS_MEMORY_BUDGETS=1 python -m pytest benchmarks/test_memory_budgets.py [-k label-setnums]
+
+import json
+import os
+
+import pytest
+
+import check_memory_budgets
+import run_benchmarks
+import synthetic_trials
+
+SCALE = 'medium'
+
+pytestmark = pytest.mark.skipif(os.environ.get('DATATOOLS_MEMORY_BUDGETS') != '1', reason='set DATATOOLS_MEMORY_BUDGETS=1 to run the memory budget checks')
+
+@pytest.fixture(scope='module')
+def budgets():
+    with open(check_memory_budgets.DEFAULT_BUDGETS) as f:
+        return json.load(f)['budgets']
+
+@pytest.mark.parametrize('component', run_benchmarks.COMPONENTS)
+def test_memory_within_budget(component, budgets):
+    (users, sets, trials) = run_benchmarks.SCALES[SCALE]
+    results = run_benchmarks.run_benchmarks([component], synthetic_trials.make_users(users), sets, trials)
+    (over, _) = check_memory_budgets.check(results, budgets)
+    assert not over, ', '.join(f'{name}: {bytes_per_trial:.0f} bytes/trial vs budget {budget}' for (name, bytes_per_trial, budget) in over)
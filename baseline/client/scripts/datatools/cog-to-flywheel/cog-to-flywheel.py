@@ -8,41 +8,99 @@
 # Usage:
 # cog-to-flywheel.py --fw-conf flywheel_config_file
 # Options:
+# --compress gzip|zstd Compress the .tsv files before uploading them
 # --force Load the data even if it already exists. Note that this option without any others will re-load all data for all subjects!
 # --fw-conf path to flywheel config file (required)
+# --no-projection Fetch whole experiment data items rather than only the attributes each task's transformer reads
+# --query-slices n Fetch each subject's data for a task with up to n queries in parallel, each for an equal span
+#                  of time between the subject's first and last trial, rather than one query paged in sequence.
+#                  This speeds up subjects with many runs of a task (e.g. nBack and faceName across 12 sets).
+# --raw-decode Fetch trial data with the low-level DynamoDB client and decode it with dynamo_decode.py, which is faster
+#              and uses less memory than the boto3 resource layer. Numbers are decoded as int/float rather than Decimal,
+#              which changes how some values print in the .tsv files (see dynamo_decode.py)
+# --plan Print the acquisitions that are missing from Flywheel, using cached inventories of Flywheel and
+#        of the task sets in DynamoDB (see sync_plan.py), without fetching or transforming any trial data.
+#        The caches are built the first time (and with --refresh-cache), which takes as long as a full check.
+#   --execute-plan Then fetch, transform and upload only the planned acquisitions
+#   --fw-inventory, --aws-summary Paths of the cache files (default fw-inventory.json and aws-summary.json)
+# --stream Instead of checking every subject, wait for participants to finish task runs and upload each run
+#          shortly afterwards, using the DynamoDB stream of the experiment data table (see stream_sync.py).
+#          Runs until it's killed.
+#   --stream-start latest|trim-horizon Where to start reading the stream (default latest; trim-horizon goes
+#                  back over the last 24 hours, e.g. after a restart)
+#   --settle-secs n How long to wait after a run's last event before uploading it (default 60)
+# --stream-feed path Like --stream, but reads the events from a local file of JSON lines, for testing
+#   --follow Keep reading the feed as it's appended to, rather than stopping at its end
+# --shard i/N Only process the subjects in shard i of N (numbered from 0), assigned by a stable hash of their human id,
+#             so that a full reload can be split across processes or hosts. Give each shard its own --warehouse
+#             file and merge them afterwards with trial_warehouse.py merge.
+# --journal path Record the subjects, tasks and files that are finished in this file (see run_journal.py)
+#   --resume Skip the work the journal records as finished, e.g. after a run was interrupted (use the same options as that run)
+#   --new-journal Start the journal afresh even though it already records finished work (otherwise the run stops, so that
+#                 the record isn't lost by leaving out --resume)
+# --scan-segments n Scan the users table in n segments in parallel, rather than in one sequential scan (default 1)
 # --task taskName1 taskName2 ... Load only data for the given task name(s)
 # --user userId Load only data for the given userId (7 character human id)
+# --warehouse path Also load the rows of every transformed task into this SQLite file, replacing the subject's
+#                  earlier rows for the task (see trial_warehouse.py)
 
 import boto3
 from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from dynamo_decode import decode_items
 import logging
 log = logging.getLogger(__name__)
+import queue
 import re
-from tsv_transformer import transformer_for_task
+import threading
+from trial_warehouse import TrialWarehouse
+from upload_tracker import UploadTracker
+from tsv_transformer import TsvTransformer, transformer_for_task
+from run_journal import RunJournal, content_hash, journal_has_records
+from key_ranges import split_key_range
+from sharding import in_shard, parse_shard
+from stream_sync import iter_feed_items, iter_stream_items, run_stream_sync
+from sync_plan import load_cache, plan_by_subject, plan_sync, print_plan, save_cache
 
 def get_fw_subject_sessions(subject):
     return list(filter(lambda s: s.label == 'pre' or s.label == 'post', subject.sessions()))
 
 def get_tasks_for_session(session):
+    return get_tasks_for_session_label(session.label)
+
+def get_tasks_for_session_label(label):
     pre_tasks = ['task-ffmq', 'task-faceName', 'task-moodPrediction', 'task-dass', 'task-mindInEyes', 'task-dailyStressors', 'task-patternSeparationRecall', 'task-flanker', 'task-emotionalMemory', 'task-panas', 'task-nBack', 'task-moodMemory', 'task-patternSeparationLearning', 'task-verbalFluency', 'task-sleepSurvey', 'task-spatialOrientation', 'task-taskSwitching', 'task-verbalLearningLearning', 'task-physicalActivity', 'task-verbalLearningRecall']
     post_tasks = pre_tasks.copy()
     post_tasks.remove('task-physicalActivity')
     
-    if session.label == "pre":
+    if label == "pre":
         return pre_tasks
-    elif session.label == "post":
+    elif label == "post":
         return post_tasks
     else:
-        raise Exception(f"Expected session to be 'pre' or 'post', but got {session.label}.")
+        raise Exception(f"Expected session to be 'pre' or 'post', but got {label}.")
 
 
 def task_to_experiment(task_name):
     name_match = re.search(r'task-([^_]+)', task_name)
     return re.sub(r'([A-Z]+)', lambda x: f'-{x.group().lower()}', name_match.group(1))
 
+# Returns the query arguments that limit experiment data items to the attributes task's transformer reads
+# (see TsvTransformer.results_fields). All of the names are substituted, since many of them (e.g. size,
+# type, name) are DynamoDB reserved words. stimulus, which is often a large block of HTML, is left out unless
+# the transformer writes it; the fetch functions get it separately for the few items _skip needs it for.
+def projection_for_task(task):
+    names = {'#edt': 'experimentDateTime', '#rel': 'isRelevant', '#res': 'results'}
+    paths = ['#edt', '#rel']
+    fields = dict.fromkeys(transformer_for_task(task, [], None).results_fields()) # de-duplicated, in order
+    for (idx, field) in enumerate(fields):
+        names[f'#f{idx}'] = field
+        paths.append(f'#res.#f{idx}')
+    return {'ProjectionExpression': ', '.join(paths), 'ExpressionAttributeNames': names}
+
 def filename_to_acq_label(fname):
-    return re.sub(r'sub-[A-z]+_ses-[A-z]+_(.*)_beh.tsv', lambda x: f'beh_{x.group(1)}', fname)
+    return re.sub(r'sub-[A-z]+_ses-[A-z]+_(.*)_beh\.tsv(\.gz|\.zst)?', lambda x: f'beh_{x.group(1)}', fname)
 
 def get_aws_user_id_for_user_id(dyn_client, user_id):
     result = ""
@@ -70,6 +128,31 @@ def get_aws_user_id_for_user_id(dyn_client, user_id):
 
     return result
 
+def get_human_id_for_aws_user_id(dyn_client, aws_user_id):
+    result = None
+    scan_args = {
+        "FilterExpression": "userId = :userId",
+        "ExpressionAttributeValues": {":userId": aws_user_id},
+        "ProjectionExpression": "humanId"
+    }
+    try:
+        done = False
+        start_key = None
+        table = dyn_client.Table("pvs-prod-users")
+        while not done:
+            if start_key:
+                scan_args['ExclusiveStartKey'] = start_key
+            response = table.scan(**scan_args)
+            start_key = response.get('LastEvaluatedKey', None)
+            items = response.get("Items", [])
+            if items:
+                result = items[0]["humanId"]
+            done = start_key is None or result is not None
+    except ClientError as err:
+        log.error("Error fetching humanId for aws userId: %s", err.response["Error"]["Message"])
+
+    return result
+
 def get_aws_identity_id_for_aws_user_id(dyn_client, aws_user_id):
     result = None
     try:
@@ -116,48 +199,261 @@ def has_aws_cog_data(dyn_client, aws_identity_id, sess_label):
 
     return result
 
-def get_aws_data(dyn_client, aws_identity_id, task):
-    key = Key("identityId").eq(aws_identity_id) & Key("experimentDateTime").begins_with(task)
-    query_args = {"KeyConditionExpression": key}
+# boto3 resources aren't thread safe, so a worker thread that needs one creates its own the first time
+# and reuses it for everything else the thread does.
+_worker_state = threading.local()
+
+def _worker_resource():
+    if getattr(_worker_state, 'dynamodb', None) is None:
+        _worker_state.dynamodb = boto3.session.Session().resource('dynamodb')
+    return _worker_state.dynamodb
+
+def _worker_table(table_name):
+    return _worker_resource().Table(table_name)
+
+# The two ways get_aws_data and get_aws_data_raw talk to the experiment data table, for _fetch_task_items.
+# query takes either an experimentDateTime prefix or a (low, high) range of experimentDateTime keys (inclusive)
+# and returns a page of decoded items and the LastEvaluatedKey to continue from (None after the last page).
+# key and batch_get_item are for the BatchGetItem requests in _add_skip_stimuli.
+class _ResourceQueries(object):
+    """Queries through a DynamoDB resource (boto3.resource('dynamodb')), which decodes the items itself."""
+    def __init__(self, dynamodb):
+        self.dynamodb = dynamodb
+
+    def for_worker_thread(self):
+        return _ResourceQueries(_worker_resource())
+
+    def query(self, aws_identity_id, key, **args):
+        experiment_date_time = Key("experimentDateTime").between(*key) if isinstance(key, tuple) else Key("experimentDateTime").begins_with(key)
+        response = self.dynamodb.Table("pvs-prod-experiment-data").query(KeyConditionExpression=Key("identityId").eq(aws_identity_id) & experiment_date_time, **args)
+        return (response.get("Items", []), response.get('LastEvaluatedKey', None))
+
+    def key(self, aws_identity_id, experiment_date_time):
+        return {'identityId': aws_identity_id, 'experimentDateTime': experiment_date_time}
+
+    def batch_get_item(self, request):
+        response = self.dynamodb.batch_get_item(RequestItems=request)
+        return (response['Responses'].get("pvs-prod-experiment-data", []), response.get('UnprocessedKeys'))
+
+class _RawQueries(object):
+    """
+    Queries through a low-level client (boto3.client('dynamodb')), decoding the wire-format items with
+    dynamo_decode and leaving out the attributes in skip.
+    """
+    def __init__(self, client, skip):
+        self.client = client
+        self.skip = skip
+
+    def for_worker_thread(self):
+        return self # low-level clients are thread safe
+
+    def query(self, aws_identity_id, key, **args):
+        if isinstance(key, tuple):
+            condition = "identityId = :id AND experimentDateTime BETWEEN :low AND :high"
+            values = {":id": {"S": aws_identity_id}, ":low": {"S": key[0]}, ":high": {"S": key[1]}}
+        else:
+            condition = "identityId = :id AND begins_with(experimentDateTime, :exp)"
+            values = {":id": {"S": aws_identity_id}, ":exp": {"S": key}}
+        response = self.client.query(TableName="pvs-prod-experiment-data", KeyConditionExpression=condition, ExpressionAttributeValues=values, **args)
+        return (decode_items(response.get("Items", []), self.skip), response.get('LastEvaluatedKey', None))
+
+    def key(self, aws_identity_id, experiment_date_time):
+        return {'identityId': {'S': aws_identity_id}, 'experimentDateTime': {'S': experiment_date_time}}
+
+    def batch_get_item(self, request):
+        response = self.client.batch_get_item(RequestItems=request)
+        return (decode_items(response['Responses'].get("pvs-prod-experiment-data", []), self.skip), response.get('UnprocessedKeys'))
+
+# When projection (from projection_for_task) leaves out stimulus, fetches it for just the items that
+# TsvTransformer._skip needs it for (see may_skip_by_stimulus) and adds it to them, 100 items per
+# BatchGetItem request.
+def _add_skip_stimuli(queries, aws_identity_id, items, projection):
+    if projection is None or 'stimulus' in projection['ExpressionAttributeNames'].values():
+        return
+    keys = [queries.key(aws_identity_id, item['experimentDateTime']) for item in items if TsvTransformer.may_skip_by_stimulus(item)]
+    stimuli = {}
+    for start in range(0, len(keys), 100):
+        request = {"pvs-prod-experiment-data": {
+            "Keys": keys[start:start + 100],
+            "ProjectionExpression": "#edt, #res.#stim",
+            "ExpressionAttributeNames": {'#edt': 'experimentDateTime', '#res': 'results', '#stim': 'stimulus'}
+        }}
+        while request:
+            (found, request) = queries.batch_get_item(request)
+            for item in found:
+                if 'stimulus' in item.get('results', {}):
+                    stimuli[item['experimentDateTime']] = item['results']['stimulus']
+    for item in items:
+        if item['experimentDateTime'] in stimuli:
+            item['results']['stimulus'] = stimuli[item['experimentDateTime']]
+
+# Returns every item for key (see _ResourceQueries.query), following LastEvaluatedKey from page to page.
+def _query_all(queries, aws_identity_id, key, projection):
+    query_args = dict(projection or {})
     result = []
+    while True:
+        (items, start_key) = queries.query(aws_identity_id, key, **query_args)
+        result.extend(items)
+        if start_key is None:
+            return result
+        query_args["ExclusiveStartKey"] = start_key
+
+# The threads for _fetch_task_items's range queries are kept for the whole run, so that the resource each
+# one creates (see _worker_resource) is reused for every subject and task rather than created per query.
+_range_query_pools = {} # number of threads -> ThreadPoolExecutor
+
+def _range_query_pool(workers):
+    if workers not in _range_query_pools:
+        _range_query_pools[workers] = ThreadPoolExecutor(max_workers=workers)
+    return _range_query_pools[workers]
+
+# Fetches task's items for get_aws_data and get_aws_data_raw through queries (a _ResourceQueries or _RawQueries).
+# With slices > 1, the items are fetched with up to that many queries in parallel, one per range of
+# experimentDateTime (see split_key_range), which is faster for identities with many runs of a task.
+# Finding the first and last keys to split takes two single-item queries.
+# Returns [] (after logging the error) if any query fails, rather than part of the task's items.
+def _fetch_task_items(queries, aws_identity_id, task, projection, slices):
     try:
-        done = False
-        start_key = False
-        table = dyn_client.Table("pvs-prod-experiment-data")
-        while not done:
-            if start_key:
-                query_args["ExclusiveStartKey"] = start_key
-            response = table.query(**query_args)
-            start_key = response.get('LastEvaluatedKey', None)
-            done = start_key is None
-            result.extend(response.get("Items", []))
+        if slices > 1:
+            (first, last) = [queries.query(aws_identity_id, task, ProjectionExpression="experimentDateTime", Limit=1, ScanIndexForward=forward)[0] for forward in (True, False)]
+            if not first:
+                return []
+            key_ranges = split_key_range(first[0]['experimentDateTime'], last[0]['experimentDateTime'], slices)
+            # the ranges are in key order, so concatenating them keeps the items in key order
+            query_range = lambda key_range: _query_all(queries.for_worker_thread(), aws_identity_id, key_range, projection)
+            result = [item for items in _range_query_pool(slices).map(query_range, key_ranges) for item in items]
+        else:
+            result = _query_all(queries, aws_identity_id, task, projection)
+        _add_skip_stimuli(queries, aws_identity_id, result, projection)
+        return result
     except ClientError as err:
         log.error(f"Error fetching data for {aws_identity_id}/{task}: %s", err.response["Error"]["Message"])
+        return []
 
-    return result
+# projection, if given, is from projection_for_task. See _fetch_task_items for slices.
+def get_aws_data(dyn_client, aws_identity_id, task, projection=None, slices=1):
+    return _fetch_task_items(_ResourceQueries(dyn_client), aws_identity_id, task, projection, slices)
 
-def get_aws_subjects(dyn_client, human_id=None):
-    result = []
+# Attributes of experiment data items that no transformer reads; get_aws_data_raw doesn't decode them.
+UNUSED_ATTRIBUTES = ['identityId', 'userId']
+
+# Like get_aws_data, but takes a low-level client (boto3.client('dynamodb')) and decodes the wire-format
+# items itself (see dynamo_decode.py), leaving out the attributes in skip.
+def get_aws_data_raw(raw_client, aws_identity_id, task, skip=UNUSED_ATTRIBUTES, projection=None, slices=1):
+    return _fetch_task_items(_RawQueries(raw_client, skip), aws_identity_id, task, projection, slices)
+
+DEFAULT_SCAN_SEGMENTS = 1
+
+def get_aws_subjects(dyn_client, human_id=None, segments=1):
+    return list(iter_aws_subjects(dyn_client, human_id, segments))
+
+# Scans one segment of a parallel scan, putting each page of items on out_queue and None when it's done.
+def _scan_segment(table_name, scan_args, segment, total_segments, out_queue):
+    try:
+        table = _worker_table(table_name)
+        args = dict(scan_args, Segment=segment, TotalSegments=total_segments)
+        while True:
+            response = table.scan(**args)
+            out_queue.put(response.get("Items", []))
+            start_key = response.get('LastEvaluatedKey', None)
+            if start_key is None:
+                break
+            args['ExclusiveStartKey'] = start_key
+    finally:
+        out_queue.put(None)
+
+# Yields the users in pvs-prod-users as soon as they're scanned. With segments > 1 the table is
+# scanned with a DynamoDB parallel scan, one thread per segment, and users are yielded in
+# whatever order the pages arrive.
+def iter_aws_subjects(dyn_client, human_id=None, segments=1):
     scan_args = {"ProjectionExpression": "userId, humanId"}
     if human_id:
         scan_args["FilterExpression"] = "humanId = :humId"
         scan_args["ExpressionAttributeValues"] = {":humId": human_id}
+
+    if segments <= 1:
+        try:
+            done = False
+            start_key = None
+            table = dyn_client.Table("pvs-prod-users")
+            while not done:
+                if start_key:
+                    scan_args['ExclusiveStartKey'] = start_key
+                response = table.scan(**scan_args)
+                start_key = response.get('LastEvaluatedKey', None)
+                done = start_key is None
+                yield from response.get("Items", [])
+        except ClientError as err:
+            log.error("Error fetching aws subjects: %s", err.response["Error"]["Message"])
+        return
+
+    pages = queue.Queue()
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [executor.submit(_scan_segment, "pvs-prod-users", scan_args, segment, segments, pages) for segment in range(segments)]
+        running = segments
+        while running:
+            items = pages.get()
+            if items is None:
+                running -= 1
+            else:
+                yield from items
+    for future in futures:
+        err = future.exception()
+        if isinstance(err, ClientError):
+            log.error("Error fetching aws subjects: %s", err.response["Error"]["Message"])
+        elif err:
+            raise err
+
+# Returns {experiment: [setNum, ...]} with the setNum of every set header (taskStarted) trial for the identity,
+# in experimentDateTime order. Only the keys and setNums are transferred, not the trial data.
+def get_aws_task_sets(dyn_client, aws_identity_id):
+    query_args = {
+        "KeyConditionExpression": Key('identityId').eq(aws_identity_id),
+        "FilterExpression": "attribute_exists(results.taskStarted) and attribute_exists(results.setNum)",
+        "ProjectionExpression": "experimentDateTime, results.setNum",
+    }
+    result = {}
     try:
         done = False
         start_key = None
-        table = dyn_client.Table("pvs-prod-users")
+        table = dyn_client.Table("pvs-prod-experiment-data")
         while not done:
             if start_key:
-                scan_args['ExclusiveStartKey'] = start_key
-            response = table.scan(**scan_args)
-            start_key = response.get('LastEvaluatedKey', None)
+                query_args['ExclusiveStartKey'] = start_key
+            resp = table.query(**query_args)
+            start_key = resp.get('LastEvaluatedKey', None)
             done = start_key is None
-            result.extend(response.get("Items", []))
+            for item in resp.get("Items", []):
+                experiment = item['experimentDateTime'].split('|')[0]
+                result.setdefault(experiment, []).append(int(item['results']['setNum']))
     except ClientError as err:
-        log.error("Error fetching aws subjects: %s", err.response["Error"]["Message"])
+        log.error("Error fetching task sets for aws identityId %s: %s", aws_identity_id, err.response["Error"]["Message"])
 
     return result
 
+# Builds the AWS summary used by sync_plan for the given subjects (as returned by get_aws_subjects)
+def build_aws_summary(dyn_client, subjects):
+    all_tasks = get_tasks_for_session_label("pre")
+    summary = {}
+    for subj in subjects:
+        identity_id = get_aws_identity_id_for_aws_user_id(dyn_client, subj['userId'])
+        task_sets = {}
+        if identity_id:
+            sets_by_experiment = get_aws_task_sets(dyn_client, identity_id)
+            for task in all_tasks:
+                set_nums = sets_by_experiment.get(task_to_experiment(task))
+                if set_nums:
+                    task_sets[task] = set_nums
+        summary[subj['humanId']] = {'userId': subj['userId'], 'identityId': identity_id, 'task_sets': task_sets}
+    return summary
+
+# Builds the Flywheel inventory used by sync_plan: {subject label: {session label: {acquisition label: file count}}}
+def build_fw_inventory(fw_project):
+    inventory = {}
+    for subj in fw_project.subjects():
+        inventory[subj.label] = {sess.label: {acq.label: len(acq.files) for acq in sess.acquisitions()} for sess in get_fw_subject_sessions(subj)}
+    return inventory
+
 def has_missing_fw_session(fw_session_labels, aws_sessions_with_cog_data):
     for s in aws_sessions_with_cog_data:
         if not s in fw_session_labels:
@@ -166,20 +462,32 @@ def has_missing_fw_session(fw_session_labels, aws_sessions_with_cog_data):
     return False
 
 # no_upload (used for dry runs) trumps force_upload
-def upload_task_data_for_subject(dyn_client, fw_subj, aws_subj, tasks, force_upload, no_upload=False):
+# Returns the paths of any files that failed to upload (after retries; see upload_tracker.py).
+# compression may be None, 'gzip' or 'zstd'
+# plan, if given, is this subject's part of a sync plan ({session label: {task: set of acquisition labels}},
+# see sync_plan.plan_by_subject); only those tasks are fetched and only those acquisitions are uploaded.
+# raw_client, if given, is a low-level DynamoDB client to fetch the trial data with (see get_aws_data_raw).
+# With project, only the attributes each task's transformer reads are fetched (see projection_for_task).
+# warehouse, if given, is a TrialWarehouse to load the transformed rows into.
+# journal, if given, is a RunJournal: tasks and files it records as done are skipped, and finished work is recorded in it.
+def upload_task_data_for_subject(dyn_client, fw_subj, aws_subj, tasks, force_upload, no_upload=False, compression=None, plan=None, raw_client=None, project=True, warehouse=None, journal=None, query_slices=1):
     aws_identity_id = aws_subj['identityId']
     if not aws_identity_id:
         print(f'No cognitive baseline data found for {aws_subj["humanId"]}.')
-        return
+        return []
     
     data_files_for_task = {}
+    uploader = UploadTracker(no_upload)
     
     sessions = get_fw_subject_sessions(fw_subj)
+    if plan is not None:
+        # the plan has already checked for missing sessions
+        sessions = [s for s in sessions if s.label in plan]
     fw_sess_labels = list(map(lambda x: x.label, sessions))
     aws_sess_with_cog_data = []
-    if has_aws_cog_data(dyn_client, aws_identity_id, "pre"):
+    if plan is None and has_aws_cog_data(dyn_client, aws_identity_id, "pre"):
         aws_sess_with_cog_data.append("pre")
-    if has_aws_cog_data(dyn_client, aws_identity_id, "post"):
+    if plan is None and has_aws_cog_data(dyn_client, aws_identity_id, "post"):
         aws_sess_with_cog_data.append("post")
 
     if has_missing_fw_session(fw_sess_labels, aws_sess_with_cog_data):
@@ -193,41 +501,107 @@ def upload_task_data_for_subject(dyn_client, fw_subj, aws_subj, tasks, force_upl
                 if (acq.label == acq_label): return acq
             return None
             
-        if tasks:
+        if plan is not None:
+            tasks_to_fetch = list(plan[sess.label].keys())
+        elif tasks:
             tasks_to_fetch = tasks
         else:
             tasks_to_fetch = get_tasks_for_session(sess)
             
+        done_files = {} # task -> [(path, sha256)] of the session's files that are done once the uploads succeed
         for task in tasks_to_fetch:
+            if journal and journal.task_done(fw_subj.label, sess.label, task):
+                print(f'Skipping {fw_subj.label}/{sess.label}/{task} (already done according to the journal)...')
+                continue
             print(f'Processing {fw_subj.label}/{sess.label}/{task}...')
+            done_files[task] = []
             if not task in data_files_for_task.keys(): # we might have already fetched all of the data when doing the pre session
-                task_data = get_aws_data(dyn_client, aws_identity_id, task_to_experiment(task))
+                projection = projection_for_task(task) if project else None
+                if raw_client is not None:
+                    task_data = get_aws_data_raw(raw_client, aws_identity_id, task_to_experiment(task), projection=projection, slices=query_slices)
+                else:
+                    task_data = get_aws_data(dyn_client, aws_identity_id, task_to_experiment(task), projection, query_slices)
                 transformer = transformer_for_task(task, task_data, fw_subj.label)
+                transformer.compression = compression
+                transformer.warehouse = warehouse
                 files_written = transformer.process()
                 data_files_for_task[task] = files_written
             
             session_task_files = list(filter(lambda x: f'ses-{sess.label}' in x, data_files_for_task[task]))
             for f in session_task_files:
                 acq_label = filename_to_acq_label(f)
+                if plan is not None and acq_label not in plan[sess.label][task]:
+                    continue
                 acq = find_acq(acq_label)
-                needs_upload = False
+                needs_upload = plan is not None
                 if not acq:
                     acq = sess.add_acquisition({'label': acq_label})
                     acq.reload()
                     needs_upload = True
                 if len(acq.files) == 0: # at some point we somehow created acquisitions and didn't upload the files
                     needs_upload = True
-            
-                if needs_upload or force_upload:
-                    if no_upload:
-                        print(f'Would upload {f} to {acq.label} (skipping; dry run)...')
-                    else:
-                        print(f'Uploading {f} to {acq.label}...')
-                        acq.upload_file(f)
 
+                sha256 = content_hash(f) if journal else None
+                if journal and journal.file_done(fw_subj.label, sess.label, task, f, sha256):
+                    print(f'Skipping {f} (already uploaded according to the journal)...')
+                elif needs_upload or force_upload:
+                    uploader.upload(acq, f)
+                done_files[task].append((f, sha256))
+
+        failed = uploader.failed()
+        if journal:
+            for (task, files) in done_files.items():
+                for (f, sha256) in dict(files).items():
+                    if f not in failed:
+                        journal.record_file(fw_subj.label, sess.label, task, f, sha256)
+                if not any(f in failed for (f, _) in files):
+                    journal.record_task(fw_subj.label, sess.label, task)
         if len(tasks_to_fetch) == 0:
             print(f'No missing tasks found for {fw_subj.label}/{sess.label}.')
 
+    if not no_upload:
+        print(f'{fw_subj.label}: {uploader.summary()}')
+    if journal and not uploader.failed():
+        journal.record_subject(fw_subj.label)
+    return uploader.failed()
+
+
+# Uploads the file for a single run (a stream_sync.CompletedRun) of task. The whole task is fetched and
+# transformed, since run numbers depend on the runs before it, but only the run's own file is uploaded.
+def upload_completed_run(dyn_client, fw_subj, run, task, no_upload=False, compression=None, raw_client=None, project=True, warehouse=None, query_slices=1):
+    projection = projection_for_task(task) if project else None
+    if raw_client is not None:
+        task_data = get_aws_data_raw(raw_client, run.identity_id, run.experiment, projection=projection, slices=query_slices)
+    else:
+        task_data = get_aws_data(dyn_client, run.identity_id, run.experiment, projection, query_slices)
+    transformer = transformer_for_task(task, task_data, fw_subj.label)
+    transformer.compression = compression
+    transformer.warehouse = warehouse
+    files_written = transformer.process()
+    run_idx = transformer.run_index_at(run.end)
+    if run_idx is None:
+        log.error("No start of the run of %s that ended at %s found for %s.", task, run.end, fw_subj.label)
+        return []
+
+    f = files_written[run_idx]
+    sess_label = transformer.runs[run_idx].get_session()
+    sessions = [s for s in get_fw_subject_sessions(fw_subj) if s.label == sess_label]
+    if not sessions:
+        log.error("Subject %s has a completed %s run without a corresponding flywheel session %s.", fw_subj.label, task, sess_label)
+        return []
+    acq_label = filename_to_acq_label(f)
+    acq = next((a for a in sessions[0].acquisitions() if a.label == acq_label), None)
+    if not acq:
+        acq = sessions[0].add_acquisition({'label': acq_label})
+        acq.reload()
+
+    print(f'Processing {fw_subj.label}/{sess_label}/{task} run ending at {run.end.split("|")[1]}...')
+    uploader = UploadTracker(no_upload)
+    uploader.upload(acq, f)
+    if not no_upload:
+        print(f'{fw_subj.label}: {uploader.summary()}')
+    return uploader.failed()
+
 
 if __name__ == '__main__':
     import argparse
@@ -236,31 +610,167 @@ if __name__ == '__main__':
 
     def _parse_args():
         parser = argparse.ArgumentParser()
+        parser.add_argument('--compress', help='Compress the .tsv files with the given algorithm before uploading them', choices=['gzip', 'zstd'])
         parser.add_argument('--dry-run', help="Do not upload any data to flywheel; just log what data would be uploaded", dest='dry_run', action='store_true')
         parser.add_argument('--force', help='Load data even for tasks that already exist in flywheel', action='store_true')
         parser.add_argument('--fw-conf', help='Path to your Flywheel config file that contains your API key', dest='fw_conf', required=True)
         parser.add_argument('--task', help='Names of one or more tasks to load, separated by commas. Implies --force.', nargs='*')
         parser.add_argument('--user')
+        parser.add_argument('--shard', help='Only process the subjects in shard i of N, e.g. "0/4" (shards are numbered from 0)', type=parse_shard)
+        parser.add_argument('--scan-segments', help=f'Scan the users table in this many segments in parallel (default {DEFAULT_SCAN_SEGMENTS}, a sequential scan)', dest='scan_segments', type=int, default=DEFAULT_SCAN_SEGMENTS)
+        parser.add_argument('--query-slices', help='Fetch each task with up to this many queries in parallel, each for a range of dates (default 1)', dest='query_slices', type=int, default=1)
+        parser.add_argument('--no-projection', help='Fetch whole experiment data items rather than only the attributes each task uses', dest='project', action='store_false')
+        parser.add_argument('--raw-decode', help='Fetch trial data with the low-level DynamoDB client and a faster decoder. Numbers become int/float rather than Decimal, so numbers inside lists and maps print without Decimal(...) and exponents print as floats do (1e-07, not 1E-7)', dest='raw_decode', action='store_true')
+        parser.add_argument('--journal', help='Record finished subjects, tasks and files in this file, so that an interrupted run can be resumed')
+        parser.add_argument('--resume', help='Skip the work recorded as finished in the --journal file', action='store_true')
+        parser.add_argument('--new-journal', help='Start the --journal file afresh even if it already records finished work', dest='new_journal', action='store_true')
+        parser.add_argument('--warehouse', help='Also load the transformed rows into this SQLite file (see trial_warehouse.py)')
+        parser.add_argument('--plan', help='Print the acquisitions missing from Flywheel using cached inventories, without fetching any trial data', action='store_true')
+        parser.add_argument('--execute-plan', help='With --plan, fetch, transform and upload only the planned acquisitions', dest='execute_plan', action='store_true')
+        parser.add_argument('--fw-inventory', help='Cache file for the Flywheel inventory used by --plan', dest='fw_inventory', default='fw-inventory.json')
+        parser.add_argument('--aws-summary', help='Cache file for the summary of task sets in DynamoDB used by --plan', dest='aws_summary', default='aws-summary.json')
+        parser.add_argument('--stream', help='Upload each task run shortly after it is completed, using the DynamoDB stream of the experiment data table', action='store_true')
+        parser.add_argument('--stream-feed', help='Like --stream, but read the events from this file of JSON lines', dest='stream_feed')
+        parser.add_argument('--follow', help='With --stream-feed, keep reading the feed as it is appended to', action='store_true')
+        parser.add_argument('--stream-start', help='Where to start reading the stream (default latest)', dest='stream_start', choices=['latest', 'trim-horizon'], default='latest')
+        parser.add_argument('--settle-secs', help='With --stream, how long to wait after the last event for a run before uploading it (default 60)', dest='settle_secs', type=float, default=60)
+        parser.add_argument('--refresh-cache', help='Rebuild the --plan cache files even if they exist', dest='refresh_cache', action='store_true')
         args = parser.parse_args()
+        if args.execute_plan and not args.plan:
+            parser.error('--execute-plan requires --plan')
+        if args.resume and not args.journal:
+            parser.error('--resume requires --journal')
+        if args.new_journal and not args.journal:
+            parser.error('--new-journal requires --journal')
+        if args.resume and args.new_journal:
+            parser.error('--resume and --new-journal cannot be used together')
+        if args.journal and not (args.resume or args.new_journal) and journal_has_records(args.journal):
+            parser.error(f'{args.journal} already records finished work. Use --resume to continue from it or --new-journal to start it afresh')
+        if args.journal and args.dry_run:
+            parser.error('--journal cannot be used with --dry-run, since nothing is uploaded')
+        if (args.stream or args.stream_feed) and (args.plan or args.journal):
+            parser.error('--stream and --stream-feed cannot be used with --plan or --journal')
+        if args.query_slices < 1:
+            parser.error('--query-slices must be at least 1')
+        if args.follow and not args.stream_feed:
+            parser.error('--follow requires --stream-feed')
         return args
+
+    def _run_plan(args, fw, dyn_client, raw_client, warehouse, journal, project_path):
+        fw_inventory = None if args.refresh_cache else load_cache(args.fw_inventory)
+        if fw_inventory is None:
+            print(f'Building Flywheel inventory ({args.fw_inventory})...')
+            fw_inventory = build_fw_inventory(fw.lookup(project_path))
+            save_cache(args.fw_inventory, fw_inventory)
+        aws_summary = None if args.refresh_cache else load_cache(args.aws_summary)
+        if aws_summary is None:
+            # always summarize every subject so the cache can be reused without --user
+            print(f'Building AWS task set summary ({args.aws_summary})...')
+            aws_summary = build_aws_summary(dyn_client, iter_aws_subjects(dyn_client, segments=args.scan_segments))
+            save_cache(args.aws_summary, aws_summary)
+
+        (plan, problems) = plan_sync(fw_inventory, aws_summary, get_tasks_for_session_label, args.task, args.force, args.user)
+        if args.shard:
+            plan = [item for item in plan if in_shard(item.human_id, args.shard)]
+        print_plan(plan, problems)
+        if not args.execute_plan:
+            return
+
+        failed = []
+        for (human_id, subj_plan) in plan_by_subject(plan).items():
+            if journal and journal.subject_done(human_id):
+                print(f'Skipping {human_id} (already done according to the journal).')
+                continue
+            aws_subj = dict(aws_summary[human_id], humanId=human_id)
+            fw_subj = fw.lookup(project_path + '/' + human_id)
+            failed.extend(upload_task_data_for_subject(dyn_client, fw_subj, aws_subj, None, False, args.dry_run, args.compress, subj_plan, raw_client, args.project, warehouse, journal, args.query_slices))
+        _report_failed(failed)
+        if plan and not args.dry_run:
+            print(f'Run with --refresh-cache to update {args.fw_inventory} before planning again.')
     
+    def _report_failed(failed):
+        if failed:
+            log.error('%d files could not be uploaded: %s', len(failed), ', '.join(failed))
+
+    def _sync(args, fw, dyn_client, raw_client, warehouse, journal, project_path):
+        # subjects are processed as they're scanned, rather than after the whole users table has been read
+        subjects = iter_aws_subjects(dyn_client, args.user, args.scan_segments)
+        failed = []
+        for subj in subjects:
+            if args.shard and not in_shard(subj['humanId'], args.shard):
+                continue
+            if journal and journal.subject_done(subj['humanId']):
+                print(f'Skipping {subj["humanId"]} (already done according to the journal).')
+                continue
+            aws_subj = {'humanId': subj['humanId'], 'userId': subj['userId'], 'identityId': get_aws_identity_id_for_aws_user_id(dyn_client, subj['userId'])}
+            if aws_subj['identityId']:
+                fw_subj = fw.lookup(project_path + '/' + aws_subj['humanId'])
+                failed.extend(upload_task_data_for_subject(dyn_client, fw_subj, aws_subj, args.task, args.force, args.dry_run, args.compress, raw_client=raw_client, project=args.project, warehouse=warehouse, journal=journal, query_slices=args.query_slices))
+            else:
+                print(f'No cognitive data found for {aws_subj["humanId"]}.')
+        _report_failed(failed)
+
+    def _stream(args, fw, dyn_client, raw_client, warehouse, project_path):
+        experiment_tasks = {task_to_experiment(task): task for task in get_tasks_for_session_label('pre')}
+        human_ids = {} # aws userId -> humanId
+        failed = []
+
+        def on_run(run):
+            task = experiment_tasks.get(run.experiment)
+            if task is None or (args.task and task not in args.task):
+                return
+            if run.user_id not in human_ids:
+                human_ids[run.user_id] = get_human_id_for_aws_user_id(dyn_client, run.user_id)
+            human_id = human_ids[run.user_id]
+            if not human_id:
+                log.error("No humanId found for aws userId %s (identityId %s).", run.user_id, run.identity_id)
+                return
+            if (args.user and human_id != args.user) or (args.shard and not in_shard(human_id, args.shard)):
+                return
+            # keep going after errors, since this runs unattended
+            try:
+                fw_subj = fw.lookup(project_path + '/' + human_id)
+                failed.extend(upload_completed_run(dyn_client, fw_subj, run, task, args.dry_run, args.compress, raw_client, args.project, warehouse, args.query_slices))
+            except Exception:
+                log.exception("Error uploading the %s run of %s that ended at %s.", task, human_id, run.end)
+
+        if args.stream_feed:
+            items = iter_feed_items(args.stream_feed, args.follow)
+        else:
+            table = boto3.client('dynamodb').describe_table(TableName='pvs-prod-experiment-data')['Table']
+            if not table.get('LatestStreamArn'):
+                raise Exception('The pvs-prod-experiment-data table has no stream enabled.')
+            items = iter_stream_items(boto3.client('dynamodbstreams'), table['LatestStreamArn'], args.stream_start.upper().replace('-', '_'))
+        print('Waiting for completed runs...')
+        try:
+            count = run_stream_sync(items, on_run, args.settle_secs)
+            print(f'{count} completed runs found.')
+        finally:
+            _report_failed(failed)
+
     def _main(args):
         with open(args.fw_conf) as f:
             fw_conf = json.load(f)
         
         fw = flywheel.Client(fw_conf['key'])
         dyn_client = boto3.resource('dynamodb')
+        raw_client = boto3.client('dynamodb') if args.raw_decode else None
+        warehouse = TrialWarehouse(args.warehouse) if args.warehouse else None
+        journal = RunJournal(args.journal, args.resume, args.new_journal) if args.journal else None
         group_name = 'emocog'
         proj_name = '2023_HeartBEAM'
-        subjects = get_aws_subjects(dyn_client, args.user)
-        identityIds = list(map(lambda subj: get_aws_identity_id_for_aws_user_id(dyn_client, subj['userId']), subjects))
-        subjects = [{'humanId': subj['humanId'], 'userId': subj['userId'], 'identityId': identId} for subj, identId in zip(subjects, identityIds)]
-        for aws_subj in subjects:
-            if aws_subj['identityId']:
-                fw_subj = fw.lookup(group_name + '/' + proj_name + '/' + aws_subj['humanId'])
-                upload_task_data_for_subject(dyn_client, fw_subj, aws_subj, args.task, args.force, args.dry_run)
+        try:
+            if args.stream or args.stream_feed:
+                _stream(args, fw, dyn_client, raw_client, warehouse, group_name + '/' + proj_name)
+            elif args.plan:
+                _run_plan(args, fw, dyn_client, raw_client, warehouse, journal, group_name + '/' + proj_name)
             else:
-                print(f'No cognitive data found for {aws_subj["humanId"]}.')
+                _sync(args, fw, dyn_client, raw_client, warehouse, journal, group_name + '/' + proj_name)
+        finally:
+            if warehouse:
+                warehouse.close()
+            if journal:
+                journal.close()
         
     _main(_parse_args())
     
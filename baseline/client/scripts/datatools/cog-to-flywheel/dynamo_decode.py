@@ -0,0 +1,78 @@
+# Decodes items in DynamoDB's wire format (as returned by the low-level boto3 client) into plain Python values.
+#
+# The boto3 resource layer runs every attribute through the generic TypeDeserializer, which turns every
+# number into a Decimal and every string set into a set. The decoder here is specialized for our items:
+# numbers become int or float directly (they all come from JavaScript, so a double never loses anything),
+# and attributes that nothing reads can be skipped without being decoded at all.
+#
+# So the .tsv files from the two paths aren't always byte-identical: a value that holds numbers, such as a
+# list (NBack's sequence) or a map (survey responses), prints as [3] or {'x': 3} rather than [Decimal('3')]
+# or {'x': Decimal('3')}, and a number in exponent form prints as a float does (1e-07 rather than 1E-7).
+#
+# Skipped attributes are given as dotted paths, e.g. {'identityId', 'results.stimulus'}.
+
+def _number(value):
+    if '.' in value or 'e' in value or 'E' in value:
+        return float(value)
+    return int(value)
+
+def _decode_value(value, skip_tree):
+    (kind, inner) = next(iter(value.items()))
+    if kind == 'S':
+        return inner
+    if kind == 'N':
+        return _number(inner)
+    if kind == 'BOOL':
+        return inner
+    if kind == 'NULL':
+        return None
+    if kind == 'M':
+        return _decode_map(inner, skip_tree)
+    if kind == 'L':
+        return [_decode_value(v, None) for v in inner]
+    if kind == 'SS':
+        return set(inner)
+    if kind == 'NS':
+        return set(_number(v) for v in inner)
+    if kind == 'B':
+        return inner
+    if kind == 'BS':
+        return set(inner)
+    raise ValueError(f'Unknown DynamoDB type {kind}')
+
+def _decode_map(attrs, skip_tree):
+    if not skip_tree:
+        return {name: _decode_value(value, None) for (name, value) in attrs.items()}
+    result = {}
+    for (name, value) in attrs.items():
+        sub_tree = skip_tree.get(name)
+        if sub_tree is True:
+            continue
+        result[name] = _decode_value(value, sub_tree)
+    return result
+
+def skip_tree_for(paths):
+    """Turns dotted attribute paths into the nested dict the decoder uses ({name: True} for a skipped leaf)."""
+    tree = {}
+    for path in paths or []:
+        node = tree
+        parts = path.split('.')
+        for part in parts[:-1]:
+            child = node.setdefault(part, {})
+            if child is True:
+                break
+            node = child
+        else:
+            node[parts[-1]] = True
+    return tree
+
+def decode_item(item, skip_tree=None):
+    """
+    Decodes one wire-format item. skip_tree (from skip_tree_for) names attributes to leave out.
+    """
+    return _decode_map(item, skip_tree)
+
+def decode_items(items, skip=None):
+    """Decodes a list of wire-format items, leaving out the attributes in skip (dotted paths)."""
+    skip_tree = skip_tree_for(skip)
+    return [_decode_map(item, skip_tree) for item in items]
@@ -0,0 +1,27 @@
+# Splits a query's experimentDateTime key range into smaller ranges that can be queried in parallel
+# (cog-to-flywheel.py --query-slices). Kept apart from cog-to-flywheel.py, which needs boto3, so that it can
+# be tested on its own (test_key_ranges.py).
+
+from datetime import datetime
+
+# Splits the experimentDateTime keys from first_key to last_key (inclusive) into up to `slices` ranges that
+# span equal amounts of time, returned as [(low, high)] bounds for BETWEEN conditions, in key order.
+# Keys are experiment|dateTime|index, so an inner bound of experiment|dateTime sorts before every key with
+# that dateTime and can't be a key itself: no item falls into two ranges. Keys that don't look like that
+# give a single range.
+def split_key_range(first_key, last_key, slices):
+    try:
+        (experiment, first_time, _) = first_key.split('|')
+        last_time = last_key.split('|')[1]
+        start = datetime.strptime(first_time, '%Y-%m-%dT%H:%M:%S.%fZ')
+        step = (datetime.strptime(last_time, '%Y-%m-%dT%H:%M:%S.%fZ') - start) / slices
+    except ValueError:
+        return [(first_key, last_key)]
+    bounds = [first_key]
+    for idx in range(1, slices):
+        t = start + step * idx
+        bound = f'{experiment}|' + t.strftime('%Y-%m-%dT%H:%M:%S.') + f'{t.microsecond // 1000:03d}Z'
+        if bounds[-1] < bound < last_key:
+            bounds.append(bound)
+    bounds.append(last_key)
+    return list(zip(bounds[:-1], bounds[1:]))
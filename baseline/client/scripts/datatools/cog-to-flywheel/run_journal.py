@@ -0,0 +1,88 @@
+# A persistent journal of the work a cog-to-flywheel run has finished, so that a run that crashes or is killed
+# can be resumed (cog-to-flywheel.py --journal path --resume) without repeating it.
+#
+# The journal is a file of JSON lines, appended to (and synced to disk) as each unit of work finishes:
+#  {"subject": ..., "session": ..., "task": ..., "file": ..., "sha256": ...}  a .tsv file was uploaded (or didn't need to be)
+#  {"subject": ..., "session": ..., "task": ...}                             every file for the task and session is done
+#  {"subject": ...}                                                          everything for the subject is done
+# A resumed run skips finished subjects, doesn't fetch or transform finished tasks, and doesn't re-upload a file
+# if its content is the same as when it was journaled. A partly-written last line (from a crash) is ignored.
+# Resume with the same options as the interrupted run; the journal doesn't record them. A journal that already
+# records work is only started afresh when asked to (--new-journal), so that rerunning a command without --resume
+# doesn't silently throw away the record of what it finished.
+
+from compressed_io import open_input
+import hashlib
+import json
+import os
+
+def content_hash(path):
+    """sha256 of a .tsv file's content, decompressed (so that e.g. the timestamp in a gzip header doesn't change it)."""
+    digest = hashlib.sha256()
+    with open_input(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def journal_has_records(path):
+    return os.path.exists(path) and os.path.getsize(path) > 0
+
+class RunJournal(object):
+    def __init__(self, path, resume=False, overwrite=False):
+        """
+        Opens the journal at path. With resume, the units it already records are loaded; otherwise it's started
+        afresh, which raises FileExistsError if it already records any unless overwrite is given.
+        """
+        if not resume and not overwrite and journal_has_records(path):
+            raise FileExistsError(f'{path} already records finished work; resume it or start it afresh explicitly.')
+        self.path = path
+        self.files = {} # (subject, session, task, file name) -> sha256
+        self.tasks = set() # (subject, session, task)
+        self.subjects = set()
+        if resume and os.path.exists(path):
+            self._load()
+        self._f = open(path, 'a' if resume else 'w')
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue # the last line may have been cut off
+                if 'file' in rec:
+                    self.files[(rec['subject'], rec['session'], rec['task'], rec['file'])] = rec['sha256']
+                elif 'task' in rec:
+                    self.tasks.add((rec['subject'], rec['session'], rec['task']))
+                else:
+                    self.subjects.add(rec['subject'])
+
+    def _write(self, rec):
+        self._f.write(json.dumps(rec) + '\n')
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def close(self):
+        self._f.close()
+
+    def subject_done(self, subject):
+        return subject in self.subjects
+
+    def task_done(self, subject, session, task):
+        return (subject, session, task) in self.tasks
+
+    def file_done(self, subject, session, task, path, sha256):
+        return self.files.get((subject, session, task, os.path.basename(path))) == sha256
+
+    def record_file(self, subject, session, task, path, sha256):
+        file_name = os.path.basename(path)
+        self.files[(subject, session, task, file_name)] = sha256
+        self._write({'subject': subject, 'session': session, 'task': task, 'file': file_name, 'sha256': sha256})
+
+    def record_task(self, subject, session, task):
+        self.tasks.add((subject, session, task))
+        self._write({'subject': subject, 'session': session, 'task': task})
+
+    def record_subject(self, subject):
+        self.subjects.add(subject)
+        self._write({'subject': subject})
@@ -0,0 +1 @@
+../sharding.py
\ No newline at end of file
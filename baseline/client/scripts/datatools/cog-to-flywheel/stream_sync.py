@@ -0,0 +1,167 @@
+# Change events for pvs-prod-experiment-data, for syncing each run of a task to Flywheel shortly after the
+# participant finishes it (cog-to-flywheel.py --stream), rather than waiting for the next full pass.
+#
+# Events come from the table's DynamoDB stream (which must include new images, i.e. have the view type
+# NEW_IMAGE or NEW_AND_OLD_IMAGES) or, for testing, from a local feed: a file of JSON lines, each either a
+# stream record as returned by GetRecords ({"eventName": ..., "dynamodb": {"NewImage": ...}}) or a plain
+# decoded item ({"identityId": ..., "experimentDateTime": ..., "results": {...}}).
+#
+# RunCollector groups the events by identityId and experiment. A run is complete once its end marker (the
+# trial whose results have 'ua') has arrived and there have been no more events for that identity and
+# experiment for settle_secs, which gives trials that were written just before the marker, or that arrive
+# through another stream shard, time to come in. Only the keys of events are kept, not their trial data:
+# the run itself is fetched from the table once it's complete.
+#
+# Stream positions aren't saved. Records stay in a DynamoDB stream for 24 hours, so after a restart use
+# --stream-start trim-horizon to go back over them (re-uploading a run just replaces its file), or run a
+# full sync to catch up on anything older.
+
+from collections import namedtuple
+from dynamo_decode import decode_item
+import json
+import time
+
+# end is the experimentDateTime of the run's end marker
+CompletedRun = namedtuple('CompletedRun', ['identity_id', 'user_id', 'experiment', 'end'])
+
+class _Pending(object):
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.ends = set()
+        self.last_event = None
+
+class RunCollector(object):
+    def __init__(self, settle_secs=60, abandon_secs=24 * 60 * 60):
+        """
+        settle_secs is how long to wait after the last event for an identity and experiment before treating
+        its finished runs as complete. Events for runs that never finish are forgotten after abandon_secs.
+        """
+        self.settle_secs = settle_secs
+        self.abandon_secs = abandon_secs
+        self._pending = {} # (identityId, experiment) -> _Pending
+
+    def add(self, item, now):
+        experiment = item['experimentDateTime'].split('|')[0]
+        pending = self._pending.setdefault((item['identityId'], experiment), _Pending(item.get('userId')))
+        pending.last_event = now
+        if pending.user_id is None:
+            pending.user_id = item.get('userId')
+        if item.get('results', {}).get('ua', None):
+            pending.ends.add(item['experimentDateTime'])
+
+    def ready(self, now):
+        """Returns the runs that are complete as of now, in the order they ended, and stops tracking them."""
+        result = []
+        for (key, pending) in list(self._pending.items()):
+            idle = now - pending.last_event
+            if pending.ends and idle >= self.settle_secs:
+                result.extend(CompletedRun(key[0], pending.user_id, key[1], end) for end in pending.ends)
+                del self._pending[key]
+            elif not pending.ends and idle >= self.abandon_secs:
+                del self._pending[key]
+        return sorted(result, key=lambda run: run.end.split('|')[1])
+
+    def flush(self):
+        """Returns every run whose end marker has arrived, without waiting for it to settle."""
+        return self.ready(float('inf'))
+
+    def pending_count(self):
+        return len(self._pending)
+
+def _item_for_record(record):
+    """Returns the decoded new image of a stream record, or None for records without one (deletions)."""
+    if record.get('eventName') == 'REMOVE':
+        return None
+    image = record.get('dynamodb', {}).get('NewImage')
+    if image is None:
+        raise ValueError('Stream records have no new image; the stream view type must be NEW_IMAGE or NEW_AND_OLD_IMAGES.')
+    return decode_item(image)
+
+def _list_shards(streams_client, stream_arn):
+    shards = []
+    args = {'StreamArn': stream_arn}
+    while True:
+        desc = streams_client.describe_stream(**args)['StreamDescription']
+        shards.extend(desc['Shards'])
+        last = desc.get('LastEvaluatedShardId')
+        if not last:
+            return shards
+        args['ExclusiveStartShardId'] = last
+
+def iter_stream_items(streams_client, stream_arn, start='LATEST', poll_secs=5):
+    """
+    Yields the items written to the table, from a boto3.client('dynamodbstreams'), forever. start is the
+    ShardIteratorType for the shards that are open when this starts (LATEST or TRIM_HORIZON); shards that
+    appear later are read from their beginning. None is yielded after every poll, so that callers can do
+    other work while the table is quiet.
+    """
+    iterators = {} # shard id -> iterator, for shards that haven't been read to their end
+    seen = set()
+    first = True
+    while True:
+        # DynamoDB splits the stream into new shards every few hours
+        for shard in _list_shards(streams_client, stream_arn):
+            if shard['ShardId'] in seen:
+                continue
+            seen.add(shard['ShardId'])
+            resp = streams_client.get_shard_iterator(StreamArn=stream_arn, ShardId=shard['ShardId'], ShardIteratorType=start if first else 'TRIM_HORIZON')
+            iterators[shard['ShardId']] = resp['ShardIterator']
+        first = False
+
+        for (shard_id, iterator) in list(iterators.items()):
+            resp = streams_client.get_records(ShardIterator=iterator, Limit=1000)
+            for record in resp.get('Records', []):
+                item = _item_for_record(record)
+                if item is not None:
+                    yield item
+            if resp.get('NextShardIterator'):
+                iterators[shard_id] = resp['NextShardIterator']
+            else:
+                del iterators[shard_id] # the shard is closed and has been read to its end
+        yield None
+        time.sleep(poll_secs)
+
+def iter_feed_items(path, follow=False, poll_secs=1):
+    """
+    Yields the items in a local feed file (see above). With follow, keeps reading lines as they're appended,
+    like tail -f, yielding None whenever it reaches the end of the file.
+    """
+    with open(path) as f:
+        partial = ''
+        while True:
+            line = f.readline()
+            if line.endswith('\n') or (line and not follow):
+                line = partial + line
+                partial = ''
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                item = _item_for_record(record) if 'dynamodb' in record else record
+                if item is not None:
+                    yield item
+            elif follow:
+                partial += line # a line that's still being written
+                yield None
+                time.sleep(poll_secs)
+            else:
+                return
+
+def run_stream_sync(items, on_run, settle_secs=60, clock=time.monotonic):
+    """
+    Collects items (as yielded by iter_stream_items or iter_feed_items) into runs and calls on_run with each
+    CompletedRun once it's complete. When items runs out, every run whose end marker has arrived is
+    completed without waiting. Returns the number of runs completed.
+    """
+    collector = RunCollector(settle_secs)
+    count = 0
+    for item in items:
+        now = clock()
+        if item is not None:
+            collector.add(item, now)
+        for run in collector.ready(now):
+            on_run(run)
+            count += 1
+    for run in collector.flush():
+        on_run(run)
+        count += 1
+    return count
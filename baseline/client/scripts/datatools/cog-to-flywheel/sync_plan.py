@@ -0,0 +1,101 @@
+# Computes what a cog-to-flywheel sync would upload without fetching or transforming any trial data.
+#
+# A plan compares two inventories, both of which are cached as JSON files so that planning takes seconds:
+#  - the Flywheel inventory: {humanId: {session label: {acquisition label: number of files}}}
+#  - the AWS summary: {humanId: {'userId': ..., 'identityId': ..., 'task_sets': {task: [setNum, ...]}}},
+#    with one setNum per set header (taskStarted) trial, in the order they were recorded.
+# The acquisitions each task would produce are worked out from its set numbers the same way
+# TsvTransformer names its output files, and every one that's missing from Flywheel (or has no files)
+# becomes a PlanItem.
+
+from collections import namedtuple
+import json
+import os
+from tsv_transformer import RunData, transformer_for_task
+
+PlanItem = namedtuple('PlanItem', ['human_id', 'session', 'task', 'acq_label', 'reason'])
+
+def load_cache(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_cache(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp_path, path)
+
+def expected_acq_labels(task, set_nums, human_id):
+    """
+    Returns {session label: [acquisition label, ...]} for the acquisitions that TsvTransformer would write
+    for a task with runs for the given set numbers.
+    """
+    has_multi_runs = transformer_for_task(task, [], human_id).has_multi_runs
+    result = {}
+    for set_num in set_nums:
+        session = RunData(set_num).get_session()
+        labels = result.setdefault(session, [])
+        if has_multi_runs:
+            labels.append(f'beh_{task}_run-{len(labels) + 1}')
+        elif not labels:
+            labels.append(f'beh_{task}')
+    return result
+
+def plan_sync(fw_inventory, aws_summary, tasks_for_session, tasks=None, force=False, human_id=None):
+    """
+    Returns (plan, problems): a list of PlanItems for the acquisitions to upload, and a list of messages
+    about data that can't be uploaded (e.g. subjects or sessions that don't exist in Flywheel).
+    tasks_for_session(session label) gives the tasks to check for each session; tasks, if given,
+    limits them further. With force, every expected acquisition is planned, even if it already has files.
+    """
+    plan = []
+    problems = []
+    for (subj_id, aws_subj) in aws_summary.items():
+        if human_id and subj_id != human_id:
+            continue
+        if not aws_subj.get('identityId'):
+            continue
+        fw_sessions = fw_inventory.get(subj_id)
+        if fw_sessions is None:
+            problems.append(f'{subj_id} has cognitive data in AWS but no Flywheel subject')
+            continue
+
+        expected = {} # session label -> [(task, acq label)]
+        for (task, set_nums) in aws_subj.get('task_sets', {}).items():
+            for (session, labels) in expected_acq_labels(task, set_nums, subj_id).items():
+                expected.setdefault(session, []).extend((task, label) for label in labels)
+
+        for (session, task_labels) in expected.items():
+            if session not in fw_sessions:
+                problems.append(f'{subj_id} has {session} session cognitive data in AWS but no {session} session in Flywheel')
+                continue
+            session_tasks = tasks or tasks_for_session(session)
+            acqs = fw_sessions[session]
+            for (task, label) in task_labels:
+                if task not in session_tasks:
+                    continue
+                if label not in acqs:
+                    plan.append(PlanItem(subj_id, session, task, label, 'missing'))
+                elif acqs[label] == 0:
+                    plan.append(PlanItem(subj_id, session, task, label, 'no files'))
+                elif force:
+                    plan.append(PlanItem(subj_id, session, task, label, 'forced'))
+
+    return (plan, problems)
+
+def plan_by_subject(plan):
+    """Groups plan items into {humanId: {session label: {task: set of acquisition labels}}}, the form the executor takes."""
+    result = {}
+    for item in plan:
+        result.setdefault(item.human_id, {}).setdefault(item.session, {}).setdefault(item.task, set()).add(item.acq_label)
+    return result
+
+def print_plan(plan, problems):
+    for item in plan:
+        print(f'{item.human_id}/{item.session}/{item.acq_label} ({item.reason})')
+    for problem in problems:
+        print(f'WARNING: {problem}')
+    subjects = len({item.human_id for item in plan})
+    print(f'{len(plan)} acquisitions to upload for {subjects} subjects.')
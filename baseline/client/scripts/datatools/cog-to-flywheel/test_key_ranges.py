@@ -0,0 +1,57 @@
+# Tests for key_ranges.split_key_range: every key between the first and last falls into exactly one range.
+# python -m pytest test_key_ranges.py
+
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from key_ranges import split_key_range
+
+def _keys(rng, count, span_secs):
+    start = datetime(2023, 3, 3, 9)
+    times = sorted(start + timedelta(milliseconds=rng.randrange(span_secs * 1000)) for _ in range(count))
+    # several items can share a dateTime; they're told apart by the index at the end of the key
+    return sorted(f'n-back|{t.strftime("%Y-%m-%dT%H:%M:%S.")}{t.microsecond // 1000:03d}Z|{rng.randrange(60)}' for t in times)
+
+def _ranges_containing(key_ranges, key):
+    return [idx for (idx, (low, high)) in enumerate(key_ranges) if low <= key <= high]
+
+@pytest.mark.parametrize('seed', range(50))
+def test_every_key_in_exactly_one_range(seed):
+    rng = random.Random(seed)
+    keys = _keys(rng, rng.randrange(1, 300), rng.choice([1, 60, 3600, 30 * 24 * 3600]))
+    slices = rng.randrange(1, 12)
+    key_ranges = split_key_range(keys[0], keys[-1], slices)
+
+    assert 1 <= len(key_ranges) <= slices
+    assert key_ranges[0][0] == keys[0] and key_ranges[-1][1] == keys[-1]
+    for ((_, high), (low, _)) in zip(key_ranges, key_ranges[1:]):
+        assert high == low # no gap between ranges
+        assert high not in keys # inner bounds are never keys, so no overlap
+    for key in keys:
+        assert len(_ranges_containing(key_ranges, key)) == 1
+
+def test_inner_bounds_sort_before_keys_with_the_same_time():
+    key_ranges = split_key_range('n-back|2023-03-03T09:00:00.000Z|0', 'n-back|2023-03-03T09:00:00.002Z|9', 2)
+    assert key_ranges == [
+        ('n-back|2023-03-03T09:00:00.000Z|0', 'n-back|2023-03-03T09:00:00.001Z'),
+        ('n-back|2023-03-03T09:00:00.001Z', 'n-back|2023-03-03T09:00:00.002Z|9'),
+    ]
+    assert _ranges_containing(key_ranges, 'n-back|2023-03-03T09:00:00.001Z|0') == [1]
+
+def test_more_slices_than_milliseconds():
+    # bounds are whole milliseconds, so a range can't be split more finely than that
+    key_ranges = split_key_range('n-back|2023-03-03T09:00:00.000Z|0', 'n-back|2023-03-03T09:00:00.001Z|3', 10)
+    assert key_ranges == [('n-back|2023-03-03T09:00:00.000Z|0', 'n-back|2023-03-03T09:00:00.001Z|3')]
+
+def test_single_key():
+    key = 'n-back|2023-03-03T09:00:00.000Z|0'
+    assert split_key_range(key, key, 4) == [(key, key)]
+
+@pytest.mark.parametrize('first_key,last_key', [
+    ('n-back|2023-03-03 09:00:00|0', 'n-back|2023-03-04 09:00:00|0'), # not ISO 8601 with milliseconds
+    ('n-back|2023-03-03T09:00:00.000Z', 'n-back|2023-03-04T09:00:00.000Z'), # no index
+])
+def test_unexpected_keys_give_one_range(first_key, last_key):
+    assert split_key_range(first_key, last_key, 4) == [(first_key, last_key)]
@@ -0,0 +1,156 @@
+# A local SQLite store of the rows the transformers write to .tsv files, for analyses that span tasks,
+# sessions and subjects without downloading and combining the .tsv files from Flywheel.
+#
+# Each task gets a table named after it (task-faceName -> task_faceName) with the columns of its .tsv
+# files, plus key columns:
+#  sub   the subject's humanId
+#  sess  the session label (pre or post)
+#  run   the run number used in the .tsv file name (1 for tasks with a single run per session, which keep
+#        only the session's last run, as their .tsv files do)
+#  row   the row's index within its .tsv file
+# Tables are indexed on (sub, sess, run, row) and on sess. Loading a task for a subject replaces all of
+# that subject's rows for the task, in one transaction, so the store can be updated one subject at a time.
+# The loads table records when each subject/task was last loaded and how many rows it had.
+#
+# Stores written by separate shards of a sync (cog-to-flywheel.py --shard) can be merged with:
+# trial_warehouse.py merge trials.sqlite shard-0.sqlite shard-1.sqlite ...
+#
+# Values are stored the way the .tsv files show them, except that numbers stay numbers and missing
+# values are NULL: booleans, lists and dicts are stored as their str().
+#
+# Example:
+# sqlite3 trials.sqlite "select f.sub, f.sess, avg(f.response_time_ms), avg(s.response_time_ms)
+#   from task_flanker f join task_spatialOrientation s using (sub, sess) where f.is_relevant = 'True' group by 1, 2"
+
+import datetime
+import sqlite3
+
+KEY_COLUMNS = ['sub', 'sess', 'run', 'row']
+
+def table_for_task(task):
+    return task.replace('-', '_')
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def _sql_value(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return str(value)
+
+def _group_by_task(loads):
+    result = {}
+    for (sub, task, loaded_at, rows) in loads:
+        result.setdefault(task, []).append((sub, loaded_at, rows))
+    return result
+
+class TrialWarehouse(object):
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('create table if not exists loads (sub text, task text, loaded_at text, rows integer, primary key (sub, task))')
+        self._columns = {} # table -> set of column names, for tables we've already checked
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _ensure_table(self, table, columns):
+        existing = self._columns.get(table)
+        if existing is None:
+            existing = {row[1] for row in self.conn.execute(f'pragma table_info({_quote(table)})')}
+            if not existing:
+                key_defs = 'sub text not null, sess text not null, run integer not null, row integer not null'
+                col_defs = ''.join(f', {_quote(c)}' for c in columns)
+                self.conn.execute(f'create table {_quote(table)} ({key_defs}{col_defs}, primary key (sub, sess, run, row))')
+                self.conn.execute(f'create index {_quote(table + "_sess")} on {_quote(table)} (sess)')
+                existing = set(KEY_COLUMNS) | set(columns)
+            self._columns[table] = existing
+        # some tasks (e.g. NBack) add columns as they see more responses
+        for c in columns:
+            if c not in existing:
+                self.conn.execute(f'alter table {_quote(table)} add column {_quote(c)}')
+                existing.add(c)
+
+    def load_task(self, subject, task, runs, fieldnames):
+        """
+        Replaces subject's rows for task. runs is a sequence of (session label, run number, rows), where rows
+        are dicts keyed by fieldnames (as TsvTransformer writes them). Returns the number of rows loaded.
+        """
+        table = table_for_task(task)
+        columns = [c for c in dict.fromkeys(fieldnames) if c not in KEY_COLUMNS]
+        count = 0
+        with self.conn:
+            self._ensure_table(table, columns)
+            self.conn.execute(f'delete from {_quote(table)} where sub = ?', (subject,))
+            insert = f'insert into {_quote(table)} ({", ".join(_quote(c) for c in KEY_COLUMNS + columns)}) values ({", ".join("?" * (len(KEY_COLUMNS) + len(columns)))})'
+            for (session, run, rows) in runs:
+                self.conn.executemany(insert, ([subject, session, run, idx, *(_sql_value(row.get(c)) for c in columns)] for (idx, row) in enumerate(rows)))
+                count += len(rows)
+            self.conn.execute('insert or replace into loads values (?, ?, ?, ?)', (subject, task, datetime.datetime.now(datetime.timezone.utc).isoformat(), count))
+        return count
+
+    def merge(self, other_path):
+        """
+        Copies everything loaded into the store at other_path into this one, replacing this store's rows for
+        each subject/task loaded there (the later load wins if both stores have one). Returns the number of rows copied.
+        """
+        count = 0
+        other = sqlite3.connect(other_path)
+        try:
+            loads = other.execute('select sub, task, loaded_at, rows from loads').fetchall()
+            for (task, task_loads) in _group_by_task(loads).items():
+                table = table_for_task(task)
+                columns = [row[1] for row in other.execute(f'pragma table_info({_quote(table)})') if row[1] not in KEY_COLUMNS]
+                current = self.loaded()
+                with self.conn:
+                    self._ensure_table(table, columns)
+                    insert = f'insert into {_quote(table)} ({", ".join(_quote(c) for c in KEY_COLUMNS + columns)}) values ({", ".join("?" * (len(KEY_COLUMNS) + len(columns)))})'
+                    select = f'select {", ".join(_quote(c) for c in KEY_COLUMNS + columns)} from {_quote(table)} where sub = ?'
+                    for (sub, loaded_at, rows) in task_loads:
+                        if current.get((sub, task), ('',))[0] > loaded_at:
+                            continue
+                        self.conn.execute(f'delete from {_quote(table)} where sub = ?', (sub,))
+                        self.conn.executemany(insert, other.execute(select, (sub,)))
+                        self.conn.execute('insert or replace into loads values (?, ?, ?, ?)', (sub, task, loaded_at, rows))
+                        count += rows
+        finally:
+            other.close()
+        return count
+
+    def loaded(self, subject=None):
+        """Returns {(sub, task): (loaded_at, rows)} for everything loaded, or just for subject."""
+        if subject is None:
+            cursor = self.conn.execute('select sub, task, loaded_at, rows from loads')
+        else:
+            cursor = self.conn.execute('select sub, task, loaded_at, rows from loads where sub = ?', (subject,))
+        return {(sub, task): (loaded_at, rows) for (sub, task, loaded_at, rows) in cursor}
+
+    def query(self, sql, params=()):
+        return self.conn.execute(sql, params).fetchall()
+
+if __name__ == '__main__':
+    import argparse
+
+    def _parse_args():
+        parser = argparse.ArgumentParser(description='Maintains the local store of transformed trial rows.')
+        subparsers = parser.add_subparsers(dest='command', required=True)
+        merge_parser = subparsers.add_parser('merge', help='Merge the stores written by several shards into one')
+        merge_parser.add_argument('output', help='Store to merge into (created if necessary)')
+        merge_parser.add_argument('inputs', nargs='+', help='Stores to merge')
+        return parser.parse_args()
+
+    def _main(args):
+        with TrialWarehouse(args.output) as warehouse:
+            for path in args.inputs:
+                rows = warehouse.merge(path)
+                print(f'Merged {rows} rows from {path}.')
+
+    _main(_parse_args())
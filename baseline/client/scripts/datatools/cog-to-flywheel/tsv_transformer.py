@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from compressed_io import open_output, with_compression_suffix
 
 def transformer_for_task(task, data, subject):
     if task == 'task-moodPrediction' or task == 'task-moodMemory':
@@ -44,6 +45,9 @@ def transformer_for_task(task, data, subject):
 
 class TsvTransformer(ABC):
     default_fields = ['date_time', 'is_relevant', 'screen_size', 'time_elapsed_ms', 'ua', 'version']
+    # results attributes read by _skip and TsvTransformer._process_line, which every transformer needs. _skip
+    # also reads stimulus, but only for the trials in may_skip_by_stimulus, so it isn't one of these.
+    base_results_fields = ['taskStarted', 'setNum', 'ua', 'v', 'screen', 'time_elapsed', 'trial_type']
     def __init__(self, data, subject, task):
         self.data = data
         self.subject = subject
@@ -51,6 +55,21 @@ class TsvTransformer(ABC):
         self.runs = []
         self.has_multi_runs = False
         self.fieldnames = []
+        self.compression = None # set to 'gzip' or 'zstd' to write compressed .tsv files
+        self.warehouse = None # set to a trial_warehouse.TrialWarehouse to also load the rows into it
+
+    def results_fields(self):
+        """
+        Returns the names of the results attributes this transformer reads, so that queries can fetch only those
+        (see projection_for_task in cog-to-flywheel.py). Subclasses add the attributes their _process_line reads.
+        When stimulus isn't one of them, the lines in may_skip_by_stimulus still need it.
+        """
+        return list(self.base_results_fields)
+
+    @staticmethod
+    def may_skip_by_stimulus(line):
+        """True for the lines _skip can only decide on by their stimulus (the set progress screens are skipped)."""
+        return not line.get('isRelevant', True) and line['results'].get('trial_type', '') not in ('fullscreen', 'call-function')
 
     def _skip(self, line):
         if line["results"].get('trial_type', '') == 'fullscreen': 
@@ -58,7 +77,7 @@ class TsvTransformer(ABC):
         if line['results'].get('trial_type', '') == 'call-function':
             return True
         stimulus = line['results'].get('stimulus', '')
-        if not line.get('isRelevant', True) and ('You are about to start set' in stimulus or 'You have completed' in stimulus):
+        if self.may_skip_by_stimulus(line) and ('You are about to start set' in stimulus or 'You have completed' in stimulus):
             return True
         return False
     
@@ -79,22 +98,32 @@ class TsvTransformer(ABC):
         date_time = line['experimentDateTime'].split('|')[1]
         return (rd, 'NORMAL', {'is_relevant': line.get('isRelevant', False), 'time_elapsed_ms': res.get('time_elapsed', 'n/a'), 'date_time': date_time})
 
-    def _write_results(self):
-        import csv
-        csv.register_dialect('tabs', delimiter='\t')
-        files_written = []
+    def _numbered_runs(self):
+        """Returns [(run data, run number within its session)], with None for the run number of single-run tasks."""
+        result = []
         pre_session_run_count = 0
-
         for idx, run_data in enumerate(self.runs):
-            fname = f'sub-{self.subject}_ses-{run_data.get_session()}_{self.task}'
+            run_num = None
             if self.has_multi_runs:
                 if run_data.get_session() == 'pre':
-                    fname += f'_run-{idx+1}'
+                    run_num = idx+1
                     pre_session_run_count += 1
                 else:
-                    fname += f'_run-{idx+1 - pre_session_run_count}'
-            fname += '_beh.tsv'
-            with open(fname, 'w') as f:
+                    run_num = idx+1 - pre_session_run_count
+            result.append((run_data, run_num))
+        return result
+
+    def _write_results(self):
+        import csv
+        csv.register_dialect('tabs', delimiter='\t')
+        files_written = []
+
+        for (run_data, run_num) in self._numbered_runs():
+            fname = f'sub-{self.subject}_ses-{run_data.get_session()}_{self.task}'
+            if run_num is not None:
+                fname += f'_run-{run_num}'
+            fname = str(with_compression_suffix(fname + '_beh.tsv', self.compression))
+            with open_output(fname, self.compression, newline='') as f:
                 writer = csv.DictWriter(f, [*self.default_fields, *self.fieldnames], dialect='tabs')
                 writer.writeheader()
                 writer.writerows(run_data.get_lines())
@@ -108,7 +137,20 @@ class TsvTransformer(ABC):
                 self._process_line(line)
 
         files_written = self._write_results()
+        if self.warehouse is not None:
+            # like the .tsv files, a single-run task keeps only the last run in each session
+            runs = {(run_data.get_session(), run_num or 1): run_data.get_lines() for (run_data, run_num) in self._numbered_runs()}
+            self.warehouse.load_task(self.subject, self.task, [(sess, run, lines) for ((sess, run), lines) in runs.items()], [*self.default_fields, *self.fieldnames])
         return files_written
+
+    def run_index_at(self, experiment_date_time):
+        """
+        Returns the index in runs (and in the list of files process() returns) of the run that was in progress
+        at experiment_date_time, e.g. the run a given trial belongs to, or None if no run had started by then.
+        """
+        starts = [line for line in self.data if line['results'].get('taskStarted', None) and not self._skip(line)]
+        count = sum(1 for line in starts if line['experimentDateTime'] <= experiment_date_time)
+        return count - 1 if count else None
     
     def _get_na_for_none(self, dict, key):
         if dict.get(key, 'n/a') == None: return 'n/a'
@@ -152,6 +194,9 @@ class SimpleTransfomer(TsvTransformer):
     def __init__(self, data, subject, task):
         super().__init__(data, subject, task)
 
+    def results_fields(self):
+        return super().results_fields() + ['response']
+
     def _process_line(self, line):
         (run_data, line_type, fields) = super()._process_line(line)
         if line_type != 'NORMAL': return
@@ -167,6 +212,9 @@ class ModifiedFieldNamesTransformer(TsvTransformer):
         super().__init__(data, subject, task)
         self.orig_fieldnames = []
 
+    def results_fields(self):
+        return super().results_fields() + self.orig_fieldnames
+
     def _process_line(self, line):
         if len(self.orig_fieldnames) != len(self.fieldnames):
             raise AssertionError('The length of orig_fieldnames must be the same as the length of self.fieldnames.')
@@ -186,6 +234,9 @@ class MoodPrediction(TsvTransformer):
         super().__init__(data, subject, task)
         self.fieldnames = ['preamble', 'bad_mood', 'neutral_mood', 'good_mood']
 
+    def results_fields(self):
+        return super().results_fields() + ['preamble', 'response']
+
     def _process_line(self, line):
         (run_data, line_type, fields) = super()._process_line(line)
         if line_type == 'NORMAL':
@@ -225,6 +276,9 @@ class PatternSeparationRecall(TsvTransformer):
                            "response", "correct", "response_time_ms", "failed_images"]
         self.has_multi_runs = True
 
+    def results_fields(self):
+        return super().results_fields() + ['trial_index', 'stimulus', 'failed_images', 'response', 'rt', 'pic', 'type', 'isRecall']
+
     def _process_line(self, line):
         (run_data, line_type, fields) = super()._process_line(line)
         if not line_type == 'NORMAL': return
@@ -310,6 +364,9 @@ class Ffmq(TsvTransformer):
         self.fieldnames = ["Q0","Q1","Q2","Q3","Q4","Q5","Q6","Q7","Q8","Q9",
         "Q10","Q11","Q12","Q13","Q14"]
 
+    def results_fields(self):
+        return super().results_fields() + ['response']
+
     def _process_line(self, line):
         (run_data, line_type, fields) = super()._process_line(line)
         if not line_type == 'NORMAL': return
@@ -346,7 +403,11 @@ class SpatialOrientation(TsvTransformer):
                            'target_radians', 'response_radians', 'response_time_ms',
                            'signed_radian_distance', 'time_limit_ms', 'completion_reason']
         self.has_multi_runs = True
-        
+
+    def results_fields(self):
+        return super().results_fields() + ['trial_index', 'stimulus', 'rt', 'mode', 'center', 'facing', 'target', 'targetRadians',
+                                           'responseRadians', 'signedRadianDistance', 'timeLimit', 'completionReason']
+
     def _process_line(self, line):
         (run_data, line_type, fields) = super()._process_line(line)
         if not line_type == 'NORMAL': return
@@ -385,6 +446,9 @@ class VerbalFluency(TsvTransformer):
         self.fieldnames = ['trial_index', 'stimulus', 'letter', 'response']
         self.has_multi_runs = True
 
+    def results_fields(self):
+        return super().results_fields() + self.fieldnames
+
     def _process_line(self, line):
         (run_data, line_type, fields) = super()._process_line(line)
         if line_type != 'NORMAL': return
@@ -403,6 +467,9 @@ class NBack(TsvTransformer):
         self.fieldnames = ['trial_index', 'stimulus', 'n', 'sequence', 'missed_indices']
         self.has_multi_runs = True
 
+    def results_fields(self):
+        return super().results_fields() + ['trial_index', 'stimulus', 'n', 'sequence', 'missedIndices', 'responses']
+
     def add_response(self, fields, response_idx, fieldname, value):
         response_field = f'response_{response_idx}_{fieldname}'
         fields[response_field] = value
@@ -444,6 +511,10 @@ class Flanker(TsvTransformer):
                            "response", "correct", "correct_response", "response_time_ms", "trial_duration_ms", 
                            "failed_images"]
         self.has_multi_runs = True
+
+    def results_fields(self):
+        return super().results_fields() + ['trial_index', 'stimulus', 'failed_images', 'isTraining', 'arrows', 'congruent', 'response',
+                                           'correct', 'correct_response', 'rt', 'trial_duration']
         
     def _process_line(self, line):
         (run_data, line_type, fields) = super()._process_line(line)
@@ -492,6 +563,9 @@ class SleepSurvey(TsvTransformer):
             "sleepiness five minutes before": "Q8"
         }
 
+    def results_fields(self):
+        return super().results_fields() + ['response']
+
     def _process_line(self, line):
         (run_data, line_type, fields) = super()._process_line(line)
         if not line_type == 'NORMAL': return
@@ -0,0 +1,69 @@
+# Uploads .tsv files to Flywheel acquisitions, retrying failed uploads and keeping track of the status of every file.
+#
+# Each file is uploaded in its own request, as soon as it's given to upload(). A file that's given twice
+# (single-run tasks write the same file name for every run in a session) is only uploaded once.
+# If an upload fails, the acquisition is reloaded to see whether the file made it anyway, and it's retried if not.
+# Files that still fail are recorded rather than raised, so that a run can report all of them at the end.
+
+import logging
+log = logging.getLogger(__name__)
+import os
+import time
+
+UPLOADED = 'uploaded'
+FAILED = 'failed'
+SKIPPED = 'skipped (dry run)'
+
+class UploadTracker(object):
+    def __init__(self, no_upload=False, max_attempts=3, retry_delay_secs=2):
+        self.no_upload = no_upload
+        self.max_attempts = max_attempts
+        self.retry_delay_secs = retry_delay_secs
+        self.status = {} # path -> UPLOADED, FAILED or SKIPPED
+        self.errors = {} # path -> message from the last failed attempt
+        self.retries = 0
+
+    def _landed(self, acq, path):
+        """Returns True if acq has a file with the same name and size as the local file at path."""
+        acq.reload()
+        sizes = {f.name: f.size for f in acq.files}
+        return sizes.get(os.path.basename(path)) == os.path.getsize(path)
+
+    def upload(self, acq, path):
+        """Uploads path to acq, unless it's already been uploaded. Returns True unless the upload failed."""
+        if path in self.status:
+            return self.status[path] != FAILED
+        if self.no_upload:
+            print(f'Would upload {path} to {acq.label} (skipping; dry run)...')
+            self.status[path] = SKIPPED
+            return True
+
+        for attempt in range(1, self.max_attempts + 1):
+            print(f'Uploading {path} to {acq.label}...')
+            try:
+                acq.upload_file(path)
+                self.status[path] = UPLOADED
+                return True
+            except Exception as err:
+                self.errors[path] = str(err)
+                try:
+                    if self._landed(acq, path):
+                        self.status[path] = UPLOADED
+                        return True
+                except Exception as reload_err:
+                    log.error('Error checking whether %s reached %s: %s', path, acq.label, reload_err)
+                if attempt < self.max_attempts:
+                    log.error('Error uploading %s to %s (attempt %d of %d); retrying: %s', path, acq.label, attempt, self.max_attempts, err)
+                    self.retries += 1
+                    time.sleep(self.retry_delay_secs * attempt)
+
+        self.status[path] = FAILED
+        log.error('Failed to upload %s to %s: %s', path, acq.label, self.errors[path])
+        return False
+
+    def failed(self):
+        return [p for (p, status) in self.status.items() if status == FAILED]
+
+    def summary(self):
+        uploaded = sum(1 for status in self.status.values() if status == UPLOADED)
+        return f'{uploaded} files uploaded ({self.retries} retries), {len(self.failed())} failed'
@@ -12,20 +12,36 @@
 # --task taskName The task you want the combined data for (required)
 # --outfile path to file to save combined task files to (required)
 # --include-all Include all of the task data rather than just rows marked 'isRelevant' (the default)
+# --compress gzip|zstd Compress the output file. (Compressed input files are detected automatically.)
+# --subjects id1 id2 ... Only include these subjects (human ids or hashed ids)
+# --condition F|P Only include subjects in the given condition(s)
+# --runs 1-3 Only include runs in the given (inclusive) range
+# --columns col1 col2 ... Only include these task columns (sub, condition, sess and run are always included)
+# --where 'column=value' Only include rows matching the predicate. May be repeated; supports =, !=, <, <=, >, >=
+# --partition-by sess condition [run] Write a directory of files partitioned by these columns (plus an index file) to outfile instead of a single file
+# --shard i/N Only include the subjects in shard i of N (numbered from 0), assigned by a stable hash of their human id. Requires --condition-seed.
+# --condition-seed seed Seed for the randomized condition letters, so that every shard uses the same letters
+# --merge out1 out2 ... Merge the outputs (files or --partition-by directories) of several --shard runs into outfile instead of combining task files
 
 import logging
 log = logging.getLogger(__name__)
 import argparse
 from collections import defaultdict
-import flywheel
+from combine_cog_files.compressed_io import COMPRESSIONS, SUFFIXES, open_input, open_output, with_compression_suffix
+from combine_cog_files.filters import CombineFilter, parse_run_range
+from combine_cog_files.merge import PARTITION_INDEX_FILE, merge_combined_files, merge_partitioned
+from combine_cog_files.sharding import parse_shard
 import hashlib
 import json
 import csv
+import io
+import os
 from pathlib import Path
 import random
 import re
 import string
 import tempfile
+from urllib.parse import quote
 
 # Loads the hashed-user-id <-> condition map
 def get_user_map(file):
@@ -37,14 +53,18 @@ def get_user_map(file):
 # Maps the letters 'F' and 'P' (our two conditions) 
 # to two randomly-selected letters. Must only be called
 # once per run!
-def make_condition_map():
-    two_letters = random.sample(list(string.ascii_uppercase), 2)
+# seed, if given, makes the letters reproducible, so that several shards of one combine
+# (see --shard) can use the same letters
+def make_condition_map(seed=None):
+    rng = random.Random(seed) if seed is not None else random
+    two_letters = rng.sample(list(string.ascii_uppercase), 2)
     condition_map = defaultdict(lambda: 'unk')
     condition_map['F'] = two_letters[0]
     condition_map['P'] = two_letters[1]
     return condition_map
 
-def files_for_task(fw_client, project_id, tmpdir, task, sessions=[]):
+# file_filter, if provided, is called with each file name and only files it returns True for are downloaded
+def files_for_task(fw_client, project_id, tmpdir, task, sessions=[], file_filter=None):
     result = []
     if len(sessions) == 0:
         sessions = ['pre', 'post']
@@ -62,6 +82,8 @@ def files_for_task(fw_client, project_id, tmpdir, task, sessions=[]):
                     continue
 
                 for f in [x for x in acq.files if re.match(rf'sub-[^_]+_ses-{sess.label}_task-{task}.*_beh.tsv', x.name)]:
+                    if file_filter and not file_filter(f.name):
+                        continue
                     print(f'Downloading file {f.name} from {sess.label}/{acq.label}...')
                     dest_file = Path(tmpdir) / f.name
                     fw_client.download_file_from_acquisition(acq.id, f.name, dest_file, view=False)
@@ -69,19 +91,36 @@ def files_for_task(fw_client, project_id, tmpdir, task, sessions=[]):
 
     return result
 
+task_file_re = re.compile(r'sub-(?P<sub>[^_]+)_ses-(?P<sess>pre|post)_task-(?P<task>[A-z]+)_(beh.tsv|run-(?P<run>[0-9]+)_beh.tsv)')
+
+def hash_subject(human_id):
+    return hashlib.shake_128(human_id.encode('utf-8')).hexdigest(16)
+
 def metadata_from_task_file_name(task_file_name, user_map, rand_condition_map):
-    m = re.match(r'sub-(?P<sub>[^_]+)_ses-(?P<sess>pre|post)_task-(?P<task>[A-z]+)_(beh.tsv|run-(?P<run>[0-9]+)_beh.tsv)', task_file_name)
+    m = task_file_re.match(task_file_name)
     metadata = m.groupdict(default='n/a')
-    hashed_id = hashlib.shake_128(metadata['sub'].encode('utf-8')).hexdigest(16)
+    hashed_id = hash_subject(metadata['sub'])
     condition = rand_condition_map[user_map.get(hashed_id)]
     return (hashed_id, condition, metadata['sess'], metadata['run'])
 
+# Returns a function that takes a task file name and returns True if combine_filter
+# accepts the subject, condition, session and run encoded in it
+def task_file_filter(combine_filter, user_map):
+    def accepts(task_file_name):
+        m = task_file_re.match(task_file_name)
+        if not m:
+            return False
+        metadata = m.groupdict(default='n/a')
+        hashed_id = hash_subject(metadata['sub'])
+        return combine_filter.accepts_file(metadata['sub'], hashed_id, user_map.get(hashed_id), metadata['sess'], metadata['run'])
+    return accepts
+
 # nback is odd in that different files may have a different number of columns
 # check the first row of each nback file and return the longest of them
 def find_longest_nback_header(nback_files):
     longest_header = ''
     for nback_file in nback_files:
-        with open(nback_file, 'r') as infile:
+        with open_input(nback_file, newline='') as infile:
             reader = csv.reader(infile, delimiter='\t')
             header = next(reader)
             if len(header) > len(longest_header): longest_header = header
@@ -91,59 +130,271 @@ def find_longest_nback_header(nback_files):
 # nback is odd in that different files may have a different number of columns
 # works like combine_task_files, but adds empty columns as necessary to pad out
 # files that have fewer
-def combine_nback_files(nback_files, output_file, include_all, user_map, rand_condition_map):
-    longest_header = find_longest_nback_header(nback_files)
+# longest_header may be passed in when several outputs need to share the same columns
+def combine_nback_files(nback_files, output_file, include_all, user_map, rand_condition_map, compression=None, combine_filter=None, longest_header=None):
+    if longest_header is None:
+        longest_header = find_longest_nback_header(nback_files)
+    out_header, transform = combine_filter.bind(longest_header) if combine_filter else (longest_header, None)
     first_file = True
-    with open(output_file, 'w', newline='') as outfile:
+    rows_written = 0
+    with open_output(output_file, compression, newline='') as outfile:
         writer = csv.writer(outfile, delimiter='\t')
         for nback_file in nback_files:
             (sub, condition, sess, run) = metadata_from_task_file_name(nback_file.name, user_map, rand_condition_map)
-            with open(nback_file, 'r', newline='') as infile:
+            with open_input(nback_file, newline='') as infile:
                 reader = csv.reader(infile, delimiter='\t')
                 header = next(reader)
                 extra_field_count = len(longest_header) - len(header)
                 if first_file:
-                    writer.writerow(longest_header + ['sub', 'condition', 'sess', 'run'])
+                    writer.writerow(out_header + ['sub', 'condition', 'sess', 'run'])
                     first_file = False
                 for row in reader:
                     if include_all or row[1] == 'True': # row[1] is is_relevant for all task types
-                        writer.writerow(row + ['\t'] * extra_field_count + [sub, condition, sess, run])
+                        row = row + ['\t'] * extra_field_count
+                        if transform:
+                            row = transform(row)
+                            if row is None: continue
+                        writer.writerow(row + [sub, condition, sess, run])
+                        rows_written += 1
 
+    return rows_written
+
+# compression may be None, 'gzip' or 'zstd'
+# combine_filter, if provided, is a CombineFilter used to skip files and to filter and project rows
+# Returns the number of rows written.
+def combine_task_files(task_files, output_file, include_all, user_map, rand_condition_map, compression=None, combine_filter=None, nback_header=None):
+    if combine_filter:
+        accepts = task_file_filter(combine_filter, user_map)
+        task_files = [f for f in task_files if accepts(f.name)]
+        if len(task_files) == 0:
+            log.warning('No task files matched the given filters.')
+            return 0
+        if not combine_filter.has_row_filters():
+            combine_filter = None
 
-def combine_task_files(task_files, output_file, include_all, user_map, rand_condition_map):
     if 'nBack' in task_files[0].name:
-        combine_nback_files(task_files, output_file, include_all, user_map, rand_condition_map)
-        return
-    
+        return combine_nback_files(task_files, output_file, include_all, user_map, rand_condition_map, compression, combine_filter, nback_header)
+
+    if not combine_filter:
+        return combine_task_files_fast(task_files, output_file, include_all, user_map, rand_condition_map, compression)
+    return combine_task_files_csv(task_files, output_file, include_all, user_map, rand_condition_map, compression, combine_filter)
+
+# The csv-parsing path of combine_task_files, which it takes when there are row filters. Without a
+# combine_filter it writes the same bytes as combine_task_files_fast (see test_combine_task_files.py).
+def combine_task_files_csv(task_files, output_file, include_all, user_map, rand_condition_map, compression=None, combine_filter=None):
     first_file = True
-    with open(output_file, 'w', newline='') as outfile:
+    rows_written = 0
+    with open_output(output_file, compression, newline='') as outfile:
         writer = csv.writer(outfile, delimiter='\t')
         for task_file in task_files:
             (sub, condition, sess, run) = metadata_from_task_file_name(task_file.name, user_map, rand_condition_map)
-            with open(task_file, 'r', newline='') as infile:
+            with open_input(task_file, newline='') as infile:
                 reader = csv.reader(infile, delimiter='\t')
                 header = next(reader) if not first_file else next(reader, None)
+                out_header, transform = combine_filter.bind(header) if combine_filter else (header, None)
                 if first_file:
-                    writer.writerow(header + ['sub', 'condition', 'sess', 'run'])
+                    writer.writerow(out_header + ['sub', 'condition', 'sess', 'run'])
                     first_file = False
                 for row in reader:
                     if include_all or row[1] == 'True': # row[1] is is_relevant for all task types
+                        if transform:
+                            row = transform(row)
+                            if row is None: continue
                         writer.writerow(row + [sub, condition, sess, run])
+                        rows_written += 1
+
+    return rows_written
+
+# Parses raw lines (a list of bytes split on \n) with the csv module, the same way
+# combine_task_files does, and returns the bytes to write for them and the number of rows
+def _combine_raw_lines(lines, include_all, metadata):
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter='\t')
+    rows = 0
+    for row in csv.reader(io.StringIO(b'\n'.join(lines).decode('utf-8'), newline=''), delimiter='\t'):
+        if include_all or row[1] == 'True': # row[1] is is_relevant for all task types
+            writer.writerow(row + metadata)
+            rows += 1
+    return (buf.getvalue().encode('utf-8'), rows)
+
+# Produces the same output as combine_task_files_csv without a combine_filter for task files written
+# by csv.writer, as TsvTransformer writes them (see test_combine_task_files.py), but works on raw bytes:
+# each record's second field (is_relevant) is checked directly and the per-file metadata is appended
+# as a precomputed suffix, so records are never split into fields or re-quoted. Quoted fields after
+# is_relevant (e.g. stimulus html) are passed through as-is, including ones that span several lines.
+# Records with quotes in the first two fields, or with a bare carriage return (which the csv parser
+# treats as a line break), fall back to the csv parser.
+def combine_task_files_fast(task_files, output_file, include_all, user_map, rand_condition_map, compression=None):
+    first_file = True
+    rows_written = 0
+    with open_output(output_file, compression, mode='wb') as outfile:
+        for task_file in task_files:
+            metadata = list(metadata_from_task_file_name(task_file.name, user_map, rand_condition_map))
+            suffix = ('\t' + '\t'.join(metadata) + '\r\n').encode('utf-8')
+            with open_input(task_file, mode='rb') as infile:
+                lines = infile.read().split(b'\n') # task files are one run each, so they're small enough to read at once
+
+            out = []
+            if first_file:
+                out.append(lines[0].rstrip(b'\r') + b'\tsub\tcondition\tsess\trun\r\n')
+                first_file = False
+
+            record = None # raw lines of a record whose quoted field spans several lines
+            odd_quotes = False
+            for raw_line in lines[1:]:
+                if record is not None:
+                    record.append(raw_line)
+                    odd_quotes ^= raw_line.count(b'"') % 2 == 1
+                    if odd_quotes:
+                        continue
+                    # lines that end in \r inside the quoted field are part of its value
+                    if any(b'\r' in l[:-1] for l in record[:-1]) or b'\r' in record[-1][:-1]:
+                        (chunk, rows) = _combine_raw_lines(record, include_all, metadata)
+                        out.append(chunk)
+                        rows_written += rows
+                        record = None
+                        continue
+                    line = b'\n'.join(record)
+                    record = None
+                else:
+                    if b'"' in raw_line and raw_line.count(b'"') % 2 == 1:
+                        record = [raw_line]
+                        odd_quotes = True
+                        continue
+                    if b'\r' in raw_line[:-1]: # a bare carriage return is a line break to the csv parser
+                        (chunk, rows) = _combine_raw_lines([raw_line], include_all, metadata)
+                        out.append(chunk)
+                        rows_written += rows
+                        continue
+                    line = raw_line
+
+                if line.endswith(b'\r'):
+                    line = line[:-1]
+                if not line:
+                    continue
+                tab = line.find(b'\t')
+                end = line.find(b'\t', tab + 1) if tab != -1 else -1
+                if end == -1:
+                    end = len(line)
+                if b'"' in line[:end]:
+                    (chunk, rows) = _combine_raw_lines([line], include_all, metadata)
+                    out.append(chunk)
+                    rows_written += rows
+                    continue
+                if not include_all and (tab == -1 or line[tab + 1:end] != b'True'):
+                    continue
+                out.append(line + suffix)
+                rows_written += 1
+
+            if record is not None:
+                (chunk, rows) = _combine_raw_lines(record, include_all, metadata)
+                out.append(chunk)
+                rows_written += rows
+            outfile.write(b''.join(out))
+
+    return rows_written
+
+PARTITION_COLUMNS = ['sess', 'condition', 'run']
+
+# Returns the column=value directory name for a partition. Values are made safe to use as a single path
+# component: the 'n/a' run of single-run tasks becomes na and anything else that isn't is percent-encoded.
+def partition_dir_name(col, val):
+    val = 'na' if val == 'n/a' else quote(str(val), safe='')
+    return f'{col}={val}'
+
+# Like combine_task_files, but writes a directory with one file per partition instead of a single file.
+# Partitions are nested directories named column=value (e.g. sess=pre/condition=K/part.tsv, see
+# partition_dir_name), in the order given by partition_by, which may contain any of PARTITION_COLUMNS.
+# An index file listing every partition, its column values, source files and row count is written
+# to output_dir/index.json so that readers can pick out just the partitions they need. If no task files
+# are left after filtering, the index lists no partitions.
+# Returns the index.
+def combine_task_files_partitioned(task_files, output_dir, partition_by, include_all, user_map, rand_condition_map, compression=None, combine_filter=None):
+    for col in partition_by:
+        if col not in PARTITION_COLUMNS:
+            raise ValueError(f'Cannot partition by {col}. Expected one or more of {PARTITION_COLUMNS}.')
+    if combine_filter:
+        accepts = task_file_filter(combine_filter, user_map)
+        task_files = [f for f in task_files if accepts(f.name)]
+
+    # all of the partition columns are part of the task file metadata, so files can be assigned to partitions up front
+    files_by_partition = defaultdict(list)
+    for task_file in task_files:
+        (_, condition, sess, run) = metadata_from_task_file_name(task_file.name, user_map, rand_condition_map)
+        metadata = {'sess': sess, 'condition': condition, 'run': run}
+        files_by_partition[tuple(metadata[col] for col in partition_by)].append(task_file)
+
+    # make sure every nback partition has the same columns
+    nback_header = None
+    if len(task_files) > 0 and 'nBack' in task_files[0].name:
+        nback_header = find_longest_nback_header(task_files)
+
+    index = {'partition_by': partition_by, 'compression': compression, 'partitions': []}
+    os.makedirs(output_dir, exist_ok=True)
+    for partition_values in sorted(files_by_partition.keys()):
+        partition_dir = Path(output_dir).joinpath(*[partition_dir_name(col, val) for (col, val) in zip(partition_by, partition_values)])
+        os.makedirs(partition_dir, exist_ok=True)
+        part_file = with_compression_suffix(partition_dir / 'part.tsv', compression)
+        partition_files = files_by_partition[partition_values]
+        rows = combine_task_files(partition_files, part_file, include_all, user_map, rand_condition_map, compression, combine_filter, nback_header)
+        index['partitions'].append({
+            'path': part_file.relative_to(output_dir).as_posix(),
+            'values': dict(zip(partition_by, partition_values)),
+            'files': len(partition_files),
+            'rows': rows
+        })
+
+    with open(Path(output_dir) / PARTITION_INDEX_FILE, 'w') as f:
+        json.dump(index, f, indent=2)
+
+    return index
 
 if __name__ == '__main__':
+    import flywheel
 
     def _parse_args():
         parser = argparse.ArgumentParser()
-        parser.add_argument('--fw-conf', help='Path to your Flywheel config file that contains your API key', dest='fw_conf', required=True)
-        parser.add_argument('--task', help='Name of the task you want the data for', required=True)
+        parser.add_argument('--fw-conf', help='Path to your Flywheel config file that contains your API key (required unless merging)', dest='fw_conf')
+        parser.add_argument('--task', help='Name of the task you want the data for (required unless merging)')
         parser.add_argument('--outfile', help='Path to the file your results should be saved in', required=True)
         parser.add_argument('--pre', help='Only include pre session results', action='store_true')
         parser.add_argument('--post', help='Only include post session results', action='store_true')
         parser.add_argument('--include-all', help='Include all results (prompts, fixation points, etc.), not just relevant results', action='store_true', dest='include_all')
+        parser.add_argument('--compress', help='Compress the output file with the given algorithm', choices=COMPRESSIONS)
+        parser.add_argument('--subjects', help='Only include these subjects (human ids or hashed ids)', nargs='+')
+        parser.add_argument('--condition', help='Only include subjects in the given condition(s)', nargs='+', choices=['F', 'P'])
+        parser.add_argument('--runs', help='Only include runs in the given range, e.g. "2" or "1-3"', type=parse_run_range)
+        parser.add_argument('--columns', help='Only include these task columns (sub, condition, sess and run are always included)', nargs='+')
+        parser.add_argument('--where', help='Only include rows matching this predicate, e.g. "correct=True" or "response_time_ms<2000". May be repeated.', action='append', default=[])
+        parser.add_argument('--partition-by', help='Write a directory partitioned by these columns to outfile rather than a single file', nargs='+', choices=PARTITION_COLUMNS, dest='partition_by')
+        parser.add_argument('--shard', help='Only include the subjects in shard i of N, e.g. "0/4" (shards are numbered from 0)', type=parse_shard)
+        parser.add_argument('--condition-seed', help='Seed for the randomized condition letters; give every shard the same seed', dest='condition_seed')
+        parser.add_argument('--merge', help='Merge the outputs of several --shard runs into outfile', nargs='+')
         args = parser.parse_args()
+        if not args.merge and not (args.fw_conf and args.task):
+            parser.error('--fw-conf and --task are required unless merging')
+        if args.shard and args.condition_seed is None:
+            parser.error('--shard requires --condition-seed, so that all of the shards use the same condition letters')
         return args
+
+    def _merge(args):
+        if all(os.path.isdir(path) for path in args.merge):
+            index = merge_partitioned(args.merge, args.outfile, args.compress)
+            print(f'Merged {len(args.merge)} outputs into {len(index["partitions"])} partitions in {args.outfile}.')
+        elif any(os.path.isdir(path) for path in args.merge):
+            raise Exception('Cannot merge partitioned directories with single files.')
+        else:
+            outfile = args.outfile
+            if args.compress and not outfile.endswith(SUFFIXES[args.compress]):
+                outfile = with_compression_suffix(outfile, args.compress)
+            merge_combined_files(args.merge, outfile, args.compress)
+            print(f'Merged {len(args.merge)} outputs into {outfile}.')
     
     def _main(args):
+        if args.merge:
+            _merge(args)
+            return
+
         with open(args.fw_conf) as f:
             fw_conf = json.load(f)
         
@@ -156,11 +407,21 @@ if __name__ == '__main__':
         if (args.pre): sessions.append('pre')
         if (args.post): sessions.append('post')
         user_map = get_user_map('user-condition.json')
-        condition_map = make_condition_map()
-        files = files_for_task(fw, project.id, tmpdir.name, args.task, sessions)
+        condition_map = make_condition_map(args.condition_seed)
+        combine_filter = CombineFilter(subjects=args.subjects, conditions=args.condition, runs=args.runs, columns=args.columns, predicates=args.where, shard=args.shard)
+        files = files_for_task(fw, project.id, tmpdir.name, args.task, sessions, task_file_filter(combine_filter, user_map))
         if len(files) == 0:
             print(f'No data files found for task {args.task}.')
+        elif args.partition_by:
+            index = combine_task_files_partitioned(files, args.outfile, args.partition_by, args.include_all, user_map, condition_map, args.compress, combine_filter)
+            if not index['partitions']:
+                print(f'No task files matched the filters; wrote an empty index to {args.outfile}.')
+            else:
+                print(f'Wrote {len(index["partitions"])} partitions to {args.outfile}.')
         else:
-            combine_task_files(files, args.outfile, args.include_all, user_map, condition_map)
+            outfile = args.outfile
+            if args.compress and not outfile.endswith(SUFFIXES[args.compress]):
+                outfile = with_compression_suffix(outfile, args.compress)
+            combine_task_files(files, outfile, args.include_all, user_map, condition_map, args.compress, combine_filter)
     
     _main(_parse_args())
\ No newline at end of file
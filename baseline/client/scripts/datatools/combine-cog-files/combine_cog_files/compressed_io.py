@@ -0,0 +1 @@
+../../compressed_io.py
\ No newline at end of file
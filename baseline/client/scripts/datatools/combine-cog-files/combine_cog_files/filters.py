@@ -0,0 +1,119 @@
+import operator
+import re
+from .sharding import in_shard
+
+PREDICATE_OPS = {
+    '==': operator.eq,
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<=': operator.le,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '>': operator.gt,
+}
+_predicate_re = re.compile(r'^\s*([^=!<>\s]+)\s*(==|!=|<=|>=|=|<|>)\s*(.*?)\s*$')
+
+def _as_number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+class ColumnPredicate(object):
+    """
+    A simple comparison of a named column against a constant, parsed from strings
+    like 'correct=True' or 'response_time_ms<2000'. Values that both parse as numbers
+    are compared numerically; everything else is compared as strings.
+    """
+    def __init__(self, expression):
+        m = _predicate_re.match(expression)
+        if not m:
+            raise ValueError(f'Could not parse predicate "{expression}". Expected something like "column=value" or "column<value".')
+        self.column, op, self.value = m.groups()
+        self.expression = expression
+        self._op = PREDICATE_OPS[op]
+        self._num_value = _as_number(self.value)
+
+    def __call__(self, value):
+        if self._num_value is not None:
+            num = _as_number(value)
+            if num is not None:
+                return self._op(num, self._num_value)
+        return self._op(value, self.value)
+
+def parse_run_range(run_range):
+    """Parses '3' or '1-4' into an inclusive (low, high) tuple of ints."""
+    parts = run_range.split('-')
+    if len(parts) == 1 and parts[0].isdigit():
+        return (int(parts[0]), int(parts[0]))
+    if len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
+        return (int(parts[0]), int(parts[1]))
+    raise ValueError(f'Could not parse run range "{run_range}". Expected something like "2" or "1-4".')
+
+class CombineFilter(object):
+    """
+    Filters applied while task files are being combined.
+
+    subjects, conditions, sessions, runs and shard are checked against the metadata in each
+    task file's name, so files that can't contain matching rows are never downloaded or read.
+    columns (a projection) and predicates are applied row by row as the files are streamed.
+    """
+    def __init__(self, subjects=None, conditions=None, sessions=None, runs=None, columns=None, predicates=None, shard=None):
+        self.subjects = set(subjects) if subjects else None
+        self.conditions = set(conditions) if conditions else None
+        self.sessions = set(sessions) if sessions else None
+        self.runs = runs # inclusive (low, high) tuple
+        self.columns = list(columns) if columns else None
+        self.predicates = [ColumnPredicate(p) if isinstance(p, str) else p for p in (predicates or [])]
+        self.shard = shard # (i, N) tuple from sharding.parse_shard
+
+    def has_row_filters(self):
+        return self.columns is not None or len(self.predicates) > 0
+
+    def accepts_file(self, human_id, hashed_id, condition, sess, run):
+        """
+        human_id and hashed_id are both checked against the subject list, so either may be used there.
+        condition is the participant's real condition ('F' or 'P'), not the randomized letter.
+        run is the run number from the file name, or 'n/a' for single-run tasks.
+        """
+        if self.subjects is not None and human_id not in self.subjects and hashed_id not in self.subjects:
+            return False
+        if self.conditions is not None and condition not in self.conditions:
+            return False
+        if self.shard is not None and not in_shard(human_id, self.shard):
+            return False
+        if self.sessions is not None and sess not in self.sessions:
+            return False
+        if self.runs is not None:
+            if not run.isdigit(): return False
+            if not self.runs[0] <= int(run) <= self.runs[1]: return False
+        return True
+
+    def bind(self, header):
+        """
+        Returns (output_header, transform) for task files with the given header.
+        transform takes a row and returns the (projected) row to write, or None if the row should be dropped.
+        """
+        def index_of(col):
+            try:
+                return header.index(col)
+            except ValueError:
+                raise ValueError(f'Column "{col}" is not in the task file header. Available columns: {", ".join(header)}')
+
+        checks = [(index_of(p.column), p) for p in self.predicates]
+        if self.columns is None:
+            out_header = header
+            indices = None
+        else:
+            out_header = self.columns
+            indices = [index_of(col) for col in self.columns]
+
+        def transform(row):
+            for (idx, pred) in checks:
+                if not pred(row[idx] if idx < len(row) else ''):
+                    return None
+            if indices is None:
+                return row
+            return [row[idx] if idx < len(row) else '' for idx in indices]
+
+        return (out_header, transform)
@@ -0,0 +1,102 @@
+"""
+Merging of the outputs of several combine-cog-files.py --shard runs.
+
+Each shard's output has the same layout as an unsharded run's, just with a
+subset of the subjects, so merging is concatenation: the header is written
+once and every shard's rows follow, in the order the inputs are given. nBack
+outputs can have different headers in different shards (each shard pads to the
+longest header among its own files), so when headers differ rows are matched
+to the longest header by column name and missing columns are left empty.
+
+Shards only produce consistent condition letters if they were all run with
+the same --condition-seed.
+"""
+import csv
+import json
+import os
+from pathlib import Path
+import shutil
+from .compressed_io import open_input, open_output, strip_compression_suffix, with_compression_suffix
+
+PARTITION_INDEX_FILE = 'index.json'
+
+def _read_header(path):
+    with open_input(path, newline='') as f:
+        return next(csv.reader(f, delimiter='\t'), None)
+
+def merge_combined_files(input_files, output_file, compression=None):
+    """Merges combined .tsv files (optionally compressed) into output_file."""
+    headers = [_read_header(path) for path in input_files]
+    inputs = [(path, header) for (path, header) in zip(input_files, headers) if header is not None] # skip empty outputs
+    if not inputs:
+        raise ValueError('None of the files to merge have a header.')
+    out_header = max((header for (_, header) in inputs), key=len)
+
+    if all(header == out_header for (_, header) in inputs):
+        with open_output(output_file, compression, mode='wb') as outfile:
+            for (idx, (path, _)) in enumerate(inputs):
+                with open_input(path, mode='rb') as infile:
+                    header_line = infile.readline()
+                    if idx == 0:
+                        outfile.write(header_line)
+                    shutil.copyfileobj(infile, outfile)
+        return
+
+    positions = {col: idx for (idx, col) in reversed(list(enumerate(out_header)))}
+    for (path, header) in inputs:
+        missing = [col for col in header if col not in positions]
+        if missing:
+            raise ValueError(f'{path} has columns that are not in the longest header ({", ".join(missing)}), so it cannot be merged with the other files.')
+    with open_output(output_file, compression, newline='') as outfile:
+        writer = csv.writer(outfile, delimiter='\t')
+        writer.writerow(out_header)
+        for (path, header) in inputs:
+            if header == out_header:
+                mapping = None
+            else:
+                mapping = [positions[col] for col in header]
+            with open_input(path, newline='') as infile:
+                reader = csv.reader(infile, delimiter='\t')
+                next(reader)
+                for row in reader:
+                    if mapping is not None:
+                        out_row = [''] * len(out_header)
+                        for (value, pos) in zip(row, mapping):
+                            out_row[pos] = value
+                        row = out_row
+                    writer.writerow(row)
+
+def merge_partitioned(input_dirs, output_dir, compression=None):
+    """
+    Merges directories written by combine_task_files_partitioned (with the same partition_by) into output_dir,
+    merging the files for each partition and writing a combined index. Returns the index.
+    """
+    indexes = []
+    for input_dir in input_dirs:
+        with open(Path(input_dir) / PARTITION_INDEX_FILE) as f:
+            indexes.append(json.load(f))
+    partition_by = indexes[0]['partition_by']
+    for (input_dir, index) in zip(input_dirs, indexes):
+        if index['partition_by'] != partition_by:
+            raise ValueError(f'{input_dir} is partitioned by {index["partition_by"]}, not {partition_by}.')
+
+    partitions = {} # partition values -> merged index entry
+    sources = {} # partition values -> [input file, ...]
+    for (input_dir, index) in zip(input_dirs, indexes):
+        for part in index['partitions']:
+            values = tuple(part['values'][col] for col in partition_by)
+            path = with_compression_suffix(strip_compression_suffix(part['path']), compression).as_posix()
+            entry = partitions.setdefault(values, {'path': path, 'values': part['values'], 'files': 0, 'rows': 0})
+            entry['files'] += part['files']
+            entry['rows'] += part['rows']
+            sources.setdefault(values, []).append(Path(input_dir) / part['path'])
+
+    for (values, files) in sources.items():
+        output_file = Path(output_dir) / partitions[values]['path']
+        os.makedirs(output_file.parent, exist_ok=True)
+        merge_combined_files(files, output_file, compression)
+
+    merged = {'partition_by': partition_by, 'compression': compression, 'partitions': [partitions[values] for values in sorted(partitions)]}
+    with open(Path(output_dir) / PARTITION_INDEX_FILE, 'w') as f:
+        json.dump(merged, f, indent=2)
+    return merged
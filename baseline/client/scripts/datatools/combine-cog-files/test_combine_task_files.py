@@ -0,0 +1,53 @@
+# Checks that combine_task_files_fast writes exactly the same bytes as the csv-parsing path
+# (combine_task_files_csv without a filter) on randomly generated task files. The files are written with
+# csv.writer the way TsvTransformer writes them, including values with tabs, quotes and line breaks in
+# them, which the writer quotes.
+# python -m pytest test_combine_task_files.py
+
+import csv
+import importlib.util
+from pathlib import Path
+import random
+
+import pytest
+
+spec = importlib.util.spec_from_file_location('combine_cog_files_script', Path(__file__).parent / 'combine-cog-files.py')
+combine = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(combine)
+
+PLAIN_VALUES = ['', '0', '1.5', 'n/a', 'True', 'False', 'abc', '<p>Press the space bar</p>', ' a b ', 'x=1;y=2', "it's"]
+QUOTED_VALUES = ['a\tb', 'line 1\nline 2', 'line 1\r\nline 2', 'he said "hi"', '"', 'x\ry', '\n', '\r', 'a\n\n"b"']
+
+def _value(rng):
+    return rng.choice(QUOTED_VALUES) if rng.random() < 0.2 else rng.choice(PLAIN_VALUES)
+
+def _write_task_file(path, rng):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(['trial_index', 'is_relevant', 'stimulus', 'response'])
+        for idx in range(rng.randrange(0, 20)):
+            trial_index = rng.choice([str(idx), str(idx), _value(rng)])
+            is_relevant = rng.choice(['True', 'False', _value(rng)])
+            writer.writerow([trial_index, is_relevant] + [_value(rng) for _ in range(rng.randrange(1, 4))])
+
+def _task_files(rng, tmp_path):
+    paths = []
+    for idx in range(rng.randrange(1, 4)):
+        run = f'_run-{idx + 1}' if rng.random() < 0.5 else ''
+        path = tmp_path / f'sub-S{idx}_ses-{rng.choice(["pre", "post"])}_task-flanker{run}_beh.tsv'
+        _write_task_file(path, rng)
+        paths.append(path)
+    return paths
+
+@pytest.mark.parametrize('seed', range(1000))
+def test_fast_path_matches_csv_path(seed, tmp_path):
+    rng = random.Random(seed)
+    task_files = _task_files(rng, tmp_path)
+    include_all = rng.random() < 0.5
+    user_map = {combine.hash_subject('S0'): 'F', combine.hash_subject('S1'): 'P'}
+    condition_map = combine.make_condition_map(seed)
+
+    csv_rows = combine.combine_task_files_csv(task_files, tmp_path / 'csv.tsv', include_all, user_map, condition_map)
+    fast_rows = combine.combine_task_files_fast(task_files, tmp_path / 'fast.tsv', include_all, user_map, condition_map)
+    assert (tmp_path / 'fast.tsv').read_bytes() == (tmp_path / 'csv.tsv').read_bytes()
+    assert fast_rows == csv_rows
@@ -0,0 +1,78 @@
+"""
+Helpers for reading and writing optionally-compressed data files.
+
+Output compression is chosen explicitly (None, 'gzip' or 'zstd'); input
+compression is detected from the file's magic bytes, so readers never need
+to be told how a file was written. zstd support needs the `zstandard`
+package, which is only imported when a zstd file is actually used.
+
+This is the only copy: cog-to-flywheel/compressed_io.py and
+combine-cog-files/combine_cog_files/compressed_io.py are symlinks to it, so
+that every tool writes the same suffixes at the same compression levels.
+"""
+import gzip
+from pathlib import Path
+
+COMPRESSIONS = ('gzip', 'zstd')
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+GZIP_LEVEL = 6 # gzip's default of 9 is much slower for very little gain on our files
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError('zstd compression requires the zstandard package (pip install zstandard)')
+    return zstandard
+
+def with_compression_suffix(path, compression):
+    """Returns path with the file suffix for the given compression appended."""
+    path = Path(path)
+    if not compression:
+        return path
+    if compression not in SUFFIXES:
+        raise ValueError(f'Unsupported compression {compression}. Expected one of {COMPRESSIONS}.')
+    return path.with_name(path.name + SUFFIXES[compression])
+
+def strip_compression_suffix(path):
+    """Returns path without a trailing .gz or .zst suffix."""
+    path = Path(path)
+    if path.suffix in SUFFIXES.values():
+        return path.with_suffix('')
+    return path
+
+def detect_compression(path):
+    """Returns 'gzip', 'zstd' or None based on the first bytes of the file."""
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic == ZSTD_MAGIC:
+        return 'zstd'
+    return None
+
+def _open(path, compression, mode, encoding, newline):
+    if 'b' in mode:
+        encoding = None
+        newline = None
+    if compression == 'gzip':
+        if 'w' in mode:
+            return gzip.open(path, mode, compresslevel=GZIP_LEVEL, encoding=encoding, newline=newline)
+        return gzip.open(path, mode, encoding=encoding, newline=newline)
+    if compression == 'zstd':
+        return _zstandard().open(path, mode, encoding=encoding, newline=newline)
+    if compression:
+        raise ValueError(f'Unsupported compression {compression}. Expected one of {COMPRESSIONS}.')
+    return open(path, mode, encoding=encoding, newline=newline)
+
+def open_output(path, compression=None, mode='wt', encoding='utf-8', newline=None):
+    """
+    Opens path for streaming writes, compressing with the given compression.
+    Callers are responsible for adding the compression suffix to path (see with_compression_suffix).
+    """
+    return _open(path, compression, mode, encoding, newline)
+
+def open_input(path, mode='rt', encoding='utf-8', newline=None):
+    """Opens path for streaming reads, transparently decompressing gzip and zstd files."""
+    return _open(path, detect_compression(path), mode, encoding, newline)
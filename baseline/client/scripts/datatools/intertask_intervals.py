@@ -1,49 +1,130 @@
+import csv
+import statistics
+import numpy as np
+from time_columns import parse_iso, whole_seconds_between
+
 class IntertaskIntervals:
     START_KEY = 'sk'
     END_KEY = 'ek'
     SET_KEY = 'set'
-    
-    def __init__(self):
+    # notes for records missing a time. Each interval runs from the end of from_task to the start of to_task,
+    # so an interval without a start is one whose from_task has no end time, and vice versa.
+    NO_START = "N/A - no end time for {from_task}"
+    NO_END = "N/A - no start time for {to_task}"
+    CSV_FIELDS = ["user_id", "set_num", "interval_secs", "note"]
+    SUMMARY_FIELDS = ["user_id", "intervals", "missing", "min_secs", "max_secs", "mean_secs", "median_secs"]
+
+    def __init__(self, from_task, to_task):
+        """from_task and to_task are the experiments the intervals are between, named in the notes for missing times."""
+        self.from_task = from_task
+        self.to_task = to_task
+        # user id -> {set number -> record}, with each user's sets in the order they were first seen
         self.user_dict = {}
 
     def set_set(self, user_id, set):
-        user_recs = self.user_dict.get(user_id, [])
+        user_recs = self.user_dict.setdefault(user_id, {})
         # if we don't already have an entry with this set number, add it
         # if we do have one, do nothing
-        if len(list(filter(lambda x: x[self.SET_KEY] == set, user_recs))) == 0:
-            user_recs.append({self.SET_KEY: set}) 
-            self.user_dict[user_id] = user_recs
+        if set not in user_recs:
+            user_recs[set] = {self.SET_KEY: set}
 
     def set_start_time(self, user_id, start_time):
-        user_rec = self.user_dict[user_id][-1]
+        # the start time belongs to the most recently added set
+        user_rec = next(reversed(self.user_dict[user_id].values()))
         user_rec[self.START_KEY] = start_time
 
     def set_end_time(self, user_id, set, end_time):
         user_recs = self.user_dict.get(user_id, False)
         if not user_recs:
             raise AssertionError
-        
-        rec_for_set = list(filter(lambda x: x[self.SET_KEY] == set, user_recs))
-        if len(rec_for_set) != 1:
+
+        user_rec = user_recs.get(set)
+        if user_rec is None:
             raise AssertionError
-        
-        user_rec = rec_for_set[0]
+
         user_rec[self.END_KEY] = end_time
 
+    def rows(self):
+        """
+        Yields (user_id, set number, interval) for every record, where interval is the number
+        of whole seconds from start to end, or a string saying which time is missing.
+        Start and end times may be datetimes or ISO 8601 strings; they're parsed and
+        subtracted for all records at once (see time_columns).
+        """
+        records = [(user_id, rec) for (user_id, user_recs) in self.user_dict.items() for rec in user_recs.values()]
+        starts = parse_iso([rec.get(self.START_KEY) or None for (_, rec) in records])
+        ends = parse_iso([rec.get(self.END_KEY) or None for (_, rec) in records])
+        secs = whole_seconds_between(starts, ends)
+        for ((user_id, rec), st, et, interval_secs) in zip(records, np.isnat(starts), np.isnat(ends), secs):
+            if st:
+                interval_secs = self.NO_START.format(from_task=self.from_task)
+            elif et:
+                interval_secs = self.NO_END.format(to_task=self.to_task)
+            else:
+                interval_secs = int(interval_secs)
+            yield (user_id, rec[self.SET_KEY], interval_secs)
+
+    def write_csv(self, f, delimiter=","):
+        """
+        Writes one row per record to the text file f (opened with newline=""), with an empty
+        interval_secs and a note for records missing a time. Use delimiter="\\t" for tsv.
+        Returns the number of rows written.
+        """
+        writer = csv.writer(f, delimiter=delimiter)
+        writer.writerow(self.CSV_FIELDS)
+        count = 0
+        for (user_id, set, interval_secs) in self.rows():
+            if isinstance(interval_secs, int):
+                writer.writerow([user_id, set, interval_secs, ""])
+            else:
+                writer.writerow([user_id, set, "", interval_secs])
+            count += 1
+        return count
+
+    @staticmethod
+    def _stats(label, intervals, missing):
+        if not intervals:
+            return {"user_id": label, "intervals": 0, "missing": missing,
+                "min_secs": None, "max_secs": None, "mean_secs": None, "median_secs": None}
+        return {"user_id": label, "intervals": len(intervals), "missing": missing,
+            "min_secs": min(intervals), "max_secs": max(intervals),
+            "mean_secs": statistics.fmean(intervals), "median_secs": statistics.median(intervals)}
+
+    def summary(self, per_user=True):
+        """
+        Returns a list of summary statistics dicts (see SUMMARY_FIELDS): one per user if per_user
+        is true, followed by one for the whole cohort with a user_id of "ALL".
+        missing counts the records without both a start and end time.
+        """
+        result = []
+        all_intervals = []
+        all_missing = 0
+        current_user = None
+        intervals = []
+        missing = 0
+        for (user_id, _, interval_secs) in self.rows():
+            if user_id != current_user:
+                if per_user and current_user is not None:
+                    result.append(self._stats(current_user, intervals, missing))
+                current_user = user_id
+                intervals = []
+                missing = 0
+            if isinstance(interval_secs, int):
+                intervals.append(interval_secs)
+                all_intervals.append(interval_secs)
+            else:
+                missing += 1
+                all_missing += 1
+        if per_user and current_user is not None:
+            result.append(self._stats(current_user, intervals, missing))
+        result.append(self._stats("ALL", all_intervals, all_missing))
+        return result
+
+    def write_summary_csv(self, f, per_user=True, delimiter=","):
+        writer = csv.DictWriter(f, fieldnames=self.SUMMARY_FIELDS, delimiter=delimiter)
+        writer.writeheader()
+        for row in self.summary(per_user):
+            writer.writerow(row)
+
     def __str__(self):
-        result = ""
-        for (user_id, rec_list) in self.user_dict.items():
-            for rec in rec_list:
-                st = rec.get(self.START_KEY, False)
-                et = rec.get(self.END_KEY, False)
-
-                interval_secs = "N/A"
-                if not st:
-                    interval_secs = "N/A - no start time"
-                elif not et:
-                    interval_secs = "N/A - no end time"
-                else:
-                    interval_secs = int((et - st).total_seconds())
-                result += f"{user_id}, {rec[self.SET_KEY]}, {interval_secs}\n"
-        
-        return result
\ No newline at end of file
+        return "".join(f"{user_id}, {set}, {interval_secs}\n" for (user_id, set, interval_secs) in self.rows())
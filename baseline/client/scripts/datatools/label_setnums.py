@@ -1,52 +1,154 @@
-def label_setnums(trials):
+import json
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+import tempfile
+from compressed_io import open_output
+from trial_archive import open_trials
+from trial_stream import iter_trials, with_required_fields
+
+
+def iter_labeled_setnums(trials):
     """
-    Modify the trials list argument to have a setNum key-value pair on each trial."""
-    latest_trial_by_user = {}  # mapping of user IDs to their most recent trial
-    for t in trials:
-        # check for missing fields
-        user = t.get("userId")
-        if not user:
-            raise AssertionError("trial missing userId")
-        dt = t.get("dateTime")
-        if not dt:
-            raise AssertionError("trial missing dateTime")
-        # guarantee that the ordering of trials is consistent with the dateTime values
-        last = latest_trial_by_user.get(user)
-        if last and dt < last["dateTime"]:
-            raise AssertionError("trial later in list has earlier dateTime")
+    Yield each trial in trials after giving it a setNum key-value pair, so trials
+    can be labeled while they are read and written out soon after they're read.
+    Only the latest dateTime and setNum of each user are kept."""
+    # imported here so that the rest of this module (e.g. write_trials) can be used without numpy,
+    # which nothing declares as a dependency of label_setnums.py
+    from time_columns import iter_in_user_order
+    latest_by_user = {}  # mapping of user IDs to the setNum of their most recent trial
+    # guarantee that the ordering of trials is consistent with the dateTime values
+    # (checked in batches, a column of dateTimes at a time; see time_columns)
+    for t in iter_in_user_order(with_required_fields(trials)):
+        user = t["userId"]
         # add value for setNum to trials with falsy taskStarted (non-set-header trials)
         if not t.get("taskStarted"):
             if t.get("setNum"):
                 raise AssertionError("trial with falsy taskStarted already has value for setNum")
-            elif not last:
+            elif user not in latest_by_user:
                 raise AssertionError("trial with falsy taskStarted has no preceding taskStarted")
-            t["setNum"] = last["setNum"]
-        # update latest_trial_by_user
-        latest_trial_by_user[user] = t
+            elif latest_by_user[user] is None:
+                raise AssertionError("trial with falsy taskStarted follows a trial with no setNum")
+            t["setNum"] = latest_by_user[user]
+        # update latest_by_user
+        latest_by_user[user] = t.get("setNum")
+        yield t
+
+
+def label_setnums(trials):
+    """
+    Modify the trials list argument to have a setNum key-value pair on each trial."""
+    for _ in iter_labeled_setnums(trials):
+        pass
+
+
+def write_trials(trials, f, ndjson = False):
+    """
+    Write trials to the text file f one at a time, either as a JSON array (formatted
+    the same way as json.dump) or as NDJSON. Return the number of trials written."""
+    count = 0
+    if ndjson:
+        for t in trials:
+            f.write(json.dumps(t))
+            f.write("\n")
+            count += 1
+        return count
+    f.write("[")
+    for t in trials:
+        if count:
+            f.write(", ")
+        f.write(json.dumps(t))
+        count += 1
+    f.write("]")
+    return count
+
+
+def _partition_for(user, partitions):
+    # crc32 rather than hash() so that the partitioning doesn't depend on PYTHONHASHSEED
+    return zlib.crc32(user.encode("utf-8")) % partitions
+
+
+def partition_trials_by_user(trials, directory, partitions):
+    """
+    Split trials into NDJSON files in directory so that all of each user's trials are
+    in the same file, in their original order. Return the paths of the files."""
+    paths = [os.path.join(directory, f"part-{i}.ndjson") for i in range(partitions)]
+    files = [open(p, "w", encoding = "utf-8") for p in paths]
+    try:
+        for t in trials:
+            user = t.get("userId")
+            if not user:
+                raise AssertionError("trial missing userId")
+            f = files[_partition_for(user, partitions)]
+            f.write(json.dumps(t))
+            f.write("\n")
+    finally:
+        for f in files:
+            f.close()
+    return paths
+
+
+def _label_partition(ipath, opath):
+    with open(opath, "w", encoding = "utf-8") as f:
+        return write_trials(iter_labeled_setnums(iter_trials(ipath)), f, ndjson = True)
+
+
+def label_setnums_parallel(trials, f, jobs, ndjson = False):
+    """
+    Label trials in parallel by partitioning them by userId and labeling the partitions
+    in separate processes, then write them to the text file f (see write_trials).
+    Each user's trials keep their relative order, but trials from different users are
+    grouped by partition rather than interleaved as in the input.
+    Return the number of trials written."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ipaths = partition_trials_by_user(trials, tmpdir, jobs)
+        opaths = [p + ".labeled" for p in ipaths]
+        with ProcessPoolExecutor(max_workers = jobs) as executor:
+            for _ in executor.map(_label_partition, ipaths, opaths):
+                pass
+        return write_trials(chain.from_iterable(iter_trials(p) for p in opaths), f, ndjson)
 
 
 if __name__ == "__main__":
     import argparse
-    import json
+    import contextlib
     import pathlib
+    from compressed_io import COMPRESSIONS, SUFFIXES, with_compression_suffix
 
     def _parse_args():
-        parser = argparse.ArgumentParser()
-        parser.add_argument("ijsonfile", type = pathlib.Path)
+        parser = argparse.ArgumentParser(description = "Reads and writes trials one at a time, so memory use doesn't depend on the size of the export.")
+        parser.add_argument("ijsonfile", type = pathlib.Path, help = "JSON array or NDJSON; may be gzip or zstd compressed")
         parser.add_argument("ojsonfile", type = pathlib.Path)
+        parser.add_argument("--compress", choices = COMPRESSIONS, help = "compress the output file")
+        parser.add_argument("--ndjson", action = "store_true", help = "write NDJSON (one trial per line) instead of a JSON array")
+        parser.add_argument("--user", help = "only label (and write) this userId's trials; fast for indexed archives (see trial_archive.py)")
+        parser.add_argument("-j", "--jobs", type = int, default = 1,
+            help = "partition the trials by userId and label the partitions in this many processes. "
+                   "Trials from different users will be grouped by partition in the output.")
         args = parser.parse_args()
-        return args.ijsonfile, args.ojsonfile
-
-    def _main(ijsonfile, ojsonfile):
-        # read from file
-        itext = ijsonfile.read_text()
-        # load JSON as trials list
-        trials = json.loads(itext)
-        # add setNum key-value pairs
-        label_setnums(trials)
-        # output trials list as JSON
-        otext = json.dumps(trials)
-        # write to file
-        ojsonfile.write_text(otext)
+        if args.jobs < 1:
+            parser.error("--jobs must be at least 1")
+        return args.ijsonfile, args.ojsonfile, args.compress, args.ndjson, args.jobs, args.user
+
+    def _main(ijsonfile, ojsonfile, compression, ndjson, jobs, user_id):
+        if compression and ojsonfile.suffix != SUFFIXES[compression]:
+            ojsonfile = with_compression_suffix(ojsonfile, compression)
+        # stream trials from the input file, add setNum key-value pairs and write them out.
+        # they're written to a temporary file next to ojsonfile that only replaces it once every trial
+        # is labeled, so that a bad input file doesn't leave a truncated ojsonfile behind
+        tmp_path = ojsonfile.with_name(ojsonfile.name + ".partial")
+        try:
+            with open_output(tmp_path, compression) as f:
+                if jobs > 1:
+                    label_setnums_parallel(open_trials(ijsonfile, user_id), f, jobs, ndjson)
+                else:
+                    write_trials(iter_labeled_setnums(open_trials(ijsonfile, user_id)), f, ndjson)
+            os.replace(tmp_path, ojsonfile)
+        except BaseException:
+            # open_output may have failed before creating tmp_path (e.g. a missing output directory)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
 
     _main(*_parse_args())
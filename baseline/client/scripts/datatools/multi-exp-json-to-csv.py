@@ -1,43 +1,103 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
 import csv
-import json
+import glob
+import os
 from pathlib import Path
+import sys
+import time
+from compressed_io import COMPRESSIONS, open_output, strip_compression_suffix, with_compression_suffix
+from trial_archive import open_trials
 
 timeline = ""
 
-def extract(transform, path_str):
+def _csv_path(path, label, compression):
+    out_path = strip_compression_suffix(path)
+    suffix = f".{label}.csv" if label else ".csv"
+    return with_compression_suffix(out_path.with_suffix(out_path.suffix + suffix), compression)
+
+def _csv_writer(csvfile, fieldnames):
+    return csv.DictWriter(
+        csvfile,
+        fieldnames = fieldnames,
+        restval = "",
+        extrasaction = "raise",
+        dialect = csv.unix_dialect,
+    )
+
+# Each extractor (physical_activity, demographics, etc.) returns a tuple of
+# (fieldnames, f, g), where f(trial) returns True for the trials it wants
+# and g(trial) turns one of those trials into a csv row.
+
+# compression may be None, "gzip" or "zstd"; compressed input files are detected automatically
+# The input may be a JSON array or NDJSON. Trials are streamed from the file through the extractor's
+# filter and row builder to the csv writer one at a time, so memory use doesn't depend on the file size.
+# If user_id is given, only that user's trials are extracted; see trial_archive.open_trials.
+# Returns the number of rows written.
+def extract(extractor, path_str, compression=None, user_id=None):
    # print(f"extracting from {path_str}...")
     path = Path(path_str)
-    timeline = json.loads(path.read_text("utf-8"))
-    fieldnames, unfiltered_rows = transform(timeline)
-    rows = common_filter(unfiltered_rows)
-    with path.with_suffix(path.suffix + ".csv").open("w") as csvfile:
-        writer = csv.DictWriter(
-            csvfile,
-            fieldnames = fieldnames,
-            restval = "",
-            extrasaction = "raise",
-            dialect = csv.unix_dialect,
-        )
+    fieldnames, f, g = extractor()
+    rows = common_filter(map(g, filter(f, open_trials(path, user_id))))
+    row_count = 0
+    with open_output(_csv_path(path, None, compression), compression, newline="") as csvfile:
+        writer = _csv_writer(csvfile, fieldnames)
         writer.writeheader()
         for r in rows:
             writer.writerow(r)
+            row_count += 1
+    return row_count
 
-def common_filter(rows):
-    return tuple(
-        r for r in rows
-        if (
-            r.get("isRelevant", False) 
-            #and
-            #r.get("userId") in {
-            #    "7c5e2833-2bad-4b9f-b953-692d4c7542ae",
-            #    "e074b8d8-ea58-4db7-b6fe-040167568a9d",
-            #    "90f515d4-429b-4270-b2fa-d221603723d7",
-            #    "b1dd4d4e-c8fe-4f61-ab59-85c12a710fdb",
-            #}
-        )
+# Like extract, but for an export containing trials from several experiments.
+# Each trial is routed by its "experiment" field to the matching extractor (see EXPERIMENT_EXTRACTORS)
+# and written to a csv file for that experiment (e.g. export.json.panas.csv), so that every csv
+# is written from a single pass over the export. Trials from experiments without an extractor are skipped.
+# Returns a dict of experiment name -> number of rows written.
+def extract_all(path_str, compression=None, experiments=None, user_id=None):
+    path = Path(path_str)
+    handlers = {} # experiment -> (f, g, writer), created the first time we see the experiment
+    row_counts = {}
+    with contextlib.ExitStack() as stack:
+        for trial in open_trials(path, user_id):
+            experiment = trial.get("experiment")
+            handler = handlers.get(experiment)
+            if handler is None:
+                if experiment not in EXPERIMENT_EXTRACTORS or (experiments and experiment not in experiments):
+                    continue
+                fieldnames, f, g = EXTRACTORS[EXPERIMENT_EXTRACTORS[experiment]]()
+                csvfile = stack.enter_context(open_output(_csv_path(path, experiment, compression), compression, newline=""))
+                writer = _csv_writer(csvfile, fieldnames)
+                writer.writeheader()
+                handler = (f, g, writer)
+                handlers[experiment] = handler
+                row_counts[experiment] = 0
+
+            f, g, writer = handler
+            if f(trial):
+                row = g(trial)
+                if is_common(row):
+                    writer.writerow(row)
+                    row_counts[experiment] += 1
+
+    return row_counts
+
+def is_common(r):
+    return (
+        r.get("isRelevant", False) 
+        #and
+        #r.get("userId") in {
+        #    "7c5e2833-2bad-4b9f-b953-692d4c7542ae",
+        #    "e074b8d8-ea58-4db7-b6fe-040167568a9d",
+        #    "90f515d4-429b-4270-b2fa-d221603723d7",
+        #    "b1dd4d4e-c8fe-4f61-ab59-85c12a710fdb",
+        #}
     )
 
-def physical_activity(timeline):
+def common_filter(rows):
+    return (r for r in rows if is_common(r))
+
+def physical_activity():
     fieldnames = (
         "isRelevant",
         "dateTime",
@@ -60,10 +120,11 @@ def physical_activity(timeline):
                 raise AssertionError
         return False
     
+    field_set = frozenset(fieldnames) # hashed lookups for g
     def g(trial):
         row = {}
         for key, value in trial.items():
-            if key in fieldnames:
+            if key in field_set:
                 row[key] = value
         for key in ("userId", "dateTime", "trial_type", "isRelevant"):
             if key not in trial:
@@ -72,9 +133,9 @@ def physical_activity(timeline):
         row.update(trial["response"])
         return row
     
-    return fieldnames, tuple(map(g, filter(f, timeline)))
+    return fieldnames, f, g
     
-def demographics(timeline):
+def demographics():
     fieldnames = (
         "asthma",
         "inhaler_med",
@@ -148,10 +209,11 @@ def demographics(timeline):
                 raise AssertionError
         return False
     
+    field_set = frozenset(fieldnames) # hashed lookups for g
     def g(trial):
         row = {}
         for key, value in trial.items():
-            if key in fieldnames:
+            if key in field_set:
                 row[key] = value
         for key in ("userId", "experiment", "dateTime", "trial_type", "isRelevant", "time_elapsed"):
             if key not in trial:
@@ -160,9 +222,9 @@ def demographics(timeline):
         row.update(trial["response"])
         return row
     
-    return fieldnames, tuple(map(g, filter(f, timeline)))
+    return fieldnames, f, g
 
-def pattern_separation(timeline):
+def pattern_separation():
     fieldnames = (
         "userId",
         "experiment",
@@ -188,19 +250,20 @@ def pattern_separation(timeline):
                 raise AssertionError
         return False
     
+    field_set = frozenset(fieldnames) # hashed lookups for g
     def g(trial):
         row = {}
         for key, value in trial.items():
-            if key in fieldnames:
+            if key in field_set:
                 row[key] = value
         for key in ("isRelevant", "isPractice", "isLearning", "isRecall"):
             if key not in trial:
                 row[key] = False
         
         return row
-    return fieldnames, tuple(map(g, filter(f, timeline)))
+    return fieldnames, f, g
 
-def face_name(timeline):
+def face_name():
     fieldnames = (
         "userId",
         "experiment",
@@ -229,10 +292,11 @@ def face_name(timeline):
             else:
                 raise AssertionError
         return False
+    field_set = frozenset(fieldnames) # hashed lookups for g
     def g(trial):
         row = {}
         for key, value in trial.items():
-            if key in fieldnames:
+            if key in field_set:
                 if key == "names":
                     row[key] = ",".join(value)
                 else:
@@ -241,9 +305,9 @@ def face_name(timeline):
             if key not in trial:
                 row[key] = False
         return row
-    return fieldnames, tuple(map(g, filter(f, timeline)))
+    return fieldnames, f, g
 
-def panas(timeline):
+def panas():
     fieldnames = (
         "userId",
         "experiment",
@@ -291,9 +355,9 @@ def panas(timeline):
             row[key] = trial[key]
         row.update(trial["response"])
         return row
-    return fieldnames, tuple(map(g, filter(f, timeline)))
+    return fieldnames, f, g
 
-def daily_stressors(timeline):
+def daily_stressors():
     fieldnames = (
         "userId",
         "experiment",
@@ -330,9 +394,9 @@ def daily_stressors(timeline):
         row.update(trial["response"])
         
         return row
-    return fieldnames, tuple(map(g, filter(f, timeline)))
+    return fieldnames, f, g
 
-def dass(timeline):
+def dass():
     fieldnames = (
         "userId",
         "experiment",
@@ -380,10 +444,10 @@ def dass(timeline):
             row[key] = trial[key]
         row.update(trial["response"])
         return row
-    return fieldnames, tuple(map(g, filter(f, timeline)))
+    return fieldnames, f, g
 
 
-def ffmq(timeline):
+def ffmq():
     fieldnames = (
         "userId",
         "experiment",
@@ -445,15 +509,134 @@ def ffmq(timeline):
             assert key in question_key
             row[question_key[key]] = value
         return row
-    return fieldnames, tuple(map(g, filter(f, timeline)))
+    return fieldnames, f, g
+
+# extractor names (as used on the command line) -> extractors
+EXTRACTORS = {
+    "physical-activity": physical_activity,
+    "demographics": demographics,
+    "pattern-separation": pattern_separation,
+    "face-name": face_name,
+    "panas": panas,
+    "daily-stressors": daily_stressors,
+    "dass": dass,
+    "ffmq": ffmq,
+}
 
+# values of the "experiment" field -> extractor names
+EXPERIMENT_EXTRACTORS = {
+    "physical-activity": "physical-activity",
+    "demographics": "demographics",
+    "pattern-separation-learning": "pattern-separation",
+    "pattern-separation-recall": "pattern-separation",
+    "face-name": "face-name",
+    "panas": "panas",
+    "daily-stressors": "daily-stressors",
+    "dass": "dass",
+    "ffmq": "ffmq",
+}
+
+EXPORT_SUFFIXES = (".json", ".ndjson", ".json.gz", ".ndjson.gz", ".json.zst", ".ndjson.zst")
+
+# Export files are named experiment.MM.DD.YYYY-HH.MM.SS.json (possibly with extra text after the time),
+# so the extractor for a file can be found from the part of its name before the first "."
+def extractor_name_for_file(path):
+    experiment = Path(path).name.split(".")[0]
+    return EXPERIMENT_EXTRACTORS.get(experiment)
+
+# Expands a list of directories and/or glob patterns to the (unique) export files they contain
+def find_export_files(dirs_or_globs):
+    result = {}
+    for dg in dirs_or_globs:
+        if os.path.isdir(dg):
+            candidates = sorted(str(p) for p in Path(dg).iterdir())
+        else:
+            candidates = sorted(glob.glob(dg))
+        for c in candidates:
+            if c.endswith(EXPORT_SUFFIXES) and os.path.isfile(c):
+                result[os.path.abspath(c)] = c
+    return list(result.values())
+
+# Runs in a worker process for batch_extract
+def _extract_file(path_str, compression, user_id):
+    name = extractor_name_for_file(path_str)
+    start = time.perf_counter()
+    rows = extract(EXTRACTORS[name], path_str, compression, user_id)
+    return (path_str, name, rows, time.perf_counter() - start)
+
+# Extracts every export file in dirs_or_globs, picking the extractor for each from its file name
+# and processing the files in parallel across up to max_workers processes.
+# Files whose names don't match an extractor are skipped. A file that fails doesn't stop the others.
+# Returns (results, failures): a list of (file path, extractor name, rows written, seconds taken) tuples,
+# one per file extracted, and a list of (file path, extractor name, error message), one per file that failed.
+def batch_extract(dirs_or_globs, compression=None, max_workers=None, user_id=None):
+    files = []
+    for path_str in find_export_files(dirs_or_globs):
+        if extractor_name_for_file(path_str):
+            files.append(path_str)
+        else:
+            print(f"Skipping {path_str}: no extractor for this experiment.")
+
+    results = []
+    failures = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_extract_file, f, compression, user_id) for f in files]
+        for (path_str, future) in zip(files, futures):
+            try:
+                results.append(future.result())
+            except Exception as err:
+                failures.append((path_str, extractor_name_for_file(path_str), f"{type(err).__name__}: {err}"))
+    return (results, failures)
+
+def print_batch_summary(results, failures, elapsed):
+    print("file, extractor, rows, seconds, rows/second")
+    for (path_str, name, rows, secs) in results:
+        print(f"{path_str}, {name}, {rows}, {secs:.2f}, {rows / secs if secs > 0 else 0:.0f}")
+    for (path_str, name, error) in failures:
+        print(f"{path_str}, {name}, FAILED: {error}")
+    total_rows = sum(r[2] for r in results)
+    print(f"Total: {len(results)} files, {total_rows} rows in {elapsed:.2f} seconds")
+    if failures:
+        print(f"{len(failures)} files failed")
+
+# Usage:
+# multi-exp-json-to-csv.py [--extractor name] [--experiments exp1 exp2 ...] [--compress gzip|zstd] [--user userId] export.json [export2.json ...]
+# multi-exp-json-to-csv.py --batch [--jobs n] [--compress gzip|zstd] [--user userId] dir_or_glob [dir_or_glob ...]
+# With --extractor, each export is run through that one extractor and written to export.json.csv.
+# Without it, each export may contain trials from any mix of experiments; they're routed by their
+# "experiment" field and written to one csv per experiment (export.json.<experiment>.csv) in a single pass.
+# With --batch, the arguments are directories or (quoted) glob patterns of timestamped exports; the
+# extractor for each file is chosen from its name, files are processed in parallel and a summary of
+# rows written and time taken per file is printed at the end. Files that fail are listed in the summary
+# and the exit status is 1 if there were any.
 if __name__ == "__main__":
-    extract(physical_activity, "physical-activity.03.20.2023-20.52.40with-setnums.json")
-  #   extract(pattern_separation, "pattern-separation-learning.02.19.2023-19.32.14.json")
-   #  extract(pattern_separation, "pattern-separation-recall.02.19.2023-19.32.19.json")
-   #  extract(face_name, "face-name.02.19.2023-19.31.31.json")
-   # extract(panas, "panas.02.19.2023-19.32.08.json")
-   #  extract(daily_stressors, "daily-stressors.02.19.2023-19.30.57.json")
-   #  extract(dass, "dass.02.19.2023-19.31.16.json")
-   #  extract(ffmq, "ffmq.02.19.2023-19.31.37.json")
-   #  extract(physical_activity, "physical-activity.02.19.2023-19.32.25.json")
+    def _parse_args():
+        parser = argparse.ArgumentParser()
+        parser.add_argument("exports", nargs="+", help="JSON or NDJSON export file(s), optionally gzip or zstd compressed. With --batch, directories or glob patterns.")
+        parser.add_argument("--batch", action="store_true", help="treat the arguments as directories or glob patterns, pick the extractor for each file from its name and process the files in parallel")
+        parser.add_argument("-j", "--jobs", type=int, help="number of worker processes to use with --batch (default: number of CPUs)")
+        parser.add_argument("-e", "--extractor", choices=EXTRACTORS.keys(), help="run every trial in the export(s) through this extractor rather than routing trials by experiment")
+        parser.add_argument("--experiments", nargs="+", choices=EXPERIMENT_EXTRACTORS.keys(), help="only write csv files for these experiments")
+        parser.add_argument("--compress", choices=COMPRESSIONS, help="compress the csv file(s)")
+        parser.add_argument("--user", help="only extract this userId's trials (fast for indexed archives; see trial_archive.py)")
+        return parser.parse_args()
+
+    def _main(args):
+        if args.batch:
+            start = time.perf_counter()
+            (results, failures) = batch_extract(args.exports, args.compress, args.jobs, args.user)
+            print_batch_summary(results, failures, time.perf_counter() - start)
+            if failures:
+                sys.exit(1)
+            return
+
+        for path in args.exports:
+            if args.extractor:
+                rows = extract(EXTRACTORS[args.extractor], path, args.compress, args.user)
+                print(f"{path}: {rows} {args.extractor} rows")
+            else:
+                row_counts = extract_all(path, args.compress, args.experiments, args.user)
+                for (experiment, rows) in row_counts.items():
+                    print(f"{path}: {rows} {experiment} rows")
+
+    _main(_parse_args())
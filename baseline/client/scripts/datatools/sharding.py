@@ -0,0 +1,25 @@
+# Assigns subjects to shards by a stable hash of their humanId, so that a sync can be spread over several
+# processes or hosts (cog-to-flywheel.py --shard i/N) without any coordination.
+#
+# This is the only copy: cog-to-flywheel/sharding.py and combine-cog-files/combine_cog_files/sharding.py are
+# symlinks to it, so that both tools' --shard options put every subject in the same shard.
+
+import zlib
+
+def parse_shard(shard):
+    """Parses 'i/N' into an (i, N) tuple of ints, where 0 <= i < N."""
+    parts = shard.split('/')
+    if len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
+        (index, count) = (int(parts[0]), int(parts[1]))
+        if 0 <= index < count:
+            return (index, count)
+    raise ValueError(f'Could not parse shard "{shard}". Expected something like "0/4" (shard 0 of 4; shards are numbered from 0).')
+
+def shard_for(human_id, shard_count):
+    # crc32 rather than hash() so that every process and host assigns subjects to the same shards
+    return zlib.crc32(human_id.encode('utf-8')) % shard_count
+
+def in_shard(human_id, shard):
+    """True if the subject with human_id belongs to shard, an (i, N) tuple from parse_shard."""
+    (index, count) = shard
+    return shard_for(human_id, count) == index
@@ -0,0 +1,190 @@
+"""
+Scoring for the spatial orientation task (SOT), for a whole cohort at once.
+
+load_sot_trials reads the spatial-orientation trials from any number of trial
+streams into NumPy arrays, and score groups them by any combination of user,
+set and session and computes, per group:
+ - the number of trials and how many were responded to, timed out or skipped
+ - the completion rate (responded / trials) and time limit hit rate (timed out / trials)
+ - the mean absolute angular error, in radians, between the target and the
+   response, wrapped to [0, pi] with atan2(sin, cos) (responded trials only)
+ - the mean response time in ms (responded trials only)
+
+Sessions follow the same rule as the Flywheel upload (RunData.get_session in
+cog-to-flywheel/tsv_transformer.py): sets 1-6 are 'pre', later sets are 'post'.
+setNum is carried forward from each user's set header trial, so the exports
+don't need to be labeled with label_setnums first.
+
+Usage:
+sot_scoring.py spatial-orientation.json [more.json ...] [--by user set] [-o scores.csv] [--all-trials] [--user userId]
+"""
+import csv
+import numpy as np
+
+COMPLETION_REASONS = ['responded', 'timedout', 'skipped']
+GROUP_COLUMNS = ['user', 'set', 'session']
+LAST_PRE_SESSION_SET = 6
+SCORE_FIELDS = ['trials', 'responded', 'timedout', 'skipped', 'completion_rate', 'time_limit_hit_rate',
+                'mean_abs_error_radians', 'mean_rt_ms']
+
+class SotTrials(object):
+    """Spatial orientation trials as parallel NumPy arrays, one element per trial."""
+    def __init__(self, user, set_num, target_radians, response_radians, completion, rt):
+        self.user = user # str
+        self.set_num = set_num # int, -1 if the trial came before any set header
+        self.target_radians = target_radians # float, NaN if missing
+        self.response_radians = response_radians # float, NaN if missing
+        self.completion = completion # int index into COMPLETION_REASONS, -1 for anything else
+        self.rt = rt # float ms, NaN if missing
+
+    def __len__(self):
+        return len(self.user)
+
+    @property
+    def session(self):
+        return np.where(self.set_num <= LAST_PRE_SESSION_SET, 'pre', 'post')
+
+    def column(self, name):
+        if name == 'user':
+            return self.user
+        if name == 'set':
+            return self.set_num
+        if name == 'session':
+            return self.session
+        raise ValueError(f'Unknown group column {name}. Expected one of {GROUP_COLUMNS}.')
+
+def _float_or_nan(value):
+    return float('nan') if value is None else value
+
+def load_sot_trials(trials, relevant_only=True):
+    """
+    Collects the spatial-orientation trials from trials (an iterable of trial dicts, e.g. from
+    trial_archive.open_trials) into a SotTrials. With relevant_only (the default), trials
+    without a true isRelevant (such as practice trials) are skipped.
+    """
+    set_num_by_user = {}
+    completion_codes = {reason: idx for (idx, reason) in enumerate(COMPLETION_REASONS)}
+    (user, set_num, target, response, completion, rt) = ([], [], [], [], [], [])
+    for t in trials:
+        if t.get('taskStarted'):
+            set_num_by_user[t.get('userId')] = t.get('setNum', -1)
+            continue
+        if t.get('trial_type') != 'spatial-orientation':
+            continue
+        if relevant_only and not t.get('isRelevant', False):
+            continue
+        user.append(t.get('userId'))
+        set_num.append(t.get('setNum') or set_num_by_user.get(t.get('userId'), -1))
+        target.append(_float_or_nan(t.get('targetRadians')))
+        response.append(_float_or_nan(t.get('responseRadians')))
+        completion.append(completion_codes.get(t.get('completionReason'), -1))
+        rt.append(_float_or_nan(t.get('rt')))
+
+    return SotTrials(
+        np.array(user, dtype=str),
+        np.array(set_num, dtype=np.int64),
+        np.array(target, dtype=np.float64),
+        np.array(response, dtype=np.float64),
+        np.array(completion, dtype=np.int8),
+        np.array(rt, dtype=np.float64),
+    )
+
+def angular_error(target_radians, response_radians):
+    """Absolute angular distance between target and response, wrapped to [0, pi]."""
+    diff = np.asarray(target_radians) - np.asarray(response_radians)
+    return np.abs(np.arctan2(np.sin(diff), np.cos(diff)))
+
+def _group(sot, by):
+    """Returns (keys, inverse): the unique key tuples for the by columns and each trial's index into them."""
+    if not by:
+        return ([()], np.zeros(len(sot), dtype=np.intp))
+    columns = [sot.column(name) for name in by]
+    (uniques, codes) = zip(*(np.unique(col, return_inverse=True) for col in columns))
+    (unique_codes, inverse) = np.unique(np.stack(codes, axis=1), axis=0, return_inverse=True)
+    keys = [tuple(uniques[col][code].item() for (col, code) in enumerate(row)) for row in unique_codes]
+    return (keys, inverse.reshape(-1))
+
+def _ratio(numerator, denominator):
+    return np.divide(numerator, denominator, out=np.full(len(numerator), np.nan), where=denominator > 0)
+
+def score(sot, by=('user', 'set')):
+    """
+    Scores sot grouped by the by columns (any of GROUP_COLUMNS; an empty by scores the whole cohort).
+    Returns a list of dicts, one per group in sorted key order, with the by columns and SCORE_FIELDS.
+    """
+    by = list(by)
+    (keys, inverse) = _group(sot, by)
+    n = len(keys)
+    if len(sot) == 0:
+        return []
+
+    def count(mask):
+        return np.bincount(inverse, weights=mask.astype(np.float64), minlength=n)
+
+    responded = sot.completion == 0
+    trials = np.bincount(inverse, minlength=n).astype(np.float64)
+    responded_count = count(responded)
+    timedout_count = count(sot.completion == 1)
+    skipped_count = count(sot.completion == 2)
+
+    error = angular_error(sot.target_radians, sot.response_radians)
+    has_error = responded & ~np.isnan(error)
+    error_sum = np.bincount(inverse, weights=np.where(has_error, error, 0.0), minlength=n)
+    has_rt = responded & ~np.isnan(sot.rt)
+    rt_sum = np.bincount(inverse, weights=np.where(has_rt, sot.rt, 0.0), minlength=n)
+
+    columns = {
+        'trials': trials.astype(np.int64),
+        'responded': responded_count.astype(np.int64),
+        'timedout': timedout_count.astype(np.int64),
+        'skipped': skipped_count.astype(np.int64),
+        'completion_rate': _ratio(responded_count, trials),
+        'time_limit_hit_rate': _ratio(timedout_count, trials),
+        'mean_abs_error_radians': _ratio(error_sum, count(has_error)),
+        'mean_rt_ms': _ratio(rt_sum, count(has_rt)),
+    }
+    results = []
+    for (idx, key) in enumerate(keys):
+        row = dict(zip(by, key))
+        for field in SCORE_FIELDS:
+            row[field] = columns[field][idx].item()
+        results.append(row)
+    return results
+
+def write_scores(scores, by, f, delimiter=','):
+    """Writes scores (from score) to the text file f (opened with newline=''), leaving NaNs empty."""
+    writer = csv.writer(f, delimiter=delimiter)
+    fields = list(by) + SCORE_FIELDS
+    writer.writerow(fields)
+    for row in scores:
+        writer.writerow(['' if isinstance(row[field], float) and np.isnan(row[field]) else row[field] for field in fields])
+
+if __name__ == '__main__':
+    import argparse
+    import contextlib
+    from itertools import chain
+    from pathlib import Path
+    import sys
+    from trial_archive import open_trials
+
+    def _parse_args():
+        parser = argparse.ArgumentParser(description='Scores spatial orientation trials for a whole cohort in one pass.')
+        parser.add_argument('exports', nargs='+', type=Path, help='JSON or NDJSON exports or trial archives, optionally gzip or zstd compressed')
+        parser.add_argument('--by', nargs='*', choices=GROUP_COLUMNS, default=['user', 'set'], help='columns to group by (default: user set). Give --by with no columns to score the whole cohort.')
+        parser.add_argument('-o', '--output', type=Path, help='write the scores to this file instead of stdout')
+        parser.add_argument('--format', choices=['csv', 'tsv'], help='output format (default: from the --output file suffix, otherwise csv)')
+        parser.add_argument('--all-trials', action='store_true', dest='all_trials', help='include trials that are not marked isRelevant (e.g. practice trials)')
+        parser.add_argument('--user', help='only score this userId (fast for indexed archives; see trial_archive.py)')
+        return parser.parse_args()
+
+    def _main(args):
+        trials = chain.from_iterable(open_trials(path, args.user, 'spatial-orientation') for path in args.exports)
+        sot = load_sot_trials(trials, relevant_only=not args.all_trials)
+        scores = score(sot, args.by)
+        format = args.format or ('tsv' if args.output and args.output.suffix == '.tsv' else 'csv')
+        with (open(args.output, 'w', newline='') if args.output else contextlib.nullcontext(sys.stdout)) as f:
+            write_scores(scores, args.by, f, '\t' if format == 'tsv' else ',')
+        if args.output:
+            print(f'Scored {len(sot)} trials in {len(scores)} groups', file=sys.stderr)
+
+    _main(_parse_args())
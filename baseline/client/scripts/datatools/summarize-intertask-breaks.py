@@ -1,16 +1,51 @@
 import argparse
-import json
-from datetime import datetime
+import contextlib
+import csv
+import heapq
+import sys
 from pathlib import Path
+from typing import Optional
 from intertask_intervals import IntertaskIntervals
+from time_columns import iter_in_user_order, parse_iso, whole_seconds_between
+from trial_archive import open_trials
+from trial_stream import with_required_fields
 
-def parse_args() -> tuple[str, Path, Path]:
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-t", "--task", required=True, choices=["pattern-separation", "verbal-learning"])
-    parser.add_argument("learning_json_file", type = Path)
-    parser.add_argument("recall_json_file", type = Path)
-    args = parser.parse_args()
-    return args.task, args.learning_json_file, args.recall_json_file
+# learning/recall pairs reported by --merge when no --pair is given
+DEFAULT_TASK_PAIRS = [
+    ("pattern-separation-learning", "pattern-separation-recall"),
+    ("verbal-learning-learning", "verbal-learning-recall"),
+]
+MERGE_FIELDS = ["user_id", "set_num", "kind", "from_task", "to_task", "interval_secs", "note"]
+
+def _task_pair(value: str) -> tuple[str, str]:
+    parts = value.split(":")
+    if len(parts) != 2 or not all(parts):
+        raise argparse.ArgumentTypeError(f"expected FROM_EXPERIMENT:TO_EXPERIMENT, got {value}")
+    return (parts[0], parts[1])
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description = "With -t, reports the time from the end of learning to the start of recall for one task, "
+                      "given its learning and recall exports. With --merge, reads any number of exports in one "
+                      "merged pass and reports the gaps between configured task pairs and/or consecutive tasks.")
+    mode = parser.add_mutually_exclusive_group(required = True)
+    mode.add_argument("-t", "--task", choices=["pattern-separation", "verbal-learning"])
+    mode.add_argument("--merge", action = "store_true",
+        help = "merge-join the json files, each of which must be sorted by --sorted-by, and report intervals for every (userId, setNum)")
+    parser.add_argument("json_files", type = Path, nargs = "+", metavar = "json_file",
+        help = "with -t, the learning export followed by the recall export")
+    parser.add_argument("--pair", type = _task_pair, action = "append", dest = "pairs", metavar = "FROM:TO",
+        help = "with --merge, report the time from the end of experiment FROM to the start of experiment TO in the same set. "
+               "May be repeated. Default: the pattern-separation and verbal-learning learning/recall pairs. As with -t, "
+               "pattern-separation-recall and verbal-learning-recall start at their recall instructions rather than their set header")
+    parser.add_argument("--consecutive", action = "store_true", help = "with --merge, also report the break between each task and the next one in the set")
+    parser.add_argument("--sorted-by", choices = ["dateTime", "userId"], default = "dateTime", dest = "sorted_by",
+        help = "with --merge, the order of the trials in each file: by dateTime, or by userId and then dateTime")
+    parser.add_argument("--user", help = "only summarize this userId (fast for indexed archives; see trial_archive.py)")
+    parser.add_argument("-o", "--output", type = Path, help = "write the intervals to this file as csv or tsv (see --format) instead of printing them")
+    parser.add_argument("--format", choices = ["csv", "tsv"], help = "output format for --output and --summary (default: from the --output file suffix, otherwise csv)")
+    parser.add_argument("--summary", type = Path, help = "also write per-user and cohort interval statistics to this file")
+    return parser.parse_args()
 
 def get_set_and_learning_end_times(learning_json: str, intervals: IntertaskIntervals) -> None:
     for i in learning_json:
@@ -22,8 +57,8 @@ def get_set_and_learning_end_times(learning_json: str, intervals: IntertaskInter
             intervals.set_set(i["userId"], set)
 
         if i.get("ua", False):
-            learning_end_time = datetime.fromisoformat(i["dateTime"].replace('Z', ''))
-            intervals.set_start_time(i["userId"], learning_end_time)
+            # times are kept as strings and parsed all at once when the intervals are reported
+            intervals.set_start_time(i["userId"], i["dateTime"])
 
 def get_recall_start_times(recall_json: str, intervals: IntertaskIntervals, recall_filter) -> None:
     set = -1
@@ -39,8 +74,7 @@ def get_recall_start_times(recall_json: str, intervals: IntertaskIntervals, reca
            if set == -1:
                raise AssertionError
            
-           recall_start_time = datetime.fromisoformat(i["dateTime"].replace('Z', ''))
-           intervals.set_end_time(i["userId"], set, recall_start_time)
+           intervals.set_end_time(i["userId"], set, i["dateTime"])
            set = -1
 
 def vl_recall_filter(item):
@@ -49,11 +83,126 @@ def vl_recall_filter(item):
 def ps_recall_filter(item):
     return item.get("trial_type", "") == "html-keyboard-response" and item.get("stimulus", "").find("be tested on your memory") > -1
 
-def main(task: str, learning_json_file: Path, recall_json_file: Path) -> None:
-    learning_json = json.loads(learning_json_file.read_text("utf-8"))
-    recall_json = json.loads(recall_json_file.read_text("utf-8"))
+# experiment -> the filter for the trial that -t times its start from, which task_intervals uses too
+RECALL_START_FILTERS = {
+    "pattern-separation-recall": ps_recall_filter,
+    "verbal-learning-recall": vl_recall_filter,
+}
+
+INTERVAL_BATCH_SIZE = 10000 # rows whose interval times are parsed and subtracted together
+
+def merge_trial_streams(streams, sorted_by: str = "dateTime"):
+    """Merges trial streams that are each sorted by dateTime (or by userId, then dateTime) into one sorted stream."""
+    if sorted_by == "userId":
+        return heapq.merge(*streams, key = lambda t: (t.get("userId", ""), t.get("dateTime", "")))
+    return heapq.merge(*streams, key = lambda t: t.get("dateTime", ""))
+
+class _SetTasks:
+    """Start and end times of the tasks in one user's set, in the order the tasks started."""
+    def __init__(self):
+        self.tasks = {} # experiment -> [start, end]
+
+    def start(self, experiment, date_time):
+        times = self.tasks.setdefault(experiment, [None, None])
+        if times[0] is None:
+            times[0] = date_time
+
+    def end(self, experiment, date_time):
+        self.tasks.setdefault(experiment, [None, None])[1] = date_time
+
+def _interval_row(user_id, set_num, kind, from_task, to_task, from_times, to_times):
+    # the same notes as -t, which name the task whose time is missing
+    if from_times is None or from_times[1] is None:
+        return [user_id, set_num, kind, from_task, to_task, "", IntertaskIntervals.NO_START.format(from_task = from_task)]
+    if to_times is None or to_times[0] is None:
+        return [user_id, set_num, kind, from_task, to_task, "", IntertaskIntervals.NO_END.format(to_task = to_task)]
+    # the (end, start) pair is replaced with the number of seconds between them by with_interval_secs
+    return [user_id, set_num, kind, from_task, to_task, (from_times[1], to_times[0]), ""]
+
+def _set_rows(user_id, set_num, set_tasks, pairs, consecutive):
+    for (from_task, to_task) in pairs:
+        from_times = set_tasks.tasks.get(from_task)
+        to_times = set_tasks.tasks.get(to_task)
+        if from_times is None and to_times is None:
+            continue
+        yield _interval_row(user_id, set_num, "pair", from_task, to_task, from_times, to_times)
+    if consecutive:
+        ordered = sorted((times[0], experiment) for (experiment, times) in set_tasks.tasks.items() if times[0] is not None)
+        for ((_, from_task), (_, to_task)) in zip(ordered, ordered[1:]):
+            yield _interval_row(user_id, set_num, "consecutive", from_task, to_task, set_tasks.tasks[from_task], set_tasks.tasks[to_task])
+
+def task_intervals(trials, pairs = DEFAULT_TASK_PAIRS, consecutive = False):
+    """
+    Yields a row (see MERGE_FIELDS) for each configured (from, to) experiment pair and, if consecutive
+    is true, for each pair of consecutive tasks, in every (userId, setNum) in trials. interval_secs
+    is the pair of times to subtract; use with_interval_secs to replace it with the interval.
+    A task starts at its set header trial (taskStarted), or for the experiments in RECALL_START_FILTERS
+    at the first trial its filter matches, and ends at the trial with the ua value.
+    Each user's trials must be in dateTime order. A user's set is reported as soon as their
+    next set starts, so only the sets in progress are kept in memory.
+    """
+    current = {} # userId -> (setNum, experiment, _SetTasks)
+    for t in iter_in_user_order(with_required_fields(trials), message = "trials are out of dateTime order"):
+        user_id = t["userId"]
+        date_time = t["dateTime"]
+        state = current.get(user_id)
 
-    intervals = IntertaskIntervals()
+        if t.get("taskStarted", False):
+            set_num = t.get("setNum", -1)
+            if state and state[0] != set_num:
+                yield from _set_rows(user_id, state[0], state[2], pairs, consecutive)
+                state = None
+            set_tasks = state[2] if state else _SetTasks()
+            if t.get("experiment") not in RECALL_START_FILTERS:
+                set_tasks.start(t.get("experiment"), date_time)
+            state = (set_num, t.get("experiment"), set_tasks)
+        elif state and t.get("ua", False):
+            state[2].end(state[1], date_time)
+        elif state and state[1] in RECALL_START_FILTERS and RECALL_START_FILTERS[state[1]](t):
+            state[2].start(state[1], date_time)
+        current[user_id] = state
+
+    for (user_id, state) in current.items():
+        if state:
+            yield from _set_rows(user_id, state[0], state[2], pairs, consecutive)
+
+def _interval_secs_batch(batch):
+    pending = [row for row in batch if isinstance(row[5], tuple)]
+    if pending:
+        secs = whole_seconds_between(parse_iso([row[5][0] for row in pending]), parse_iso([row[5][1] for row in pending]))
+        for (row, s) in zip(pending, secs):
+            row[5] = int(s)
+    return batch
+
+def with_interval_secs(rows, batch_size = INTERVAL_BATCH_SIZE):
+    """Fills in interval_secs for the rows from task_intervals, parsing the times in batches of batch_size rows."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield from _interval_secs_batch(batch)
+            batch = []
+    yield from _interval_secs_batch(batch)
+
+def main_merge(json_files: list[Path], pairs = None, consecutive: bool = False, sorted_by: str = "dateTime",
+               user_id: Optional[str] = None, output: Optional[Path] = None, format: Optional[str] = None) -> None:
+    trials = merge_trial_streams([open_trials(f, user_id) for f in json_files], sorted_by)
+    rows = with_interval_secs(task_intervals(trials, pairs or DEFAULT_TASK_PAIRS, consecutive))
+    if not format:
+        format = "tsv" if output and output.suffix == ".tsv" else "csv"
+    delimiter = "\t" if format == "tsv" else ","
+    with (open(output, "w", newline = "") if output else contextlib.nullcontext(sys.stdout)) as f:
+        writer = csv.writer(f, delimiter = delimiter)
+        writer.writerow(MERGE_FIELDS)
+        for row in rows:
+            writer.writerow(row)
+
+def main(task: str, learning_json_file: Path, recall_json_file: Path, user_id: Optional[str] = None,
+         output: Optional[Path] = None, format: Optional[str] = None, summary: Optional[Path] = None) -> None:
+    learning_json = open_trials(learning_json_file, user_id)
+    recall_json = open_trials(recall_json_file, user_id)
+
+    intervals = IntertaskIntervals(f"{task}-learning", f"{task}-recall")
 
     get_set_and_learning_end_times(learning_json, intervals)
     
@@ -62,8 +211,28 @@ def main(task: str, learning_json_file: Path, recall_json_file: Path) -> None:
     else:
         get_recall_start_times(recall_json, intervals, ps_recall_filter)
        
-    print("user id, set number, seconds from learning end to recall start")
-    print(intervals)
+    if not format:
+        format = "tsv" if output and output.suffix == ".tsv" else "csv"
+    delimiter = "\t" if format == "tsv" else ","
+    if output:
+        with open(output, "w", newline = "") as f:
+            count = intervals.write_csv(f, delimiter)
+        print(f"Wrote {count} intervals to {output}", file = sys.stderr)
+    else:
+        print("user id, set number, seconds from learning end to recall start")
+        print(intervals)
+
+    if summary:
+        with open(summary, "w", newline = "") as f:
+            intervals.write_summary_csv(f, delimiter = delimiter)
 
 if __name__ == "__main__":
-    main(*parse_args())
+    args = parse_args()
+    if args.merge:
+        if args.summary:
+            sys.exit("--summary is only supported with -t")
+        main_merge(args.json_files, args.pairs, args.consecutive, args.sorted_by, args.user, args.output, args.format)
+    else:
+        if len(args.json_files) != 2:
+            sys.exit("-t takes exactly two json files: the learning export and the recall export")
+        main(args.task, args.json_files[0], args.json_files[1], args.user, args.output, args.format, args.summary)
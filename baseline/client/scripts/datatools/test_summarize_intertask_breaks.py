@@ -0,0 +1,75 @@
+# Runs the same learning and recall exports through summarize-intertask-breaks.py's -t and --merge modes and
+# checks that they report the same interval, or the same note, for every user and set.
+# python -m pytest test_summarize_intertask_breaks.py
+
+import csv
+import importlib.util
+import json
+from pathlib import Path
+
+import pytest
+
+spec = importlib.util.spec_from_file_location("summarize_intertask_breaks", Path(__file__).parent / "summarize-intertask-breaks.py")
+breaks = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(breaks)
+
+RECALL_INSTRUCTIONS = {
+    "pattern-separation": "<p>You will now be tested on your memory of the pictures.</p>",
+    "verbal-learning": "We presented two different lists of words to you earlier. Please recall the first list.",
+}
+
+def _time(minutes):
+    return f"2024-03-01T{10 + minutes // 60:02d}:{minutes % 60:02d}:00.000Z"
+
+def _run(user_id, experiment, set_num, start, finished = True, recall_instructions = None):
+    trials = [
+        {"userId": user_id, "experiment": experiment, "dateTime": _time(start), "taskStarted": True, "setNum": set_num},
+        {"userId": user_id, "experiment": experiment, "dateTime": _time(start + 1), "trial_type": "html-keyboard-response", "stimulus": "<p>Press the space bar to continue.</p>"},
+    ]
+    if recall_instructions:
+        trials.append({"userId": user_id, "experiment": experiment, "dateTime": _time(start + 2), "trial_type": "html-keyboard-response", "stimulus": recall_instructions})
+    if finished:
+        trials.append({"userId": user_id, "experiment": experiment, "dateTime": _time(start + 4), "ua": "Mozilla/5.0", "v": "1.0", "screen": "1920x1080"})
+    return trials
+
+def _exports(task):
+    learning = f"{task}-learning"
+    recall = f"{task}-recall"
+    instructions = RECALL_INSTRUCTIONS[task]
+    learning_trials = [
+        *_run("u1", learning, 1, 0),
+        *_run("u1", learning, 2, 100),  # no recall in set 2
+        *_run("u2", learning, 1, 0, finished = False),  # recall without a learning end time
+        *_run("u2", learning, 2, 100),
+    ]
+    # -t tracks the set across users, so one user's recall runs must not overlap another's
+    recall_trials = [
+        *_run("u1", recall, 1, 30, recall_instructions = instructions),
+        *_run("u2", recall, 1, 60, recall_instructions = instructions),
+        *_run("u2", recall, 2, 140),  # recall without its instructions, so without a start time
+    ]
+    return (sorted(learning_trials, key = lambda t: t["dateTime"]), sorted(recall_trials, key = lambda t: t["dateTime"]))
+
+def _read(path, fields):
+    with open(path, newline = "") as f:
+        return sorted(tuple(row[field] for field in fields) for row in csv.DictReader(f))
+
+@pytest.mark.parametrize("task", sorted(RECALL_INSTRUCTIONS))
+def test_merge_matches_task_mode(task, tmp_path):
+    (learning_trials, recall_trials) = _exports(task)
+    (learning_path, recall_path) = (tmp_path / "learning.json", tmp_path / "recall.json")
+    learning_path.write_text(json.dumps(learning_trials))
+    recall_path.write_text(json.dumps(recall_trials))
+
+    breaks.main(task, learning_path, recall_path, output = tmp_path / "task.csv")
+    breaks.main_merge([learning_path, recall_path], pairs = [(f"{task}-learning", f"{task}-recall")], output = tmp_path / "merge.csv")
+
+    fields = ["user_id", "set_num", "interval_secs", "note"]
+    task_rows = _read(tmp_path / "task.csv", fields)
+    assert task_rows == _read(tmp_path / "merge.csv", fields)
+    assert task_rows == [
+        ("u1", "1", "1680", ""),
+        ("u1", "2", "", f"N/A - no start time for {task}-recall"),
+        ("u2", "1", "", f"N/A - no end time for {task}-learning"),
+        ("u2", "2", "", f"N/A - no start time for {task}-recall"),
+    ]
@@ -0,0 +1,94 @@
+"""
+Column-at-a-time handling of trial timestamps with NumPy.
+
+Trials record dateTime as an ISO 8601 UTC string (2023-03-03T09:18:00.000Z, as
+produced by JavaScript's toISOString), and DynamoDB items record
+experimentDateTime as experiment|dateTime|index. The functions here convert
+whole lists of these to datetime64[ms] arrays at once and do the comparisons and
+arithmetic the tools need on the arrays, rather than parsing and comparing one
+value at a time. Missing values become NaT.
+"""
+import numpy as np
+
+UNIT = 'datetime64[ms]'
+
+def parse_iso(values):
+    """
+    Parses a sequence of ISO 8601 strings (with or without a trailing Z), datetime objects
+    or None into a datetime64[ms] array.
+    """
+    # numpy warns about (and will stop accepting) time zone designators, and our times are all UTC.
+    # Converting the list straight to datetime64 is much faster than going through a string array.
+    return np.array([v[:-1] if isinstance(v, str) and v.endswith('Z') else v for v in values], dtype=UNIT)
+
+def experiment_date_times(values):
+    """Parses the dateTime part of a sequence of experimentDateTime (experiment|dateTime|index) values."""
+    arr = np.array(values, dtype=str)
+    if arr.size == 0:
+        return np.array([], dtype=UNIT)
+    after_experiment = np.char.partition(arr, '|')[:, 2]
+    return parse_iso(np.char.partition(after_experiment, '|')[:, 0])
+
+def seconds_between(start, end):
+    """Returns end - start in (fractional) seconds as a float array, with NaN where either time is NaT."""
+    return (np.asarray(end, dtype=UNIT) - np.asarray(start, dtype=UNIT)) / np.timedelta64(1, 's')
+
+def whole_seconds_between(start, end):
+    """Like seconds_between, but truncated toward zero the way int(timedelta.total_seconds()) is."""
+    return np.trunc(seconds_between(start, end))
+
+def order_violations(users, times, previous=None):
+    """
+    Returns the (sorted) indices of the times that are earlier than the previous time for the same user.
+    Equal times are allowed. previous, if given, is a dict of user -> latest datetime64 seen in an earlier
+    batch; the first time for each user is checked against it, and it's updated with the latest time
+    for each user in this batch, so a long stream can be checked in batches.
+    """
+    times = np.asarray(times, dtype=UNIT)
+    if times.size == 0:
+        return np.array([], dtype=np.intp)
+    users = list(users)
+    user_codes = {}
+    codes = np.fromiter((user_codes.setdefault(u, len(user_codes)) for u in users), dtype=np.intp, count=len(users))
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    sorted_times = times[order]
+    same_user = sorted_codes[1:] == sorted_codes[:-1]
+    bad = order[1:][same_user & (sorted_times[1:] < sorted_times[:-1])]
+
+    if previous is not None:
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = ~same_user
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = ~same_user
+        late = [i for i in order[first] if users[i] in previous and times[i] < previous[users[i]]]
+        if late:
+            bad = np.concatenate([bad, np.array(late, dtype=np.intp)])
+        for i in order[last]:
+            previous[users[i]] = times[i]
+
+    return np.sort(bad)
+
+def check_monotonic_by_user(users, times, previous=None, message='trial later in list has earlier dateTime'):
+    """Raises AssertionError if any user's times go backwards (see order_violations)."""
+    bad = order_violations(users, times, previous)
+    if len(bad):
+        raise AssertionError(f'{message} (user {users[bad[0]]})')
+
+def iter_in_user_order(trials, batch_size=10000, message='trial later in list has earlier dateTime'):
+    """
+    Yields trials (dicts with userId and dateTime values), checking that each user's dateTimes
+    never go backwards. Trials are read batch_size at a time and each batch's dateTimes are parsed
+    and checked together, so a batch is only yielded once it's been checked.
+    """
+    previous = {}
+    batch = []
+    for t in trials:
+        batch.append(t)
+        if len(batch) == batch_size:
+            check_monotonic_by_user([t['userId'] for t in batch], parse_iso([t['dateTime'] for t in batch]), previous, message)
+            yield from batch
+            batch = []
+    if batch:
+        check_monotonic_by_user([t['userId'] for t in batch], parse_iso([t['dateTime'] for t in batch]), previous, message)
+        yield from batch
@@ -0,0 +1,204 @@
+"""
+Indexed trial archives, for reading one participant's trials from a large export
+without parsing the rest of it.
+
+An archive is an uncompressed NDJSON file (one trial per line, so any tool that
+reads NDJSON exports can read it too) with a sidecar index, <archive>.idx, that
+maps each run of consecutive trials with the same userId, experiment and setNum
+to the byte range holding them. setNum is carried forward from each user's most
+recent set header trial, the same way label_setnums assigns it, so unlabeled
+exports can be indexed too; trials before a user's first header have a setNum of
+None in the index. TrialArchive memory-maps the archive and only decodes the
+lines in the requested ranges.
+
+Usage:
+trial_archive.py build export.json export.ndjson
+trial_archive.py query export.ndjson --user <userId> [--experiment name] [--set n] [--count]
+"""
+import json
+import mmap
+import os
+from trial_stream import iter_trials
+
+INDEX_SUFFIX = '.idx'
+INDEX_VERSION = 1
+
+def index_path_for(archive_path):
+    return str(archive_path) + INDEX_SUFFIX
+
+def has_index(path):
+    return os.path.isfile(index_path_for(path))
+
+class _SetNumTracker(object):
+    """Carries each user's setNum forward from their latest set header trial."""
+    def __init__(self):
+        self.current = {}
+
+    def set_num_for(self, trial):
+        user = trial.get('userId')
+        if trial.get('taskStarted') or trial.get('setNum') is not None:
+            self.current[user] = trial.get('setNum')
+        return self.current.get(user)
+
+def build_archive(source_path, archive_path):
+    """
+    Converts the export at source_path (a JSON array or NDJSON, optionally compressed)
+    to an archive at archive_path and writes its index. Trials are kept in their original
+    order. Returns the number of trials written.
+    """
+    segments = [] # [userId, experiment, setNum, start, end, count]
+    tracker = _SetNumTracker()
+    offset = 0
+    count = 0
+    with open(archive_path, 'wb') as f:
+        for trial in iter_trials(source_path):
+            line = json.dumps(trial).encode('utf-8') + b'\n'
+            key = (trial.get('userId'), trial.get('experiment'), tracker.set_num_for(trial))
+            last = segments[-1] if segments else None
+            if last is not None and (last[0], last[1], last[2]) == key:
+                last[4] += len(line)
+                last[5] += 1
+            else:
+                segments.append([key[0], key[1], key[2], offset, offset + len(line), 1])
+            f.write(line)
+            offset += len(line)
+            count += 1
+
+    index = {'version': INDEX_VERSION, 'size': offset, 'trials': count, 'segments': segments}
+    with open(index_path_for(archive_path), 'w') as f:
+        json.dump(index, f)
+    return count
+
+class TrialArchive(object):
+    """
+    Reads trials from an archive written by build_archive. Use as a context manager,
+    or call close() when done.
+    """
+    def __init__(self, archive_path):
+        self.path = str(archive_path)
+        with open(index_path_for(self.path)) as f:
+            index = json.load(f)
+        if index.get('version') != INDEX_VERSION:
+            raise ValueError(f'{index_path_for(self.path)} has unsupported index version {index.get("version")}')
+        if os.path.getsize(self.path) != index['size']:
+            raise ValueError(f'{self.path} has changed since it was indexed. Rebuild it with build_archive.')
+        self.trial_count = index['trials']
+        self.segments = [tuple(s) for s in index['segments']]
+        self.segments_by_user = {}
+        for (idx, seg) in enumerate(self.segments):
+            self.segments_by_user.setdefault(seg[0], []).append(idx)
+
+        self._file = open(self.path, 'rb')
+        # mmap can't map an empty file
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if index['size'] else b''
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def users(self):
+        return list(self.segments_by_user.keys())
+
+    def experiments(self, user_id=None):
+        segs = self._candidate_segments(user_id)
+        return list(dict.fromkeys(seg[1] for seg in segs))
+
+    def set_nums(self, user_id, experiment=None):
+        return list(dict.fromkeys(seg[2] for seg in self._candidate_segments(user_id) if experiment is None or seg[1] == experiment))
+
+    def _candidate_segments(self, user_id):
+        if user_id is None:
+            return self.segments
+        return [self.segments[idx] for idx in self.segments_by_user.get(user_id, [])]
+
+    def ranges(self, user_id=None, experiment=None, set_num=None):
+        """Returns the (start, end) byte ranges of the matching trials, merging adjacent ranges."""
+        result = []
+        for seg in self._candidate_segments(user_id):
+            if experiment is not None and seg[1] != experiment:
+                continue
+            if set_num is not None and seg[2] != set_num:
+                continue
+            if result and result[-1][1] == seg[3]:
+                result[-1] = (result[-1][0], seg[4])
+            else:
+                result.append((seg[3], seg[4]))
+        return result
+
+    def count(self, user_id=None, experiment=None, set_num=None):
+        """Returns the number of matching trials, from the index alone."""
+        return sum(seg[5] for seg in self._candidate_segments(user_id)
+            if (experiment is None or seg[1] == experiment) and (set_num is None or seg[2] == set_num))
+
+    def trials(self, user_id=None, experiment=None, set_num=None):
+        """Yields the matching trials in archive order."""
+        for (start, end) in self.ranges(user_id, experiment, set_num):
+            for line in self._map[start:end].splitlines():
+                yield json.loads(line)
+
+def _filter_trials(trials, user_id, experiment, set_num):
+    tracker = _SetNumTracker()
+    for t in trials:
+        trial_set_num = tracker.set_num_for(t) if set_num is not None else None
+        if user_id is not None and t.get('userId') != user_id:
+            continue
+        if experiment is not None and t.get('experiment') != experiment:
+            continue
+        if set_num is not None and trial_set_num != set_num:
+            continue
+        yield t
+
+def open_trials(path, user_id=None, experiment=None, set_num=None):
+    """
+    Yields the trials in path that match the given userId, experiment and setNum (None matches anything).
+    If path is an archive with an index, only the matching trials are read; otherwise path is
+    streamed with trial_stream.iter_trials and filtered.
+    """
+    if user_id is None and experiment is None and set_num is None:
+        yield from iter_trials(path)
+    elif has_index(path):
+        with TrialArchive(path) as archive:
+            yield from archive.trials(user_id, experiment, set_num)
+    else:
+        yield from _filter_trials(iter_trials(path), user_id, experiment, set_num)
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    def _parse_args():
+        parser = argparse.ArgumentParser()
+        subparsers = parser.add_subparsers(dest='command', required=True)
+        build = subparsers.add_parser('build', help='Convert an export to an indexed archive')
+        build.add_argument('export', help='JSON array or NDJSON export, optionally gzip or zstd compressed')
+        build.add_argument('archive', help='Archive to write. Its index is written next to it with an .idx suffix.')
+        query = subparsers.add_parser('query', help='Write the matching trials from an archive to stdout as NDJSON')
+        query.add_argument('archive')
+        query.add_argument('--user', help='userId')
+        query.add_argument('--experiment')
+        query.add_argument('--set', type=int, dest='set_num', help='setNum')
+        query.add_argument('--count', action='store_true', help='Only print the number of matching trials')
+        return parser.parse_args()
+
+    def _main(args):
+        if args.command == 'build':
+            count = build_archive(args.export, args.archive)
+            print(f'Wrote {count} trials to {args.archive}')
+            return
+
+        with TrialArchive(args.archive) as archive:
+            if args.count:
+                print(archive.count(args.user, args.experiment, args.set_num))
+                return
+            for t in archive.trials(args.user, args.experiment, args.set_num):
+                sys.stdout.write(json.dumps(t))
+                sys.stdout.write('\n')
+
+    _main(_parse_args())
@@ -0,0 +1,100 @@
+"""
+Incremental readers for trial exports.
+
+Exports are either a single JSON array of trials (what the admin download
+produces) or NDJSON, with one trial per line. iter_trials figures out which
+from the first non-whitespace character and yields trials one at a time, so
+memory use doesn't grow with the size of the export. Compressed files are
+handled by compressed_io.
+"""
+import json
+import re
+from compressed_io import open_input
+
+CHUNK_SIZE = 1 << 20 # characters read from the file at a time
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+def _skip_whitespace(buf, pos):
+    return _whitespace.match(buf, pos).end()
+
+def _read_more(f, buf, pos):
+    chunk = f.read(CHUNK_SIZE)
+    return (buf[pos:] + chunk, 0, chunk == '')
+
+def _iter_json_array(f, buf):
+    pos = _skip_whitespace(buf, 0) + 1 # skip the opening [
+    eof = False
+    expect_value = True
+    while True:
+        pos = _skip_whitespace(buf, pos)
+        if pos == len(buf):
+            if eof:
+                raise ValueError('Unexpected end of JSON array')
+            (buf, pos, eof) = _read_more(f, buf, pos)
+            continue
+
+        c = buf[pos]
+        if expect_value:
+            if c == ']':
+                return
+            try:
+                (value, end) = _decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # the value was probably cut off at the end of the buffer
+                (buf, pos, eof) = _read_more(f, buf, pos)
+                continue
+            if end == len(buf) and not eof:
+                # a number at the very end of the buffer may have been truncated
+                (buf, pos, eof) = _read_more(f, buf, pos)
+                continue
+            yield value
+            pos = end
+            expect_value = False
+        elif c == ',':
+            expect_value = True
+            pos += 1
+        elif c == ']':
+            return
+        else:
+            raise ValueError(f'Expected "," or "]" in JSON array, but found "{c}"')
+
+def _iter_ndjson(f, buf):
+    # the first chunk probably ends partway through a line
+    lines = buf.split('\n')
+    lines[-1] += f.readline()
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+def iter_trials(path):
+    """
+    Yields the trials in path one at a time. path may be a JSON array of trials or NDJSON
+    (one trial per line), optionally gzip or zstd compressed.
+    """
+    with open_input(path) as f:
+        buf = f.read(CHUNK_SIZE)
+        start = _skip_whitespace(buf, 0)
+        if start == len(buf):
+            return
+        if buf[start] == '[':
+            yield from _iter_json_array(f, buf)
+        else:
+            yield from _iter_ndjson(f, buf)
+
+def with_required_fields(trials):
+    """
+    Yields trials, raising an AssertionError at the first trial without a userId or dateTime,
+    which every tool that orders trials by user and time needs.
+    """
+    for t in trials:
+        if not t.get('userId'):
+            raise AssertionError('trial missing userId')
+        if not t.get('dateTime'):
+            raise AssertionError('trial missing dateTime')
+        yield t